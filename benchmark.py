@@ -0,0 +1,553 @@
+# Offline benchmark for the bot's slash command handlers.
+# Drives /ai, /aiupload, /generateimage and the conversation history functions through fake Discord
+# interactions, against a local mock of the Gemini, Imagen and Custom Search APIs, so no API quota is spent.
+#
+# Example:
+#   python benchmark.py --scenarios ai,ai_stream,generateimage --concurrency 1,8,32 --requests 200
+#   python benchmark.py --json bench.json                           (save the results)
+#   python benchmark.py --compare bench.json --tolerance 0.15       (exit code 1 on a regression)
+#
+# Handlers are called directly, so the per-user rate limit checks are not part of the measurement.
+
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from PIL import Image
+
+try:
+    import resource # Peak RSS; not available on Windows
+except ImportError:
+    resource = None
+
+BOT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("ai", "ai_stream", "ai_search", "aiupload", "generateimage", "history")
+ERROR_EMBED_TITLES = ("Error", "Reply Interrupted", "Image Generation Failed", "Image Queue Full", "Image Display Error")
+
+# --- Mock Upstream Server ---
+class MockUpstream:
+    """
+    Emulates generateContent, streamGenerateContent, cachedContents, Imagen predict and Custom Search.
+    Every call waits for a normally distributed latency and may be answered with an injected HTTP 500 or 429.
+    """
+
+    def __init__(self, args):
+        self.latency = args.latency
+        self.fast_latency = args.fast_latency
+        self.jitter = args.jitter
+        self.error_rate = args.error_rate
+        self.rate_limit_rate = args.rate_limit_rate
+        self.retry_after = args.retry_after
+        self.stream_chunks = args.stream_chunks
+        self.chunk_interval = args.chunk_interval
+        self.reply_chars = args.reply_chars
+        self.random = random.Random(args.seed)
+        self.calls = {} # endpoint -> {"ok": n, "error": n, "rate_limited": n}
+        self.model_calls = {} # model -> requests received
+        self.cached_contents = {} # cachedContents name -> prompt tokens it holds
+        image_buffer = io.BytesIO()
+        Image.effect_noise((256, 256), 64).convert("RGB").save(image_buffer, format="PNG")
+        self.image_base64 = base64.b64encode(image_buffer.getvalue()).decode("ascii")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1beta/models/{model_action}", self._handle_model)
+        app.router.add_post("/v1beta/cachedContents", self._handle_create_cache)
+        app.router.add_patch("/v1beta/cachedContents/{cache_id}", self._handle_update_cache)
+        app.router.add_delete("/v1beta/cachedContents/{cache_id}", self._handle_delete_cache)
+        app.router.add_get("/customsearch/v1", self._handle_search)
+        return app
+
+    async def _simulate(self, endpoint, latency=None):
+        """Waits for the configured latency and returns the error response to inject, if any."""
+        counts = self.calls.setdefault(endpoint, {"ok": 0, "error": 0, "rate_limited": 0})
+        await asyncio.sleep(max(0.0, self.random.gauss(self.latency if latency is None else latency, self.jitter)))
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            counts["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"code": 429, "message": "Resource has been exhausted"}},
+                status=429,
+                headers={"Retry-After": f"{self.retry_after:g}"}
+            )
+        if roll < self.rate_limit_rate + self.error_rate:
+            counts["error"] += 1
+            return web.json_response({"error": {"code": 500, "message": "Internal error"}}, status=500)
+        counts["ok"] += 1
+        return None
+
+    def _reply_text(self, request_index):
+        words = ("the", "model", "answers", "with", "a", "reasonably", "long", "benchmark", "reply", "to", "fill", "embeds")
+        text = f"Reply {request_index}:"
+        while len(text) < self.reply_chars:
+            text += " " + words[len(text) % len(words)]
+        return text[:self.reply_chars]
+
+    def _usage(self, body, reply):
+        cached_tokens = self.cached_contents.get(body.get("cachedContent"), 0)
+        prompt_tokens = len(json.dumps(body.get("contents", []))) // 4 + cached_tokens
+        usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(reply) // 4, "totalTokenCount": prompt_tokens + len(reply) // 4}
+        if cached_tokens:
+            usage["cachedContentTokenCount"] = cached_tokens
+        return usage
+
+    async def _handle_model(self, request):
+        model, _, action = request.match_info["model_action"].partition(":")
+        body = await request.json()
+        self.model_calls[model] = self.model_calls.get(model, 0) + 1
+        is_fast_model = "flash" in model or "fast" in model
+        error_response = await self._simulate(action, self.fast_latency if is_fast_model else None)
+        if error_response is not None:
+            return error_response
+
+        if action == "predict":
+            sample_count = body.get("parameters", {}).get("sampleCount", 1)
+            return web.json_response({"predictions": [{"mimeType": "image/png", "bytesBase64Encoded": self.image_base64}] * sample_count})
+        if "cachedContent" in body and body["cachedContent"] not in self.cached_contents:
+            return web.json_response({"error": {"code": 404, "message": "CachedContent not found"}}, status=404)
+
+        reply = self._reply_text(self.calls[action]["ok"])
+        if action == "generateContent":
+            return web.json_response({
+                "candidates": [{"content": {"role": "model", "parts": [{"text": reply}]}}],
+                "usageMetadata": self._usage(body, reply)
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        chunk_length = max(1, -(-len(reply) // self.stream_chunks))
+        for start in range(0, len(reply), chunk_length):
+            if start:
+                await asyncio.sleep(self.chunk_interval)
+            chunk = {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": reply[start:start + chunk_length]}]}}],
+                "usageMetadata": self._usage(body, reply[:start + chunk_length])
+            }
+            await response.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\r\n\r\n")
+        await response.write_eof()
+        return response
+
+    async def _handle_create_cache(self, request):
+        body = await request.json()
+        error_response = await self._simulate("cachedContents")
+        if error_response is not None:
+            return error_response
+        name = f"cachedContents/mock-{len(self.cached_contents) + self.calls['cachedContents']['ok']}"
+        self.cached_contents[name] = len(json.dumps(body.get("contents", []))) // 4
+        return web.json_response({"name": name, "model": body.get("model"), "ttl": body.get("ttl")})
+
+    async def _handle_update_cache(self, request):
+        name = f"cachedContents/{request.match_info['cache_id']}"
+        error_response = await self._simulate("cachedContents")
+        if error_response is not None:
+            return error_response
+        if name not in self.cached_contents:
+            return web.json_response({"error": {"code": 404, "message": "CachedContent not found"}}, status=404)
+        return web.json_response({"name": name, **(await request.json())})
+
+    async def _handle_delete_cache(self, request):
+        error_response = await self._simulate("cachedContents")
+        if error_response is not None:
+            return error_response
+        self.cached_contents.pop(f"cachedContents/{request.match_info['cache_id']}", None)
+        return web.json_response({})
+
+    async def _handle_search(self, request):
+        error_response = await self._simulate("search")
+        if error_response is not None:
+            return error_response
+        query = request.query.get("q", "")
+        count = int(request.query.get("num", "3"))
+        return web.json_response({"items": [
+            {"title": f"Result {i} for {query}", "snippet": "A snippet of a page that matches the query.", "link": f"https://example.com/{i}"}
+            for i in range(1, count + 1)
+        ]})
+
+class MockRoutingSession:
+    """Wraps the bot's pooled session and sends every upstream request to the mock server instead."""
+
+    def __init__(self, session, base_url):
+        self._session = session
+        self._base_url = base_url
+
+    def request(self, method, url, **kwargs):
+        parts = urlsplit(str(url))
+        return self._session.request(method, f"{self._base_url}{parts.path}" + (f"?{parts.query}" if parts.query else ""), **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+# --- Fake Discord Objects ---
+class FakeMessage:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def edit(self, **fields):
+        await self.interaction.record(fields)
+
+    async def delete(self):
+        await asyncio.sleep(self.interaction.discord_latency)
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **fields):
+        await self.interaction.record({"content": content, **fields})
+        return FakeMessage(self.interaction)
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        await asyncio.sleep(self.interaction.discord_latency)
+        self._done = True
+
+    async def send_message(self, content=None, **fields):
+        self._done = True
+        await self.interaction.record({"content": content, **fields})
+
+class FakeAttachment:
+    def __init__(self, data, content_type="image/png"):
+        self._data = data
+        self.size = len(data)
+        self.content_type = content_type
+        self.url = "https://cdn.discordapp.com/attachments/benchmark/upload.png"
+
+    async def read(self):
+        return self._data
+
+class FakeInteraction:
+    """Enough of discord.Interaction for the command handlers. Every send or edit costs discord_latency."""
+
+    def __init__(self, user_id, guild_id, channel_id, discord_latency):
+        self.user = types.SimpleNamespace(id=user_id, display_name=f"bench-user-{user_id}")
+        self.guild = types.SimpleNamespace(id=guild_id, name=f"bench-guild-{guild_id}") if guild_id else None
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.channel = None
+        self.discord_latency = discord_latency
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.sends = 0
+        self.failed = False
+        self.image_delivered = asyncio.Event()
+
+    async def record(self, fields):
+        await asyncio.sleep(self.discord_latency)
+        self.sends += 1
+        for embed in fields.get("embeds") or [fields.get("embed")]:
+            if embed is None:
+                continue
+            embed_text = " ".join([embed.description or ""] + [field.value for field in embed.fields])
+            if embed.title in ERROR_EMBED_TITLES or embed_text.startswith("Sorry") or " Sorry, " in embed_text:
+                self.failed = True
+            if embed.title in ERROR_EMBED_TITLES or "attachments" in fields:
+                self.image_delivered.set()
+        if (fields.get("content") or "").startswith("Sorry"):
+            self.failed = True
+
+    async def edit_original_response(self, **fields):
+        await self.record(fields)
+
+    async def original_response(self):
+        return FakeMessage(self)
+
+# --- Measurement ---
+class LoopLagMonitor:
+    """Measures how late a short timer fires, i.e. how long the event loop was blocked."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start_time - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+def percentile(samples, quantile):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024 # bytes on macOS, KiB elsewhere
+
+# --- Scenarios ---
+def build_scenarios(bot_module, args, upload_bytes):
+    """Returns scenario name -> coroutine function(index) that runs one request end to end."""
+
+    def new_interaction(index):
+        user_id = 1000 + index % args.users
+        guild_id = None if args.guilds == 0 or index % 5 == 0 else 1 + index % args.guilds # Every fifth request is a DM
+        return FakeInteraction(user_id, guild_id, guild_id * 100 if guild_id else None, args.discord_latency)
+
+    def prompt_number(index):
+        return index % args.prompt_pool if args.prompt_pool else index
+
+    def finish(interaction):
+        if interaction.failed:
+            raise RuntimeError("the handler replied with an error message")
+
+    async def ai(index, stream=False, search=False):
+        bot_module.AI_STREAM_RESPONSES = stream
+        interaction = new_interaction(index)
+        await bot_module.ai_command.callback(interaction, f"Benchmark question {prompt_number(index)}: explain event loops.", search)
+        finish(interaction)
+
+    async def aiupload(index):
+        interaction = new_interaction(index)
+        await bot_module.aiupload_command.callback(interaction, FakeAttachment(upload_bytes), f"What is in benchmark image {index}?", False)
+        finish(interaction)
+
+    async def generateimage(index):
+        interaction = new_interaction(index)
+        await bot_module.generateimage_command.callback(interaction, f"Benchmark painting number {prompt_number(index)}", args.variants)
+        await asyncio.wait_for(interaction.image_delivered.wait(), timeout=args.timeout)
+        finish(interaction)
+
+    async def history(index):
+        interaction = new_interaction(index)
+        is_dm = interaction.guild is None
+        guild_id = interaction.guild_id
+        context_key = bot_module.get_conversation_context_key(interaction)
+        await bot_module.add_to_conversation_history(f"Benchmark question {index}", "user", guild_id, interaction.user.id, is_dm, context_key)
+        await bot_module.add_to_conversation_history(f"Benchmark answer {index} " * 20, "model", guild_id, interaction.user.id, is_dm, context_key)
+        await bot_module.get_conversation_history(guild_id, interaction.user.id, is_dm, token_budget=bot_module.AI_HISTORY_TOKEN_BUDGET, context_key=context_key)
+
+    return {
+        "ai": ai,
+        "ai_stream": lambda index: ai(index, stream=True),
+        "ai_search": lambda index: ai(index, search=True),
+        "aiupload": aiupload,
+        "generateimage": generateimage,
+        "history": history
+    }
+
+async def run_level(scenario, run_request, concurrency, total_requests, args):
+    """Runs total_requests requests with `concurrency` in flight and returns the level's measurements."""
+    latencies = []
+    errors = 0
+    next_index = 0
+    first_error = None
+
+    async def worker():
+        nonlocal next_index, errors, first_error
+        while next_index < total_requests:
+            index = next_index
+            next_index += 1
+            start_time = time.perf_counter()
+            try:
+                await asyncio.wait_for(run_request(index), timeout=args.timeout)
+            except Exception as e:
+                errors += 1
+                first_error = first_error or f"{type(e).__name__}: {e}"
+            else:
+                latencies.append(time.perf_counter() - start_time)
+
+    lag_monitor = LoopLagMonitor()
+    if args.trace_memory:
+        tracemalloc.start()
+    lag_monitor.start()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+    await lag_monitor.stop()
+    peak_traced = None
+    if args.trace_memory:
+        peak_traced = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "errors": errors,
+        "first_error": first_error,
+        "seconds": elapsed,
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "loop_lag_p99_ms": percentile(lag_monitor.samples, 0.99) * 1000,
+        "loop_lag_max_ms": max(lag_monitor.samples, default=0.0) * 1000,
+        "peak_traced_mb": peak_traced,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+# --- Reporting ---
+def format_table(results):
+    header = f"{'scenario':<14}{'conc':>6}{'reqs':>7}{'errors':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'lag p99':>9}{'lag max':>9}{'alloc MB':>10}{'rss MB':>9}"
+    lines = [header, "-" * len(header)]
+    for result in results:
+        traced = f"{result['peak_traced_mb']:.1f}" if result["peak_traced_mb"] is not None else "-"
+        rss = f"{result['peak_rss_mb']:.1f}" if result["peak_rss_mb"] is not None else "-"
+        lines.append(
+            f"{result['scenario']:<14}{result['concurrency']:>6}{result['requests']:>7}{result['errors']:>8}"
+            f"{result['rps']:>9.1f}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+            f"{result['loop_lag_p99_ms']:>9.1f}{result['loop_lag_max_ms']:>9.1f}{traced:>10}{rss:>9}"
+        )
+    return "\n".join(lines)
+
+def compare_results(results, baseline_path, tolerance):
+    """Prints throughput and p95 changes against a saved run. Returns True if any level regressed beyond tolerance."""
+    with open(baseline_path, "r") as f:
+        baseline = {(entry["scenario"], entry["concurrency"]): entry for entry in json.load(f)["results"]}
+    regressed = False
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for result in results:
+        previous = baseline.get((result["scenario"], result["concurrency"]))
+        if previous is None:
+            continue
+        rps_change = (result["rps"] - previous["rps"]) / previous["rps"] if previous["rps"] else 0.0
+        p95_change = (result["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] if previous["p95_ms"] else 0.0
+        is_regression = rps_change < -tolerance or p95_change > tolerance
+        regressed = regressed or is_regression
+        print(f"  {result['scenario']:<14} x{result['concurrency']:<4} rps {rps_change:+.1%}  p95 {p95_change:+.1%}{'  REGRESSION' if is_regression else ''}")
+    return regressed
+
+# --- Main ---
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the bot's command handlers against a local mock of the Google APIs.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated scenarios to run ({', '.join(SCENARIOS)}).")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels.")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level.")
+    parser.add_argument("--users", type=int, default=50, help="Distinct fake users the requests are spread over.")
+    parser.add_argument("--guilds", type=int, default=10, help="Distinct fake guilds (0 sends everything as DMs).")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean mock upstream latency in seconds.")
+    parser.add_argument("--fast-latency", type=float, help="Mean latency of fast models (Flash, Imagen fast) in seconds; defaults to --latency.")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Standard deviation of the mock upstream latency.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream calls answered with HTTP 500.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of upstream calls answered with HTTP 429.")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After seconds sent with mock 429s.")
+    parser.add_argument("--stream-chunks", type=int, default=8, help="SSE chunks per streamed reply.")
+    parser.add_argument("--chunk-interval", type=float, default=0.02, help="Seconds between streamed chunks.")
+    parser.add_argument("--reply-chars", type=int, default=1500, help="Length of mock Gemini replies (over 1020 exercises overflow messages).")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="Simulated seconds per Discord defer, send or edit.")
+    parser.add_argument("--variants", type=int, default=1, help="Images requested per /generateimage call.")
+    parser.add_argument("--upload-size", type=int, default=1024, help="Width and height of the /aiupload test image.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds before a single request counts as failed.")
+    parser.add_argument("--prompt-pool", type=int, default=0, help="Repeat this many distinct prompts so identical requests overlap (0 makes every prompt unique).")
+    parser.add_argument("--cache", action="store_true", help="Keep the response and image caches enabled (prompts are unique either way).")
+    parser.add_argument("--context-cache", action="store_true", help="Enable Gemini context caching against the mock cachedContents API.")
+    parser.add_argument("--context-cache-min-tokens", type=int, default=256, help="CONTEXT_CACHE_MIN_TOKENS used with --context-cache.")
+    parser.add_argument("--state-backend", default="file", help="STATE_BACKEND_URL used for the run.")
+    parser.add_argument("--trace-memory", action="store_true", help="Report peak Python allocations per level (slows the run down).")
+    parser.add_argument("--seed", type=int, default=1234, help="Seed for latency and failure injection.")
+    parser.add_argument("--log-level", default="ERROR", help="Log level for the bot while benchmarking.")
+    parser.add_argument("--json", dest="json_path", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with a JSON file from an earlier run.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed rps drop or p95 increase before --compare reports a regression.")
+    return parser.parse_args()
+
+def import_bot(args):
+    """Imports the bot with benchmark settings. It runs in a scratch directory so no real history files are touched."""
+    os.environ.update({
+        "DISCORD_BOT_TOKEN": "benchmark",
+        "GEMINI_API_KEY": "benchmark",
+        "GOOGLE_API_KEY": "benchmark",
+        "GOOGLE_CSE_ID": "benchmark",
+        "METRICS_PORT": "0",
+        "LOG_FORMAT": "text",
+        "LOG_LEVEL": args.log_level,
+        "STATE_BACKEND_URL": args.state_backend,
+        "RESPONSE_CACHE_ENABLED": "true" if args.cache else "false",
+        "CONTEXT_CACHE_ENABLED": "true" if args.context_cache else "false",
+        "CONTEXT_CACHE_MIN_TOKENS": str(args.context_cache_min_tokens),
+        "AI_STREAM_EDIT_INTERVAL": os.environ.get("AI_STREAM_EDIT_INTERVAL", "0.25")
+    })
+    os.chdir(tempfile.mkdtemp(prefix="discord-ai-bot-bench-"))
+    sys.path.insert(0, BOT_DIRECTORY)
+    import github as bot_module
+    bot_module.setup_bot_logging()
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    return bot_module
+
+async def run_benchmark(args):
+    bot_module = import_bot(args)
+    mock = MockUpstream(args)
+    runner = web.AppRunner(mock.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    mock_host, mock_port = runner.addresses[0][:2]
+
+    await bot_module.setup_hook()
+    bot_module.http_session = MockRoutingSession(bot_module.http_session, f"http://{mock_host}:{mock_port}")
+
+    upload_buffer = io.BytesIO()
+    Image.effect_noise((args.upload_size, args.upload_size), 64).convert("RGB").save(upload_buffer, format="PNG")
+    scenarios = build_scenarios(bot_module, args, upload_buffer.getvalue())
+
+    results = []
+    try:
+        for scenario in [name.strip() for name in args.scenarios.split(",") if name.strip()]:
+            if scenario not in scenarios:
+                raise SystemExit(f"Unknown scenario: {scenario}")
+            for concurrency in [int(level) for level in args.concurrency.split(",") if level.strip()]:
+                result = await run_level(scenario, scenarios[scenario], concurrency, args.requests, args)
+                results.append(result)
+                print(f"{scenario} x{concurrency}: {result['rps']:.1f} rps, p95 {result['p95_ms']:.1f} ms, {result['errors']} error(s)"
+                      + (f" (first: {result['first_error']})" if result["first_error"] else ""), flush=True)
+    finally:
+        await bot_module.close_bot_resources()
+        await runner.cleanup()
+    print(f"Models called: {json.dumps(mock.model_calls)}")
+    coalesced = {name: stats["coalesced"] for name, stats in bot_module.get_coalescing_stats().items() if isinstance(stats, dict) and stats["coalesced"]}
+    if coalesced:
+        print(f"Coalesced calls: {json.dumps(coalesced)}")
+    if args.context_cache:
+        print(f"Context cache: {json.dumps(bot_module.get_context_cache_stats())}, live on mock: {len(mock.cached_contents)}")
+    return results, mock.calls
+
+def main():
+    args = parse_args()
+    # The bot runs in a scratch directory, so resolve output paths first.
+    args.json_path = os.path.abspath(args.json_path) if args.json_path else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+    results, upstream_calls = asyncio.run(run_benchmark(args))
+    print()
+    print(format_table(results))
+    print(f"\nMock upstream calls: {json.dumps(upstream_calls)}")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"arguments": vars(args), "results": results, "upstream_calls": upstream_calls}, f, indent=2)
+    if args.compare and compare_results(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,30 @@ import discord
 from discord import app_commands # Required for slash commands
 from discord.ext import commands
 import os
+import sys # For sampling the event loop thread's stack
+import traceback # For formatting stack samples of blocking code
 import json
+import logging # For structured logs
+import datetime # For log record timestamps
+import math # For rounding rate limit costs
 import asyncio # For deferring responses
 import aiohttp # For making HTTP requests to Gemini API
+from aiohttp import web # For the local metrics endpoint
 import base64 # For encoding images for Gemini Vision (used in /aiupload)
-from googleapiclient.discovery import build # For Google Search
 import io # For handling image bytes for discord.File
 import time # For retry mechanism
 import random # For jitter in retry mechanism
+import contextlib # For the upstream scheduler's slot context manager
+import email.utils # For parsing HTTP-date Retry-After headers
+import hashlib # For response cache keys and image content hashes
+import sqlite3 # For the SQLite state backend
+import threading # Serializes access to the SQLite connection from worker threads
+import re # For locating image data in Imagen responses
+import binascii # For decoding base64 image data without intermediate strings
+import weakref # For per-channel reply delivery locks that disappear when unused
+from collections import OrderedDict, deque # For the LRU cache of DM histories and fair queues
+from concurrent.futures import ThreadPoolExecutor # Worker pool for image preprocessing and other heavy work
+from PIL import Image # For downscaling and re-encoding /aiupload images
 
 # --- Configuration ---
 # It's highly recommended to use environment variables for sensitive keys
@@ -22,12 +38,70 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "YOUR_GEMINI_API_KEY_HERE")    # Us
 # --- Google Search Configuration ---
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "YOUR_GOOGLE_API_KEY_FOR_SEARCH_HERE") # Replace if different from GEMINI_API_KEY
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID", "YOUR_GOOGLE_CSE_ID_HERE")
+GOOGLE_SEARCH_API_URL = "https://www.googleapis.com/customsearch/v1" # Custom Search JSON API, called directly over aiohttp
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "900")) # Seconds search results are reused for the same query
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "500")) # Cached queries before LRU eviction
 
-# File for guild conversation histories
+# Guild conversations are kept per context (guild, channel and optionally thread). Each context is
+# stored as its own append-only log and loaded lazily the first time it is used.
+# The old single-file format is migrated into per-guild logs on first startup.
 GUILD_CONVERSATION_HISTORY_FILE = "conversation_histories.json"
+GUILD_HISTORY_DIR = "guild_histories"
+# "guild", "channel" or "thread" (threads get their own context). A channel or thread without a log of its own
+# starts from the guild-wide history, so guilds keep their conversation after upgrading from one history per guild.
+GUILD_HISTORY_SCOPE = os.getenv("GUILD_HISTORY_SCOPE", "channel").lower()
+GUILD_HISTORY_FLUSH_INTERVAL = float(os.getenv("GUILD_HISTORY_FLUSH_INTERVAL", "2.0")) # Seconds between batched log writes
+GUILD_HISTORY_COMPACT_THRESHOLD = 200 # Log records per context before the log is rewritten as a snapshot
+GUILD_HISTORY_CACHE_MAX_CONTEXTS = int(os.getenv("GUILD_HISTORY_CACHE_MAX_CONTEXTS", "2000")) # Guild contexts kept in memory
+GUILD_HISTORY_CACHE_IDLE_TTL = float(os.getenv("GUILD_HISTORY_CACHE_IDLE_TTL", "3600")) # Seconds before an idle context is evicted (0 = never)
+MAX_HISTORY_ENTRIES = 40 # Entries kept per conversation
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "32000")) # Estimated tokens kept per stored conversation
+AI_HISTORY_TOKEN_BUDGET = int(os.getenv("AI_HISTORY_TOKEN_BUDGET", "16000")) # Estimated history tokens sent with each /ai request
+CHARS_PER_TOKEN = 4 # Rough characters-per-token ratio used for estimates
 DM_HISTORY_DIR = "dm_histories"
-if not os.path.exists(DM_HISTORY_DIR):
-    os.makedirs(DM_HISTORY_DIR)
+DM_HISTORY_FLUSH_INTERVAL = float(os.getenv("DM_HISTORY_FLUSH_INTERVAL", "5.0")) # Seconds between write-behind flushes
+DM_HISTORY_FLUSH_THRESHOLD = int(os.getenv("DM_HISTORY_FLUSH_THRESHOLD", "50")) # Dirty histories that trigger an early flush
+DM_HISTORY_CACHE_MAX_USERS = int(os.getenv("DM_HISTORY_CACHE_MAX_USERS", "1000")) # DM histories kept in memory
+DM_HISTORY_CACHE_MAX_BYTES = int(os.getenv("DM_HISTORY_CACHE_MAX_BYTES", "0")) # Approximate text budget for cached DM histories (0 = no limit)
+DM_HISTORY_CACHE_IDLE_TTL = float(os.getenv("DM_HISTORY_CACHE_IDLE_TTL", "3600")) # Seconds before an idle DM history is evicted (0 = never)
+for _history_dir in (DM_HISTORY_DIR, GUILD_HISTORY_DIR):
+    if not os.path.exists(_history_dir):
+        os.makedirs(_history_dir)
+
+# --- Streaming Configuration ---
+AI_STREAM_RESPONSES = os.getenv("AI_STREAM_RESPONSES", "true").lower() == "true" # Stream /ai replies with progressive edits
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.5")) # Minimum seconds between message edits while streaming
+
+# --- Reply Delivery Configuration ---
+REPLY_FILE_THRESHOLD = int(os.getenv("REPLY_FILE_THRESHOLD", "12000")) # Replies longer than this (in characters) are attached as a .md file
+REPLY_FILE_NAME = "reply.md"
+REPLY_MIN_EMBED_CHARS = 200 # Below this much room left in a message, continuation text starts a new message
+
+# --- Persona & Context Cache Configuration ---
+AI_SYSTEM_PERSONA = os.getenv("AI_SYSTEM_PERSONA", "") # System instruction sent with every conversation (empty = none)
+GUILD_PERSONAS_FILE = "guild_personas.json" # Optional {"guild_id": "persona"} overrides of AI_SYSTEM_PERSONA
+# Gemini can keep a stable prompt prefix (the persona plus older turns) server-side as cachedContents.
+# Requests then send only the newer turns, and cached tokens are processed faster and billed at a discount.
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096")) # Estimated prefix size before caching pays off (Gemini's minimum for 2.5 Pro)
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "900")) # Seconds a cache lives; extended while its conversation is active
+CONTEXT_CACHE_MAX_UNCACHED_TOKENS = int(os.getenv("CONTEXT_CACHE_MAX_UNCACHED_TOKENS", "4096")) # Newer turns allowed past the cache before a longer prefix is cached
+CONTEXT_CACHE_RECENT_ENTRIES = 6 # Newest history entries never cached, so the cached prefix changes rarely
+
+# --- Model Routing Configuration ---
+GEMINI_PRO_MODEL = os.getenv("GEMINI_PRO_MODEL", "gemini-2.5-pro-preview-05-06") # Primary text and vision model
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash") # Answers simple prompts and takes over when the primary is degraded (empty = none)
+IMAGEN_MODEL = os.getenv("IMAGEN_MODEL", "imagen-3.0-generate-002")
+IMAGEN_FAST_MODEL = os.getenv("IMAGEN_FAST_MODEL", "imagen-3.0-fast-generate-001") # Image generation failover (empty = none)
+MODEL_ROUTING_ENABLED = os.getenv("MODEL_ROUTING_ENABLED", "true").lower() == "true" # Send short, simple prompts to the fast model
+MODEL_ROUTING_FAST_MAX_CHARS = int(os.getenv("MODEL_ROUTING_FAST_MAX_CHARS", "160")) # Longest prompt still treated as simple
+MODEL_FAILOVER_ENABLED = os.getenv("MODEL_FAILOVER_ENABLED", "true").lower() == "true"
+MODEL_FAILOVER_P95_SECONDS = float(os.getenv("MODEL_FAILOVER_P95_SECONDS", "30")) # Primary p95 latency above which requests fail over
+MODEL_FAILOVER_ERROR_RATE = float(os.getenv("MODEL_FAILOVER_ERROR_RATE", "0.3")) # Primary error rate above which requests fail over
+MODEL_FAILOVER_COOLDOWN = float(os.getenv("MODEL_FAILOVER_COOLDOWN", "60")) # Seconds a degraded model is skipped before it is tried again
+MODEL_FAILOVER_PRIMARY_RETRIES = 1 # Retries on a model that has a fallback, before failing over instead
+MODEL_HEALTH_WINDOW = 50 # Recent calls per model used for its p95 latency and error rate
+MODEL_HEALTH_MIN_SAMPLES = 10 # Calls needed before latency or errors can mark a model degraded
 
 # --- Permission Configuration ---
 # These IDs are no longer strictly enforced by can_use_command if it always returns True,
@@ -37,35 +111,1137 @@ SPECIAL_USER_ID = 0 # Example: 123456789012345678
 TARGET_GUILD_ID = 0 # Example: 987654321098765432
 TARGET_CHANNEL_ID = 0 # Example: 112233445566778899
 
+# --- HTTP Client Configuration ---
+# One pooled aiohttp session is shared by every Gemini, Imagen and Search call so
+# keep-alive connections are reused instead of doing a TCP+TLS handshake per request.
+HTTP_CONNECTION_LIMIT = int(os.getenv("HTTP_CONNECTION_LIMIT", "100")) # Total open connections across all hosts
+HTTP_CONNECTION_LIMIT_PER_HOST = int(os.getenv("HTTP_CONNECTION_LIMIT_PER_HOST", "20")) # Open connections per host
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300")) # Seconds to cache DNS lookups
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60")) # Seconds an idle connection is kept open
+
+# --- Upstream Scheduling Configuration ---
+# Caps on concurrent Gemini/Imagen calls. Extra requests wait in a per-guild fair queue,
+# with COOLDOWN_BYPASS_USER_IDS served from a priority lane first.
+TEXT_MAX_CONCURRENCY = int(os.getenv("TEXT_MAX_CONCURRENCY", "8")) # Concurrent Gemini text calls
+VISION_MAX_CONCURRENCY = int(os.getenv("VISION_MAX_CONCURRENCY", "4")) # Concurrent Gemini vision calls
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", "2")) # Concurrent Imagen calls
+QUEUE_FEEDBACK_INTERVAL = 5.0 # Seconds between queue position updates shown to a waiting user
+
+# --- Upstream Resilience Configuration ---
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2")) # Retries after the first attempt for retryable failures
+UPSTREAM_BACKOFF_FACTOR = 1.0 # Base seconds for exponential backoff when no Retry-After is given
+UPSTREAM_MAX_RETRY_DELAY = 30.0 # Longest wait before a retry; longer Retry-After values fail immediately
+UPSTREAM_RETRY_BUDGET_RATIO = 0.2 # Retries earned per request, so retries stay a bounded fraction of traffic
+UPSTREAM_RETRY_BUDGET_MAX = 10.0 # Cap on banked retries per endpoint
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")) # Consecutive failures that open the circuit
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30")) # Seconds the circuit stays open before a probe
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# --- Rate Limit Configuration ---
+# Token buckets sized from the upstream quota, so bursts are smoothed out before Google answers with 429.
+# Each pool has a global bucket plus per-guild and per-user buckets holding a share of it.
+# Buckets live in the state backend, so they hold across restarts and bot processes.
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60")) # Gemini quota for this project (text and vision)
+IMAGEN_IMAGES_PER_MINUTE = float(os.getenv("IMAGEN_IMAGES_PER_MINUTE", "10")) # Imagen quota for this project, counted per image
+RATE_LIMIT_GUILD_SHARE = float(os.getenv("RATE_LIMIT_GUILD_SHARE", "0.5")) # Fraction of a pool one guild may use
+RATE_LIMIT_USER_SHARE = float(os.getenv("RATE_LIMIT_USER_SHARE", "0.1")) # Fraction of a pool one user may use
+RATE_LIMIT_COSTS = {
+    "text": 1, # One /ai request
+    "search": 1, # Extra cost when a web search is added to the prompt
+    "vision": 2, # One /aiupload request
+    "vision_per_mb": 1, # Extra cost per started MB of uploaded image
+    "image": 1 # Each generated image variant
+}
+RATE_LIMIT_STATE_FILE = "rate_limits.json" # Bucket levels saved by the file state backend across restarts
+
+# --- Response Cache Configuration ---
+# Caches answers to search-augmented /ai prompts and /aiupload requests so repeated questions skip the API.
+# Plain /ai chats are never cached because their answers depend on the conversation history; search-augmented
+# answers see that history too, so they are only reused within the conversation that produced them.
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600")) # Seconds a cached response stays valid
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "500")) # In-memory entries before LRU eviction
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "") # Set to a directory to also keep cached responses on disk
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "5000")) # On-disk entries kept after pruning
+RESPONSE_CACHE_DISABLED_COMMANDS = {name.strip() for name in os.getenv("RESPONSE_CACHE_DISABLED_COMMANDS", "").split(",") if name.strip()} # e.g. "ai,aiupload"
+
+# --- Request Coalescing Configuration ---
+# Identical concurrent requests of these call types share one upstream call and its result:
+# "search" (web searches), "ai_search" (search-augmented /ai answers) and "image" (/generateimage jobs).
+COALESCE_CALL_TYPES = {name.strip() for name in os.getenv("COALESCE_CALL_TYPES", "search,ai_search,image").split(",") if name.strip()}
+
+# --- Image Preprocessing Configuration ---
+# /aiupload images are downscaled and re-encoded in a worker pool before being sent to Gemini Vision.
+MAX_UPLOAD_IMAGE_BYTES = int(os.getenv("MAX_UPLOAD_IMAGE_BYTES", str(20 * 1024 * 1024))) # Larger attachments are rejected before download
+VISION_MAX_IMAGE_DIMENSION = int(os.getenv("VISION_MAX_IMAGE_DIMENSION", "1536")) # Longest side sent to Gemini, in pixels
+VISION_JPEG_QUALITY = 85 # Quality used when re-encoding opaque images as JPEG
+IMAGE_WORKER_COUNT = int(os.getenv("IMAGE_WORKER_COUNT", "2")) # Threads used for image preprocessing
+
+# --- Image Generation Queue Configuration ---
+# /generateimage requests run as jobs on a fixed pool of workers; identical pending prompts share one job.
+IMAGE_JOB_WORKERS = int(os.getenv("IMAGE_JOB_WORKERS", str(IMAGE_MAX_CONCURRENCY))) # Jobs generated at once
+IMAGE_JOB_QUEUE_MAX = int(os.getenv("IMAGE_JOB_QUEUE_MAX", "50")) # Queued jobs before new requests are turned away
+IMAGE_MAX_VARIANTS = 4 # Most images Imagen returns for one request (sampleCount)
+IMAGE_JOB_MAX_ATTEMPTS = 3 # Times a job is tried before a transient failure is reported to the user
+IMAGE_JOB_RETRY_DELAY = 15.0 # Base seconds before a failed job is re-queued; grows with each attempt
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "") # Set to a directory to reuse generated images for repeated prompts
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "86400")) # Seconds a cached image is reused
+IMAGE_CACHE_MAX_FILES = int(os.getenv("IMAGE_CACHE_MAX_FILES", "1000")) # Cached images kept after pruning
+
+# --- Sharding & State Backend Configuration ---
+# Leave SHARD_COUNT empty to run unsharded. "auto" runs every shard Discord recommends in this process.
+# A number together with SHARD_IDS runs only those shards, so N processes can split a large bot.
+# Interactions are routed by guild (DMs go to shard 0), so each conversation is owned by one process.
+SHARD_COUNT = os.getenv("SHARD_COUNT", "")
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()]
+# Where histories are persisted: "file" (local JSON/JSONL files), "sqlite:///path/to/state.db" (processes on one host)
+# or "redis://host:6379/0" (processes across hosts; needs the redis package). Shared backends also share the response and search caches.
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "file")
+STATE_KEY_PREFIX = os.getenv("STATE_KEY_PREFIX", "discord-ai-bot") # Namespace for keys in a shared Redis
+
+# --- Startup Configuration ---
+COMMAND_SYNC_HASH_FILE = "command_tree_hash.txt" # Hash of the slash command definitions last synced to Discord
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "false").lower() == "true" # Sync even if the definitions are unchanged
+
+# --- Observability Configuration ---
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower() # "json" for one JSON object per line, "text" for discord.py's console format
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper() # DEBUG also logs every timed stage
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") # Keep the metrics endpoint local unless a remote scraper needs it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464")) # Serves /metrics (Prometheus text) and /stats (JSON); 0 disables it
+METRICS_PERCENTILE_WINDOW = 2048 # Recent samples per series used for the p50/p95/p99 in /stats
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # Histogram bucket bounds in seconds
+
+# --- Event Loop Watchdog Configuration ---
+LOOP_LAG_CHECK_INTERVAL = float(os.getenv("LOOP_LAG_CHECK_INTERVAL", "0.1")) # Seconds between event loop lag measurements
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.25")) # Lag in seconds that counts as a blocked loop and captures a stack sample
+LOOP_BLOCK_SAMPLES_KEPT = 20 # Most recent stack samples kept for /debugloop
+LOOP_BLOCK_STACK_DEPTH = 8 # Innermost frames kept per stack sample
+BLOCKING_OFFLOAD_MIN_BYTES = int(os.getenv("BLOCKING_OFFLOAD_MIN_BYTES", str(256 * 1024))) # JSON and base64 work on inputs this large runs in the blocking worker pool
+BLOCKING_WORKER_COUNT = int(os.getenv("BLOCKING_WORKER_COUNT", "4")) # Threads for offloaded JSON and base64 work, kept apart from image preprocessing
+
 # --- Bot Setup ---
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=None if SHARD_COUNT == "auto" else int(SHARD_COUNT),
+        shard_ids=SHARD_IDS or None
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+bot_start_time = time.monotonic()
+
+# --- Observability ---
+log = logging.getLogger("discord_ai_bot")
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats records as one JSON object per line. Pass extra={"fields": {...}} to add keys."""
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_bot_logging():
+    """Sends the bot's and discord.py's logs through one handler, as JSON lines unless LOG_FORMAT is "text"."""
+    discord.utils.setup_logging(
+        handler=logging.StreamHandler(),
+        formatter=JsonLogFormatter() if LOG_FORMAT == "json" else None,
+        level=getattr(logging, LOG_LEVEL, logging.INFO)
+    )
 
-# --- Conversation History Management ---
-guild_conversation_histories = {}
-dm_conversation_histories = {}
+def _redact_url(url):
+    """Drops the API key query parameter so upstream URLs can be logged."""
+    return str(url.with_query({name: value for name, value in url.query.items() if name != "key"}))
+
+_METRIC_NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_]")
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(label_key):
+    if not label_key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in label_key) + "}"
+
+class Counter:
+    """A monotonically increasing count per label set."""
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {} # sorted label tuple -> count
+
+    def inc(self, amount=1, **labels):
+        label_key = tuple(sorted(labels.items()))
+        self._values[label_key] = self._values.get(label_key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(label_key)} {value}" for label_key, value in self._values.items())
+        return lines
+
+    def snapshot(self) -> dict:
+        return {_format_labels(label_key) or "total": value for label_key, value in self._values.items()}
+
+class Histogram:
+    """Cumulative buckets for Prometheus, plus a window of recent samples for percentile summaries."""
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, window=METRICS_PERCENTILE_WINDOW):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.window = window
+        self._series = {} # sorted label tuple -> [bucket counts, sum, count, recent samples]
+
+    def observe(self, value, **labels):
+        label_key = tuple(sorted(labels.items()))
+        series = self._series.get(label_key)
+        if series is None:
+            series = self._series[label_key] = [[0] * len(self.buckets), 0.0, 0, deque(maxlen=self.window)]
+        bucket_counts = series[0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket_counts[index] += 1
+        series[1] += value
+        series[2] += 1
+        series[3].append(value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_key, (bucket_counts, total, count, _) in self._series.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_format_labels(label_key + (('le', f'{bound:g}'),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(label_key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(label_key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(label_key)} {count}")
+        return lines
+
+    def snapshot(self) -> dict:
+        summaries = {}
+        for label_key, (_, total, count, recent) in self._series.items():
+            samples = sorted(recent)
+            summary = {"count": count, "sum": total}
+            for name, quantile in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                summary[name] = samples[min(len(samples) - 1, int(quantile * len(samples)))]
+            summaries[_format_labels(label_key) or "total"] = summary
+        return summaries
+
+def _flatten_stats(name, value, labels):
+    """
+    Yields (metric name, labels, number) for the numeric leaves of a stats dict. A dict whose values
+    are all dicts (e.g. one entry per endpoint) becomes one metric family with a "name" label.
+    """
+    if isinstance(value, bool):
+        yield name, labels, int(value)
+    elif isinstance(value, (int, float)):
+        yield name, labels, value
+    elif isinstance(value, dict):
+        if value and all(isinstance(child, dict) for child in value.values()):
+            for key, child in value.items():
+                yield from _flatten_stats(name, child, {**labels, "name": key})
+        else:
+            for key, child in value.items():
+                yield from _flatten_stats(f"{name}_{_METRIC_NAME_PATTERN.sub('_', str(key))}", child, labels)
+
+class MetricsRegistry:
+    """Holds the bot's counters and histograms and exposes them together with every get_*_stats() source."""
+    def __init__(self):
+        self._metrics = {}
+        self._stats_sources = {}
+
+    def counter(self, name, help_text) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def histogram(self, name, help_text, **kwargs) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, **kwargs))
+
+    def add_stats_source(self, section, stats_function):
+        self._stats_sources[section] = stats_function
 
-def load_guild_conversation_histories():
-    """Loads guild conversation histories from the JSON file."""
-    global guild_conversation_histories
+    def _collect_stats(self):
+        collected = {}
+        for section, stats_function in self._stats_sources.items():
+            try:
+                collected[section] = stats_function()
+            except Exception as e:
+                log.warning(f"Error collecting {section} stats: {e}")
+        return collected
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for section, stats in self._collect_stats().items():
+            for name, labels, value in _flatten_stats(f"bot_{section}", stats, {}):
+                lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        return {
+            "uptime_seconds": time.monotonic() - bot_start_time,
+            "metrics": {name: metric.snapshot() for name, metric in self._metrics.items()},
+            "stats": self._collect_stats()
+        }
+
+metrics = MetricsRegistry()
+stage_latency = metrics.histogram("bot_stage_seconds", "Time spent in each request stage, by stage and outcome.")
+command_latency = metrics.histogram("bot_command_seconds", "Time from a slash command being invoked to its handler returning.")
+command_count = metrics.counter("bot_commands_total", "Slash commands handled, by command and outcome.")
+error_count = metrics.counter("bot_errors_total", "Errors by component and reason.")
+block_count = metrics.counter("bot_blocked_total", "Prompts blocked by upstream safety filters, by kind.")
+upstream_attempt_count = metrics.counter("bot_upstream_attempts_total", "Upstream HTTP attempts, by endpoint and status.")
+gemini_token_count = metrics.counter("bot_gemini_tokens_total", "Tokens reported in Gemini usageMetadata, by call kind and token type.")
+
+@contextlib.contextmanager
+def span(stage):
+    """Times one request stage into bot_stage_seconds; the duration is also logged at DEBUG level."""
+    start_time = time.perf_counter()
+    outcome = "ok"
     try:
-        if os.path.exists(GUILD_CONVERSATION_HISTORY_FILE):
-            with open(GUILD_CONVERSATION_HISTORY_FILE, 'r') as f:
-                guild_conversation_histories = json.load(f)
-                # Ensure keys are integers after loading
-                guild_conversation_histories = {int(k): v for k, v in guild_conversation_histories.items()}
+        yield
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start_time
+        stage_latency.observe(elapsed, stage=stage, outcome=outcome)
+        log.debug(f"{stage} took {elapsed * 1000:.1f}ms", extra={"fields": {"stage": stage, "seconds": elapsed, "outcome": outcome}})
+
+GEMINI_USAGE_FIELDS = {
+    "promptTokenCount": "prompt",
+    "cachedContentTokenCount": "cached",
+    "candidatesTokenCount": "candidates",
+    "thoughtsTokenCount": "thoughts",
+    "totalTokenCount": "total"
+}
+
+def record_token_usage(kind, data):
+    """Adds the token counts from a Gemini response's usageMetadata to bot_gemini_tokens_total."""
+    usage = data.get("usageMetadata") or {}
+    for field, token_type in GEMINI_USAGE_FIELDS.items():
+        if usage.get(field):
+            gemini_token_count.inc(usage[field], kind=kind, type=token_type)
+
+metrics_runner = None
+
+async def _handle_metrics(request):
+    return web.Response(body=metrics.render_prometheus().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def _handle_stats(request):
+    return web.json_response(metrics.snapshot(), dumps=lambda data: json.dumps(data, default=str))
+
+async def start_metrics_server():
+    """Serves /metrics and /stats on METRICS_HOST:METRICS_PORT. A failure to bind is logged, not fatal."""
+    global metrics_runner
+    if not METRICS_PORT or metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    app.router.add_get("/stats", _handle_stats)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        await runner.cleanup()
+        log.error(f"Could not start the metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return
+    metrics_runner = runner
+    log.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# --- Event Loop Watchdog ---
+loop_lag = metrics.histogram("bot_event_loop_lag_seconds", "How late the watchdog's timer fired, i.e. how long the event loop was busy.")
+loop_block_count = metrics.counter("bot_event_loop_blocks_total", "Times the event loop was blocked for longer than LOOP_BLOCK_THRESHOLD.")
+_ASYNCIO_DIRECTORY = os.path.dirname(asyncio.__file__) # Event loop frames are left out of stack samples
+offloaded_call_count = metrics.counter("bot_offloaded_calls_total", "Heavy calls moved off the event loop into the worker pool, by function.")
+
+class EventLoopWatchdog:
+    """
+    Measures event loop lag with a timer task. A helper thread watches the timer, and when the loop
+    has not come back within LOOP_BLOCK_THRESHOLD it captures the loop thread's stack, which shows
+    the code that is blocking it.
+    """
+
+    def __init__(self, interval=LOOP_LAG_CHECK_INTERVAL, threshold=LOOP_BLOCK_THRESHOLD, samples_kept=LOOP_BLOCK_SAMPLES_KEPT):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=samples_kept)
+        self.blocks = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._last_tick = time.monotonic()
+        self._sampled_tick = None
+        self._open_sample = None
+        self._loop = None
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self._tick_loop())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+    async def _tick_loop(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._last_tick = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            loop_lag.observe(lag)
+            if lag >= self.threshold:
+                self.blocks += 1
+                loop_block_count.inc()
+                if self._open_sample is not None:
+                    # The sample was taken mid-block; record how long the block lasted in the end.
+                    self._open_sample["blocked_seconds"] = lag
+            self._open_sample = None
+
+    def _watch(self):
+        """Runs in the helper thread; samples the loop thread's stack once per block."""
+        while not self._stop_event.wait(min(self.interval, self.threshold / 2)):
+            last_tick = self._last_tick
+            blocked_for = time.monotonic() - last_tick - self.interval
+            if blocked_for < self.threshold or self._sampled_tick == last_tick:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            self._sampled_tick = last_tick
+            stack = [entry for entry in traceback.extract_stack(frame) if not entry.filename.startswith(_ASYNCIO_DIRECTORY)]
+            try:
+                task = asyncio.current_task(self._loop)
+            except RuntimeError:
+                task = None
+            sample = {
+                "at": time.time(),
+                "blocked_seconds": blocked_for,
+                "task": task.get_name() if task is not None else None,
+                "stack": traceback.format_list(stack[-LOOP_BLOCK_STACK_DEPTH:])
+            }
+            self.samples.append(sample)
+            self._open_sample = sample
+            log.warning(
+                f"Event loop blocked for over {blocked_for * 1000:.0f}ms in task {sample['task']}",
+                extra={"fields": {"task": sample["task"], "blocked_seconds": blocked_for, "stack": "".join(sample["stack"])}}
+            )
+
+    def stats(self) -> dict:
+        return {"blocks": self.blocks, "last_lag_seconds": self.last_lag, "max_lag_seconds": self.max_lag, "samples_kept": len(self.samples)}
+
+loop_watchdog = EventLoopWatchdog()
+
+def get_event_loop_stats() -> dict:
+    return loop_watchdog.stats()
+
+# Separate from image_worker_pool, so payload encoding never queues behind slow image preprocessing.
+blocking_worker_pool = ThreadPoolExecutor(max_workers=BLOCKING_WORKER_COUNT, thread_name_prefix="blocking-worker")
+
+async def run_blocking(function, *args, size=None):
+    """
+    Runs CPU-heavy work such as JSON encoding of large payloads or base64 decoding of images in the
+    blocking worker pool once its input reaches BLOCKING_OFFLOAD_MIN_BYTES. Smaller inputs run inline,
+    where the thread hop would cost more than the work itself.
+    """
+    if size is not None and size < BLOCKING_OFFLOAD_MIN_BYTES:
+        return function(*args)
+    offloaded_call_count.inc(function=function.__name__)
+    return await asyncio.get_running_loop().run_in_executor(blocking_worker_pool, function, *args)
+
+# --- Shared HTTP Session ---
+http_session = None
+http_requests_in_flight = 0
+
+async def _on_http_request_start(session, trace_config_ctx, params):
+    global http_requests_in_flight
+    http_requests_in_flight += 1
+
+async def _on_http_request_done(session, trace_config_ctx, params):
+    global http_requests_in_flight
+    http_requests_in_flight = max(0, http_requests_in_flight - 1)
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Returns the bot-wide pooled HTTP session, creating it if needed."""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_CONNECTION_LIMIT,
+            limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(_on_http_request_start)
+        trace_config.on_request_end.append(_on_http_request_done)
+        trace_config.on_request_exception.append(_on_http_request_done)
+        http_session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+    return http_session
+
+async def close_http_session():
+    """Closes the shared HTTP session and its connection pool."""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def get_http_pool_stats() -> dict:
+    """Returns open, idle and in-flight connection counts for monitoring."""
+    if http_session is None or http_session.closed or http_session.connector is None:
+        return {"open": 0, "idle": 0, "in_use": 0, "in_flight": http_requests_in_flight}
+    connector = http_session.connector
+    # aiohttp does not expose pool sizes publicly, so read them defensively.
+    idle = sum(len(conns) for conns in getattr(connector, "_conns", {}).values())
+    in_use = len(getattr(connector, "_acquired", ()))
+    return {
+        "open": idle + in_use,
+        "idle": idle,
+        "in_use": in_use,
+        "in_flight": http_requests_in_flight,
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host
+    }
+
+# --- Shared State Backend ---
+def _replay_history_records(records):
+    """Applies append/reset records in order, returning the resulting history and the number of records."""
+    history = []
+    record_count = 0
+    for record in records:
+        record_count += 1
+        if record.get("op") == "reset":
+            history = []
+        elif record.get("op") == "append":
+            history.append(record["entry"])
+    return trim_history_to_budget(history, HISTORY_TOKEN_BUDGET), record_count
+
+def _take_from_buckets(states, buckets, cost, now):
+    """
+    Token-bucket step shared by the local and SQLite backends. states maps bucket name to (tokens, updated_at);
+    buckets are (name, capacity, refill_per_second). Takes cost from every bucket or from none.
+    Returns (retry_after_seconds, new_states); retry_after is 0.0 when the tokens were taken.
+    """
+    levels = {}
+    retry_after = 0.0
+    for name, capacity, refill_per_second in buckets:
+        tokens, updated_at = states.get(name, (capacity, now))
+        tokens = min(capacity, tokens + max(0.0, now - updated_at) * refill_per_second)
+        levels[name] = tokens
+        needed = min(cost, capacity) # A cost above capacity would never fit, so it needs a full bucket instead
+        if tokens < needed:
+            retry_after = max(retry_after, (needed - tokens) / refill_per_second)
+    new_states = {}
+    for name, capacity, _ in buckets:
+        tokens = levels[name] if retry_after else levels[name] - min(cost, capacity)
+        new_states[name] = (tokens, now)
+    return retry_after, new_states
+
+def _state_key(key):
+    """Context keys are tuples such as (guild_id, channel_id) and DM keys are user ids; both become "a/b" strings."""
+    return "/".join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+class StateBackend:
+    """
+    Persists conversation histories as append/reset records per kind ("guild" or "dm") and key, plus
+    shared cache values. Methods block, so callers run them with asyncio.to_thread.
+    shared is True when several bot processes can use the same backend.
+    """
+    shared = False
+
+    def load_history(self, kind, key):
+        """Returns (history, record_count) for one conversation."""
+        raise NotImplementedError
+
+    def append_history_records(self, kind, key, records):
+        raise NotImplementedError
+
+    def replace_history(self, kind, key, history):
+        """Atomically replaces every stored record of a conversation with a snapshot of its history."""
+        raise NotImplementedError
+
+    def get_value(self, namespace, key):
+        return None
+
+    def set_value(self, namespace, key, value, ttl):
+        pass
+
+    def take_tokens(self, buckets, cost):
+        """Atomically takes cost tokens from every bucket or from none; see _take_from_buckets."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class FileStateBackend(StateBackend):
+    """
+    The local layout: one JSONL log per guild context under GUILD_HISTORY_DIR and one JSON file per DM user.
+    Rate limit buckets are kept in memory and saved to RATE_LIMIT_STATE_FILE on shutdown.
+    """
+
+    def __init__(self):
+        self._bucket_lock = threading.Lock()
+        self._buckets = {}
+        try:
+            with open(RATE_LIMIT_STATE_FILE, 'r') as f:
+                self._buckets = {name: tuple(state) for name, state in json.load(f).items()}
+        except (OSError, ValueError):
+            pass
+
+    def take_tokens(self, buckets, cost):
+        with self._bucket_lock:
+            retry_after, new_states = _take_from_buckets(self._buckets, buckets, cost, time.time())
+            self._buckets.update(new_states)
+        return retry_after
+
+    def close(self):
+        with self._bucket_lock:
+            now = time.time()
+            # Buckets idle for an hour have refilled, so there is nothing worth saving about them.
+            buckets = {name: state for name, state in self._buckets.items() if now - state[1] < 3600}
+        try:
+            with open(RATE_LIMIT_STATE_FILE, 'w') as f:
+                json.dump(buckets, f)
+        except OSError as e:
+            log.error(f"Error saving rate limit state: {e}")
+
+    def load_history(self, kind, key):
+        if kind == "dm":
+            history = load_dm_conversation_history(key)
+            return history, len(history)
+        filepath = _guild_history_log_path(key)
+        if not os.path.exists(filepath):
+            return [], 0
+        return _replay_guild_history_log(filepath)
+
+    def append_history_records(self, kind, key, records):
+        if kind == "dm":
+            stored_records = [{"op": "append", "entry": entry} for entry in load_dm_conversation_history(key)]
+            save_dm_conversation_history(key, _replay_history_records(stored_records + records)[0])
+            return
+        filepath = _guild_history_log_path(key)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, 'a') as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+
+    def replace_history(self, kind, key, history):
+        if kind == "dm":
+            save_dm_conversation_history(key, history)
         else:
-            guild_conversation_histories = {}
+            _write_guild_history_snapshot(key, history)
+
+class SQLiteStateBackend(StateBackend):
+    """
+    SQLite database shared by bot processes on one host. Records are inserted in transactions,
+    so concurrent writers append rather than overwrite each other.
+    """
+    shared = True
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._value_writes = 0
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS history_records (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, key TEXT NOT NULL, record TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS history_records_by_key ON history_records (kind, key, seq)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache_values (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL, PRIMARY KEY (namespace, key))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    def load_history(self, kind, key):
+        with self._lock:
+            rows = self._db.execute("SELECT record FROM history_records WHERE kind = ? AND key = ? ORDER BY seq", (kind, _state_key(key))).fetchall()
+        return _replay_history_records(json.loads(row[0]) for row in rows)
+
+    def append_history_records(self, kind, key, records):
+        state_key = _state_key(key)
+        with self._lock, self._db:
+            self._db.executemany("INSERT INTO history_records (kind, key, record) VALUES (?, ?, ?)", [(kind, state_key, json.dumps(record)) for record in records])
+
+    def replace_history(self, kind, key, history):
+        state_key = _state_key(key)
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM history_records WHERE kind = ? AND key = ?", (kind, state_key))
+            self._db.executemany("INSERT INTO history_records (kind, key, record) VALUES (?, ?, ?)", [(kind, state_key, json.dumps({"op": "append", "entry": entry})) for entry in history])
+
+    def get_value(self, namespace, key):
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM cache_values WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def set_value(self, namespace, key, value, ttl):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO cache_values (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)", (namespace, key, json.dumps(value), time.time() + ttl))
+            self._value_writes += 1
+            if self._value_writes % 100 == 0:
+                self._db.execute("DELETE FROM cache_values WHERE expires_at < ?", (time.time(),))
+
+    def take_tokens(self, buckets, cost):
+        names = [name for name, _, _ in buckets]
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock before reading, so other processes cannot interleave.
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(f"SELECT name, tokens, updated_at FROM rate_limit_buckets WHERE name IN ({', '.join('?' * len(names))})", names).fetchall()
+                retry_after, new_states = _take_from_buckets({row[0]: (row[1], row[2]) for row in rows}, buckets, cost, time.time())
+                self._db.executemany("INSERT OR REPLACE INTO rate_limit_buckets (name, tokens, updated_at) VALUES (?, ?, ?)", [(name, tokens, updated_at) for name, (tokens, updated_at) in new_states.items()])
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+        return retry_after
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class RedisStateBackend(StateBackend):
+    """
+    Redis (or any Redis-protocol server) shared by bot processes across hosts. Records are appended
+    with RPUSH, so concurrent writers never lose updates. Requires the optional 'redis' package;
+    tests can pass a compatible client such as fakeredis.FakeRedis() instead.
+    """
+    shared = True
+    # Same algorithm as _take_from_buckets, run atomically inside Redis using the server clock.
+    # KEYS are bucket names; ARGV is cost followed by (capacity, refill_per_second) for each key.
+    TAKE_TOKENS_SCRIPT = """
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local cost = tonumber(ARGV[1])
+    local retry_after = 0
+    local levels = {}
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 2])
+        local refill_per_second = tonumber(ARGV[i * 2 + 1])
+        local state = redis.call('HMGET', key, 'tokens', 'updated_at')
+        local tokens = tonumber(state[1]) or capacity
+        local updated_at = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * refill_per_second)
+        levels[i] = tokens
+        local needed = math.min(cost, capacity)
+        if tokens < needed then
+            retry_after = math.max(retry_after, (needed - tokens) / refill_per_second)
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[i * 2])
+        local refill_per_second = tonumber(ARGV[i * 2 + 1])
+        local tokens = levels[i]
+        if retry_after == 0 then
+            tokens = tokens - math.min(cost, capacity)
+        end
+        redis.call('HSET', key, 'tokens', tokens, 'updated_at', now)
+        redis.call('EXPIRE', key, math.ceil(capacity / refill_per_second) + 60)
+    end
+    return tostring(retry_after)
+    """
+
+    def __init__(self, url=None, prefix=STATE_KEY_PREFIX, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("STATE_BACKEND_URL points at Redis, but the 'redis' package is not installed (pip install redis).") from e
+            client = redis.Redis.from_url(url)
+        self._redis = client
+        self.prefix = prefix
+        self._take_tokens_script = client.register_script(self.TAKE_TOKENS_SCRIPT)
+
+    def _history_key(self, kind, key):
+        return f"{self.prefix}:history:{kind}:{_state_key(key)}"
+
+    def load_history(self, kind, key):
+        return _replay_history_records(json.loads(raw) for raw in self._redis.lrange(self._history_key(kind, key), 0, -1))
+
+    def append_history_records(self, kind, key, records):
+        if records:
+            self._redis.rpush(self._history_key(kind, key), *(json.dumps(record) for record in records))
+
+    def replace_history(self, kind, key, history):
+        history_key = self._history_key(kind, key)
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.delete(history_key)
+        if history:
+            pipeline.rpush(history_key, *(json.dumps({"op": "append", "entry": entry}) for entry in history))
+        pipeline.execute()
+
+    def get_value(self, namespace, key):
+        raw = self._redis.get(f"{self.prefix}:{namespace}:{key}")
+        return json.loads(raw) if raw is not None else None
+
+    def set_value(self, namespace, key, value, ttl):
+        self._redis.set(f"{self.prefix}:{namespace}:{key}", json.dumps(value), ex=max(1, int(ttl)))
+
+    def take_tokens(self, buckets, cost):
+        keys = [f"{self.prefix}:ratelimit:{name}" for name, _, _ in buckets]
+        args = [cost]
+        for _, capacity, refill_per_second in buckets:
+            args.extend((capacity, refill_per_second))
+        return float(self._take_tokens_script(keys=keys, args=args))
+
+    def close(self):
+        self._redis.close()
+
+def create_state_backend(url):
+    if url == "file":
+        return FileStateBackend()
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+
+state_backend = create_state_backend(STATE_BACKEND_URL)
+shared_state_backend = state_backend if state_backend.shared else None # Used for cache values shared between processes
+
+# --- Conversation History Management ---
+def _estimate_history_size(history):
+    """Approximates a history's memory footprint by the length of its text parts."""
+    return sum(len(part.get("text", "")) for entry in history for part in entry.get("parts", []))
+
+def estimate_entry_tokens(entry):
+    """Estimates the tokens a history entry costs, including a small per-message overhead."""
+    return sum(len(part.get("text", "")) for part in entry.get("parts", [])) // CHARS_PER_TOKEN + 4
+
+def trim_history_to_budget(history, token_budget, max_entries=MAX_HISTORY_ENTRIES):
+    """Returns the newest entries that fit the token budget. The latest entry is always kept."""
+    total_tokens = 0
+    start = len(history)
+    while start > 0 and len(history) - start < max_entries:
+        entry_tokens = estimate_entry_tokens(history[start - 1])
+        if start < len(history) and total_tokens + entry_tokens > token_budget:
+            break
+        total_tokens += entry_tokens
+        start -= 1
+    return history[start:]
+
+history_token_counts = {} # ("dm", user_id) or ("guild", context_key) -> running estimated token count of the stored history
+
+def _append_within_budget(key, history, entry):
+    """
+    Appends an entry and drops the oldest entries beyond the entry cap or token budget.
+    The running token count is updated incrementally, so the history is only scanned once per key.
+    Returns the (possibly new) trimmed history list.
+    """
+    if key not in history_token_counts:
+        history_token_counts[key] = sum(estimate_entry_tokens(e) for e in history)
+    total_tokens = history_token_counts[key] + estimate_entry_tokens(entry)
+    history.append(entry)
+    drop = 0
+    while len(history) - drop > 1 and (len(history) - drop > MAX_HISTORY_ENTRIES or total_tokens > HISTORY_TOKEN_BUDGET):
+        total_tokens -= estimate_entry_tokens(history[drop])
+        drop += 1
+    history_token_counts[key] = total_tokens
+    return history[drop:] if drop else history
+
+class HistoryCache:
+    """LRU cache of conversation histories bounded by entry count, approximate size and idle time."""
+
+    def __init__(self, max_entries, max_bytes=0, idle_ttl=0, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self._entries = OrderedDict() # key -> [history, last_access, size]
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns a cached history and marks it recently used, or None on a miss."""
+        self.evict_idle()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry[1] = time.monotonic()
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def peek(self, key):
+        """Returns a cached history without touching its recency or the counters."""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, history):
+        """Stores a history as most recently used, then evicts down to the configured bounds."""
+        size = _estimate_history_size(history)
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._total_bytes -= old_entry[2]
+        self._entries[key] = [history, time.monotonic(), size]
+        self._total_bytes += size
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            self._evict(next(iter(self._entries)))
+        self.evict_idle()
+
+    def evict_idle(self):
+        """Evicts histories that have not been accessed within the idle TTL."""
+        if not self.idle_ttl:
+            return
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry[1] > cutoff:
+                break
+            self._evict(key)
+
+    def _evict(self, key):
+        history, _, size = self._entries.pop(key)
+        self._total_bytes -= size
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, history)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+def _on_dm_history_evicted(user_id, history):
+    # Keep histories that have not been written yet so flushes can persist them and reloads find them.
+    if user_id in dirty_dm_history_user_ids or user_id in flushing_dm_history_user_ids:
+        evicted_dm_histories[user_id] = history
+    history_token_counts.pop(("dm", user_id), None)
+
+def _on_guild_history_evicted(context_key, history):
+    # Contexts with records still waiting to be written stay reachable for compaction and reloads.
+    if context_key in pending_guild_history_records or context_key in flushing_guild_history_keys:
+        evicted_guild_histories[context_key] = history
+    else:
+        guild_history_log_sizes.pop(context_key, None)
+    history_token_counts.pop(("guild", context_key), None)
+
+guild_conversation_histories = HistoryCache(
+    GUILD_HISTORY_CACHE_MAX_CONTEXTS,
+    idle_ttl=GUILD_HISTORY_CACHE_IDLE_TTL,
+    on_evict=_on_guild_history_evicted
+)
+evicted_guild_histories = {} # context_key -> evicted history whose log records are not written yet
+dm_conversation_histories = HistoryCache(
+    DM_HISTORY_CACHE_MAX_USERS,
+    max_bytes=DM_HISTORY_CACHE_MAX_BYTES,
+    idle_ttl=DM_HISTORY_CACHE_IDLE_TTL,
+    on_evict=_on_dm_history_evicted
+)
+evicted_dm_histories = {} # user_id -> evicted history still waiting to be flushed
+flushing_dm_history_user_ids = set() # users whose histories are being written right now
+
+pending_guild_history_records = {} # context_key -> log records not yet written to disk
+flushing_guild_history_keys = set() # context keys whose records are being written right now
+guild_history_log_sizes = {} # context_key -> number of records currently in the context's log file
+guild_history_flush_lock = asyncio.Lock()
+guild_history_flush_task = None
+
+def get_conversation_context_key(interaction):
+    """
+    Returns the guild history context an interaction belongs to, following GUILD_HISTORY_SCOPE:
+    (guild_id,), (guild_id, channel_id) or (guild_id, channel_id, thread_id). None in DMs.
+    """
+    if interaction.guild is None:
+        return None
+    guild_id = interaction.guild.id
+    if GUILD_HISTORY_SCOPE == "guild" or interaction.channel_id is None:
+        return (guild_id,)
+    channel = interaction.channel
+    if isinstance(channel, discord.Thread):
+        if GUILD_HISTORY_SCOPE == "thread":
+            return (guild_id, channel.parent_id, channel.id)
+        return (guild_id, channel.parent_id)
+    return (guild_id, interaction.channel_id)
+
+def _guild_history_log_path(context_key):
+    """Logs are sharded by context: guild_histories/<guild>.jsonl, <guild>/<channel>.jsonl or <guild>/<channel>/<thread>.jsonl."""
+    return os.path.join(GUILD_HISTORY_DIR, *(str(part) for part in context_key[:-1]), f"{context_key[-1]}.jsonl")
+
+def _write_guild_history_snapshot(context_key, history):
+    """Atomically replaces a context's log with a compacted snapshot of its history."""
+    filepath = _guild_history_log_path(context_key)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        for entry in history:
+            f.write(json.dumps({"op": "append", "entry": entry}) + "\n")
+    os.replace(tmp_filepath, filepath)
+
+def _replay_guild_history_log(filepath):
+    """Replays a context's log, returning the resulting history and the number of records read."""
+    records = []
+    with open(filepath, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A crash mid-write can leave a partial last line; skip it.
+                log.warning(f"Skipping corrupt record in {filepath}.")
+    return _replay_history_records(records)
+
+def _migrate_legacy_guild_history_file():
+    """Splits the old single-file history into per-guild logs, then renames the old file."""
+    try:
+        with open(GUILD_CONVERSATION_HISTORY_FILE, 'r') as f:
+            legacy_histories = json.load(f)
     except json.JSONDecodeError:
-        print(f"Error decoding {GUILD_CONVERSATION_HISTORY_FILE}. Starting with empty histories.")
-        guild_conversation_histories = {}
+        log.warning(f"Error decoding {GUILD_CONVERSATION_HISTORY_FILE}. Skipping migration.")
+        return
+    for guild_id, history in legacy_histories.items():
+        state_backend.replace_history("guild", (int(guild_id),), trim_history_to_budget(history, HISTORY_TOKEN_BUDGET))
+    os.replace(GUILD_CONVERSATION_HISTORY_FILE, f"{GUILD_CONVERSATION_HISTORY_FILE}.migrated")
+    log.info(f"Migrated {len(legacy_histories)} guild histories from {GUILD_CONVERSATION_HISTORY_FILE}.")
+
+def prepare_guild_history_storage():
+    """Migrates the legacy history file if present. Context logs themselves are loaded on first use."""
+    if os.path.exists(GUILD_CONVERSATION_HISTORY_FILE):
+        _migrate_legacy_guild_history_file()
+
+history_loads_in_flight = {} # (kind, key) -> task reading that history from the state backend
+
+async def _load_history(kind, key):
+    """Reads a history from the state backend off the event loop; concurrent loads of one key share a single read."""
+    load_key = (kind, key)
+    task = history_loads_in_flight.get(load_key)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(state_backend.load_history, kind, key))
+        history_loads_in_flight[load_key] = task
+        task.add_done_callback(lambda _: history_loads_in_flight.pop(load_key, None))
+    with span("history_load"):
+        return await asyncio.shield(task)
+
+async def get_guild_context_history(context_key):
+    """
+    Gets a guild context's history, loading it lazily if it is not in memory. A channel or thread context
+    with no log yet is seeded with a copy of the guild-wide (guild_id,) history.
+    """
+    history = guild_conversation_histories.get(context_key)
+    if history is not None:
+        return history
+    history = evicted_guild_histories.pop(context_key, None)
+    if history is None:
+        loaded_history, record_count = await _load_history("guild", context_key)
+        seeded = not record_count and len(context_key) > 1
+        if seeded:
+            guild_history, _ = await _load_history("guild", context_key[:1])
+            loaded_history = list(guild_history)
+        # Another request may have loaded this context while the read was in progress.
+        history = guild_conversation_histories.peek(context_key)
+        if history is not None:
+            return history
+        history = evicted_guild_histories.pop(context_key, loaded_history)
+        if history is loaded_history:
+            guild_history_log_sizes[context_key] = record_count
+            if seeded:
+                # Written to the context's own log, so it is not seeded again once it has one.
+                for entry in history:
+                    queue_guild_history_record(context_key, {"op": "append", "entry": entry})
+    guild_conversation_histories.set(context_key, history)
+    return history
+
+def get_guild_history_cache_stats() -> dict:
+    """Returns hit, miss and eviction counters for the guild context cache."""
+    return {**guild_conversation_histories.stats(), "pending_evicted": len(evicted_guild_histories)}
+
+def queue_guild_history_record(context_key, record):
+    """Queues a log record for a context; it is written by the next batched flush."""
+    pending_guild_history_records.setdefault(context_key, []).append(record)
+
+def _write_guild_history_batch(batch, snapshots):
+    """Appends queued records to each context's log, or writes a compacted snapshot instead."""
+    for context_key, records in batch.items():
+        if context_key in snapshots:
+            state_backend.replace_history("guild", context_key, snapshots[context_key])
+        else:
+            state_backend.append_history_records("guild", context_key, records)
 
-def save_guild_conversation_histories():
-    """Saves guild conversation histories to the JSON file."""
-    with open(GUILD_CONVERSATION_HISTORY_FILE, 'w') as f:
-        json.dump(guild_conversation_histories, f, indent=4)
+async def flush_guild_histories():
+    """Writes all queued guild history records to disk off the event loop."""
+    async with guild_history_flush_lock:
+        if not pending_guild_history_records:
+            return
+        batch = dict(pending_guild_history_records)
+        pending_guild_history_records.clear()
+        flushing_guild_history_keys.update(batch)
+        snapshots = {}
+        for context_key, records in batch.items():
+            log_size = guild_history_log_sizes.get(context_key, 0) + len(records)
+            if log_size > GUILD_HISTORY_COMPACT_THRESHOLD:
+                history = guild_conversation_histories.peek(context_key)
+                if history is None:
+                    history = evicted_guild_histories.get(context_key)
+                if history is not None:
+                    # The in-memory history already includes this batch, so it replaces the whole log.
+                    snapshots[context_key] = list(history)
+                    log_size = len(snapshots[context_key])
+            guild_history_log_sizes[context_key] = log_size
+        try:
+            with span("persist_guild_history"):
+                await asyncio.to_thread(_write_guild_history_batch, batch, snapshots)
+        except Exception as e:
+            error_count.inc(component="persistence", reason="guild_flush")
+            log.error(f"Error flushing guild histories: {e}")
+        finally:
+            flushing_guild_history_keys.difference_update(batch)
+            for context_key in batch:
+                if context_key not in pending_guild_history_records and evicted_guild_histories.pop(context_key, None) is not None:
+                    guild_history_log_sizes.pop(context_key, None)
+
+async def guild_history_flush_loop():
+    """Background task that periodically flushes queued guild history records."""
+    while True:
+        await asyncio.sleep(GUILD_HISTORY_FLUSH_INTERVAL)
+        guild_conversation_histories.evict_idle()
+        await flush_guild_histories()
 
 def load_dm_conversation_history(user_id):
     """Loads a DM conversation history for a specific user."""
@@ -76,66 +1252,1041 @@ def load_dm_conversation_history(user_id):
                 return json.load(f)
         return []
     except json.JSONDecodeError:
-        print(f"Error decoding DM history for user {user_id}. Starting fresh.")
+        log.warning(f"Error decoding DM history for user {user_id}. Starting fresh.")
         return []
 
 def save_dm_conversation_history(user_id, history):
-    """Saves a DM conversation history for a specific user."""
+    """Atomically saves a DM conversation history for a specific user (temp file + rename)."""
     filepath = os.path.join(DM_HISTORY_DIR, f"{user_id}.json")
-    with open(filepath, 'w') as f:
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, 'w') as f:
         json.dump(history, f, indent=4)
-
-def get_user_dm_history(user_id):
-    """Gets or initializes DM history for a user."""
-    if user_id not in dm_conversation_histories:
-        dm_conversation_histories[user_id] = load_dm_conversation_history(user_id)
-    return dm_conversation_histories[user_id]
-
-def add_to_conversation_history(message_content, role, guild_id=None, user_id=None, is_dm=False):
-    """Adds a message to the appropriate conversation history."""
+    os.replace(tmp_filepath, filepath)
+
+# DM histories are written behind: changes only mark the user dirty, and a background
+# task coalesces every turn since the last flush into a single file write.
+dirty_dm_history_user_ids = set()
+dm_history_flush_lock = asyncio.Lock()
+dm_history_flush_event = asyncio.Event()
+dm_history_flush_task = None
+dm_history_flush_stats = {"flushes": 0, "histories_written": 0, "errors": 0, "last_flush_seconds": 0.0, "max_flush_seconds": 0.0}
+
+def mark_dm_history_dirty(user_id):
+    """Marks a user's DM history for the next write-behind flush."""
+    dirty_dm_history_user_ids.add(user_id)
+    if len(dirty_dm_history_user_ids) >= DM_HISTORY_FLUSH_THRESHOLD:
+        dm_history_flush_event.set()
+
+def _write_dm_history_batch(snapshots):
+    for user_id, history in snapshots.items():
+        state_backend.replace_history("dm", user_id, history)
+
+async def flush_dm_histories():
+    """Writes every dirty DM history to disk off the event loop."""
+    async with dm_history_flush_lock:
+        if not dirty_dm_history_user_ids:
+            return
+        snapshots = {}
+        for user_id in dirty_dm_history_user_ids:
+            history = dm_conversation_histories.peek(user_id)
+            if history is None:
+                # Left in place until the write completes, so a reload meanwhile does not read the stale file.
+                history = evicted_dm_histories.get(user_id, [])
+            snapshots[user_id] = list(history)
+        dirty_dm_history_user_ids.clear()
+        flushing_dm_history_user_ids.update(snapshots)
+        start_time = time.perf_counter()
+        try:
+            with span("persist_dm_history"):
+                await asyncio.to_thread(_write_dm_history_batch, snapshots)
+        except Exception as e:
+            # Re-mark so the next flush retries these histories.
+            dirty_dm_history_user_ids.update(snapshots)
+            for user_id, history in snapshots.items():
+                if user_id not in dm_conversation_histories:
+                    evicted_dm_histories.setdefault(user_id, history)
+            dm_history_flush_stats["errors"] += 1
+            error_count.inc(component="persistence", reason="dm_flush")
+            log.error(f"Error flushing DM histories: {e}")
+            return
+        finally:
+            flushing_dm_history_user_ids.difference_update(snapshots)
+        for user_id in snapshots:
+            if user_id not in dirty_dm_history_user_ids:
+                evicted_dm_histories.pop(user_id, None) # Now on disk
+        elapsed = time.perf_counter() - start_time
+        dm_history_flush_stats["flushes"] += 1
+        dm_history_flush_stats["histories_written"] += len(snapshots)
+        dm_history_flush_stats["last_flush_seconds"] = elapsed
+        dm_history_flush_stats["max_flush_seconds"] = max(dm_history_flush_stats["max_flush_seconds"], elapsed)
+
+async def dm_history_flush_loop():
+    """Background task that flushes dirty DM histories on a timer or once enough are dirty."""
+    while True:
+        try:
+            await asyncio.wait_for(dm_history_flush_event.wait(), timeout=DM_HISTORY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        dm_history_flush_event.clear()
+        dm_conversation_histories.evict_idle()
+        await flush_dm_histories()
+
+def get_dm_history_flush_stats() -> dict:
+    """Returns write-behind flush latency and queue depth for monitoring."""
+    return {**dm_history_flush_stats, "queue_depth": len(dirty_dm_history_user_ids)}
+
+async def get_user_dm_history(user_id):
+    """Gets or initializes DM history for a user, reloading it lazily if it was evicted."""
+    history = dm_conversation_histories.get(user_id)
+    if history is not None:
+        return history
+    history = evicted_dm_histories.pop(user_id, None)
+    if history is None:
+        loaded_history, _ = await _load_history("dm", user_id)
+        history = dm_conversation_histories.peek(user_id)
+        if history is not None:
+            return history
+        history = evicted_dm_histories.pop(user_id, loaded_history)
+    dm_conversation_histories.set(user_id, history)
+    return history
+
+def get_dm_history_cache_stats() -> dict:
+    """Returns hit, miss and eviction counters for the DM history cache."""
+    return {**dm_conversation_histories.stats(), "pending_evicted": len(evicted_dm_histories)}
+
+async def add_to_conversation_history(message_content, role, guild_id=None, user_id=None, is_dm=False, context_key=None):
+    """
+    Adds a message to the appropriate conversation history. Guild messages go to context_key
+    (see get_conversation_context_key), defaulting to the guild-wide context.
+    """
     history_entry = {"role": role, "parts": [{"text": message_content}]}
 
     if is_dm and user_id:
-        history = get_user_dm_history(user_id)
-        history.append(history_entry)
-        if len(history) > 40: # Keep history to last 40 entries
-            history = history[-40:]
-        dm_conversation_histories[user_id] = history
-        save_dm_conversation_history(user_id, history)
+        history = await get_user_dm_history(user_id)
+        # Keep history to the last 40 entries and within the stored token budget
+        history = _append_within_budget(("dm", user_id), history, history_entry)
+        mark_dm_history_dirty(user_id)
+        dm_conversation_histories.set(user_id, history)
     elif guild_id:
-        if guild_id not in guild_conversation_histories:
-            guild_conversation_histories[guild_id] = []
-        guild_conversation_histories[guild_id].append(history_entry)
-        if len(guild_conversation_histories[guild_id]) > 40: # Keep history to last 40 entries
-            guild_conversation_histories[guild_id] = guild_conversation_histories[guild_id][-40:]
-        save_guild_conversation_histories()
-
-def get_conversation_history(guild_id=None, user_id=None, is_dm=False):
-    """Retrieves the conversation history."""
+        context_key = context_key or (guild_id,)
+        history = await get_guild_context_history(context_key)
+        # Keep history to the last 40 entries and within the stored token budget
+        history = _append_within_budget(("guild", context_key), history, history_entry)
+        queue_guild_history_record(context_key, {"op": "append", "entry": history_entry})
+        guild_conversation_histories.set(context_key, history)
+
+async def get_conversation_history(guild_id=None, user_id=None, is_dm=False, token_budget=None, context_key=None):
+    """
+    Retrieves the conversation history.
+    With a token_budget, only the newest turns that fit are returned (oldest turns are dropped),
+    starting from a user turn as Gemini expects.
+    """
     if is_dm and user_id:
-        return get_user_dm_history(user_id)
+        history = await get_user_dm_history(user_id)
     elif guild_id:
-        return guild_conversation_histories.get(guild_id, [])
-    return []
+        history = await get_guild_context_history(context_key or (guild_id,))
+    else:
+        return []
+    if token_budget is None:
+        return history
+    window = trim_history_to_budget(history, token_budget)
+    while len(window) > 1 and window[0].get("role") != "user":
+        window = window[1:]
+    return window
+
+# --- Upstream Resilience ---
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+
+    def __init__(self, endpoint_name, retry_in):
+        super().__init__(f"the {endpoint_name} service is temporarily unavailable. Please try again in {max(1, round(retry_in))} seconds.")
+        self.endpoint_name = endpoint_name
+        self.retry_in = retry_in
+
+class UpstreamEndpoint:
+    """Circuit breaker, retry budget and error-rate tracking for one upstream endpoint."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = "closed" # closed -> open after repeated failures -> half_open probe -> closed
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._retry_tokens = UPSTREAM_RETRY_BUDGET_MAX
+        self._outcomes = deque(maxlen=200) # (timestamp, succeeded)
+        self.total_requests = 0
+        self.total_failures = 0
+        self.total_retries = 0
+        self.total_rejected = 0
+
+    def before_attempt(self, is_retry=False):
+        """Raises CircuitOpenError while the circuit is open; lets a single probe through once it may have recovered."""
+        if self.state == "open":
+            retry_in = self.opened_at + CIRCUIT_RESET_TIMEOUT - time.monotonic()
+            if retry_in > 0:
+                self.total_rejected += 1
+                raise CircuitOpenError(self.name, retry_in)
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probe_in_flight:
+                self.total_rejected += 1
+                raise CircuitOpenError(self.name, CIRCUIT_RESET_TIMEOUT)
+            self._probe_in_flight = True
+        if not is_retry:
+            self.total_requests += 1
+            self._retry_tokens = min(UPSTREAM_RETRY_BUDGET_MAX, self._retry_tokens + UPSTREAM_RETRY_BUDGET_RATIO)
+
+    def record_success(self):
+        self._outcomes.append((time.monotonic(), True))
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            log.info(f"Circuit for {self.name} closed after a successful probe.")
+        self.state = "closed"
+
+    def abandon_attempt(self):
+        """An attempt ended without an outcome (cancelled or an unexpected error); a half-open probe may go again."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._outcomes.append((time.monotonic(), False))
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+            if self.state != "open":
+                log.warning(f"Circuit for {self.name} opened after {self.consecutive_failures} consecutive failures.")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_delay(self, attempt, max_retries, backoff_factor=UPSTREAM_BACKOFF_FACTOR, retry_after=None):
+        """Returns seconds to wait before retrying, or None if the retry is not allowed."""
+        if attempt >= max_retries or self.state == "open":
+            return None
+        if retry_after is not None and retry_after > UPSTREAM_MAX_RETRY_DELAY:
+            return None
+        if self._retry_tokens < 1:
+            return None
+        self._retry_tokens -= 1
+        self.total_retries += 1
+        if retry_after is not None:
+            return retry_after
+        return min(UPSTREAM_MAX_RETRY_DELAY, backoff_factor * (2 ** attempt) + random.uniform(0, 1))
+
+    def error_rate(self, window_seconds=60.0):
+        cutoff = time.monotonic() - window_seconds
+        recent = [succeeded for timestamp, succeeded in self._outcomes if timestamp >= cutoff]
+        return (recent.count(False) / len(recent)) if recent else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "error_rate_1m": self.error_rate(),
+            "retry_budget": self._retry_tokens,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "total_retries": self.total_retries,
+            "total_rejected": self.total_rejected
+        }
+
+upstream_endpoints = {name: UpstreamEndpoint(name) for name in ("text", "vision", "image", "search", "cache", "text_fast", "vision_fast", "image_fast")}
+
+def get_upstream_health_stats() -> dict:
+    """Returns circuit state, retry budget and error rate for each upstream endpoint."""
+    return {name: endpoint.stats() for name, endpoint in upstream_endpoints.items()}
+
+def parse_retry_after(value):
+    """Parses a Retry-After header given in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+@contextlib.asynccontextmanager
+async def resilient_request(endpoint_name, method, url, max_retries=UPSTREAM_MAX_RETRIES, backoff_factor=UPSTREAM_BACKOFF_FACTOR, **kwargs):
+    """
+    Sends a request through the shared session, retrying connection errors and retryable
+    statuses (honoring Retry-After) within the endpoint's retry budget. Fails fast with
+    CircuitOpenError while the endpoint is unhealthy. Yields the final response; callers
+    still call raise_for_status() on it.
+    """
+    endpoint = upstream_endpoints[endpoint_name]
+    session = await get_http_session()
+    attempt = 0
+    while True:
+        endpoint.before_attempt(is_retry=attempt > 0)
+        try:
+            response = await session.request(method, url, **kwargs)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            upstream_attempt_count.inc(endpoint=endpoint_name, status=type(e).__name__)
+            endpoint.record_failure()
+            delay = endpoint.retry_delay(attempt, max_retries, backoff_factor)
+            if delay is None:
+                raise
+            log.warning(f"{endpoint_name} request failed ({e!r}); retrying in {delay:.2f}s.", extra={"fields": {"endpoint": endpoint_name, "attempt": attempt + 1}})
+        except BaseException:
+            # Without this a cancelled half-open probe would leave the circuit rejecting every call for good.
+            endpoint.abandon_attempt()
+            raise
+        else:
+            upstream_attempt_count.inc(endpoint=endpoint_name, status=response.status)
+            if response.status not in RETRYABLE_STATUSES:
+                endpoint.record_success()
+                break
+            endpoint.record_failure()
+            delay = endpoint.retry_delay(attempt, max_retries, backoff_factor, parse_retry_after(response.headers.get("Retry-After")))
+            if delay is None:
+                break
+            log.warning(f"{endpoint_name} request returned HTTP {response.status}; retrying in {delay:.2f}s.", extra={"fields": {"endpoint": endpoint_name, "attempt": attempt + 1, "status": response.status}})
+            response.release()
+        attempt += 1
+        await asyncio.sleep(delay)
+    try:
+        yield response
+    finally:
+        response.release()
+
+# --- Upstream Request Scheduling ---
+def _fair_lane_position(lanes, lane_index, fair_key, item):
+    """
+    Returns the 1-based position an item will be served at. lanes is a list of OrderedDicts
+    (priority first) mapping fair key -> deque, served round-robin across keys.
+    """
+    position = sum(len(items) for lane in lanes[:lane_index] for items in lane.values())
+    lane = lanes[lane_index]
+    index = lane[fair_key].index(item)
+    seen_own_key = False
+    for key, items in lane.items():
+        if key == fair_key:
+            seen_own_key = True
+            position += index
+        else:
+            # Keys ahead of ours in the rotation get one extra turn before ours comes up.
+            position += min(len(items), index if seen_own_key else index + 1)
+    return position + 1
+
+def _pop_fair_lane(lanes):
+    """Removes and returns the next item in round-robin order, or None if every lane is empty."""
+    lane = next((lane for lane in lanes if lane), None)
+    if lane is None:
+        return None
+    fair_key, items = next(iter(lane.items()))
+    item = items.popleft()
+    if items:
+        lane.move_to_end(fair_key)
+    else:
+        del lane[fair_key]
+    return item
+
+class UpstreamScheduler:
+    """
+    Limits concurrent calls to one upstream endpoint. Waiting requests are queued per fair key
+    (guild, or user in DMs) and served round-robin, with a priority lane served before the rest.
+    """
+
+    def __init__(self, name, max_concurrency):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self._lanes = [OrderedDict(), OrderedDict()] # [priority, normal]; each maps fair key -> deque of waiters
+        self._avg_service_seconds = 5.0
+        self.total_started = 0
+        self.total_queued = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def queue_depth(self):
+        return sum(len(waiters) for lane in self._lanes for waiters in lane.values())
+
+    def _position(self, lane_index, fair_key, waiter):
+        return _fair_lane_position(self._lanes, lane_index, fair_key, waiter)
+
+    def _dispatch(self):
+        while self.in_flight < self.max_concurrency:
+            waiter = _pop_fair_lane(self._lanes)
+            if waiter is None:
+                return
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _remove_waiter(self, lane_index, fair_key, waiter):
+        waiters = self._lanes[lane_index].get(fair_key)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._lanes[lane_index][fair_key]
+
+    async def acquire(self, fair_key, priority=False, on_queued=None):
+        """
+        Waits for a free slot. If the request has to queue, on_queued(position, estimated_wait_seconds)
+        is awaited when it is queued and again whenever its position changes.
+        """
+        self.total_started += 1
+        if self.in_flight < self.max_concurrency and not self.queue_depth():
+            self.in_flight += 1
+            return
+        lane_index = 0 if priority else 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._lanes[lane_index].setdefault(fair_key, deque()).append(waiter)
+        self.total_queued += 1
+        queued_at = time.monotonic()
+        last_position = None
+        try:
+            while not waiter.done():
+                position = self._position(lane_index, fair_key, waiter)
+                if on_queued is not None and position != last_position:
+                    last_position = position
+                    estimated_wait = position / self.max_concurrency * self._avg_service_seconds
+                    try:
+                        await on_queued(position, estimated_wait)
+                    except Exception as e:
+                        log.error(f"Error sending queue feedback for {self.name}: {e}")
+                if waiter.done():
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=QUEUE_FEEDBACK_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.release() # The slot was granted just before the cancellation; hand it on.
+            else:
+                waiter.cancel()
+                self._remove_waiter(lane_index, fair_key, waiter)
+            raise
+        waited = time.monotonic() - queued_at
+        self.total_wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def release(self, service_seconds=None):
+        self.in_flight -= 1
+        if service_seconds is not None:
+            self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * service_seconds
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, fair_key, priority=False, on_queued=None):
+        """Holds one concurrency slot for the duration of the block."""
+        await self.acquire(fair_key, priority, on_queued)
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start_time)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queue_depth(),
+            "priority_queue_depth": sum(len(waiters) for waiters in self._lanes[0].values()),
+            "total_started": self.total_started,
+            "total_queued": self.total_queued,
+            "avg_wait_seconds": self.total_wait_seconds / self.total_queued if self.total_queued else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+            "avg_service_seconds": self._avg_service_seconds
+        }
+
+upstream_schedulers = {
+    "text": UpstreamScheduler("text", TEXT_MAX_CONCURRENCY),
+    "vision": UpstreamScheduler("vision", VISION_MAX_CONCURRENCY),
+    "image": UpstreamScheduler("image", IMAGE_MAX_CONCURRENCY)
+}
+
+def _fair_queue_key(guild_id=None, user_id=None):
+    """Requests are queued fairly per guild; DMs get one queue per user."""
+    return guild_id if guild_id else f"user:{user_id}"
+
+def _is_priority_user(user_id):
+    return user_id is not None and user_id in COOLDOWN_BYPASS_USER_IDS
+
+def get_upstream_scheduler_stats() -> dict:
+    """Returns in-flight and queue-depth metrics for each upstream endpoint."""
+    return {name: scheduler.stats() for name, scheduler in upstream_schedulers.items()}
+
+def format_queue_status(position, estimated_wait):
+    return f"⏳ Queued: position {position}, estimated wait ~{max(1, round(estimated_wait))}s"
+
+# --- Model Routing ---
+model_route_count = metrics.counter("bot_model_routes_total", "Requests routed to each model, by call kind and routing reason.")
+model_failover_count = metrics.counter("bot_model_failovers_total", "Calls retried on the fallback model after the routed model failed, by call kind and failed model.")
+COMPLEX_PROMPT_PATTERN = re.compile(r"```|\b(explain|analy[sz]e|compare|step[- ]by[- ]step|prove|derive|debug|refactor|implement|write|code|essay|detailed|why)\b", re.IGNORECASE)
+
+def gemini_model_url(model, method):
+    """URL of a Gemini API model method, e.g. gemini_model_url("gemini-2.5-flash", "generateContent")."""
+    stream_parameter = "alt=sse&" if method == "streamGenerateContent" else ""
+    return f"{GEMINI_API_BASE}/models/{model}:{method}?{stream_parameter}key={GEMINI_API_KEY}"
+
+def is_simple_prompt(prompt):
+    """Short prompts without code or analysis keywords are answered well by the fast model."""
+    return bool(prompt) and len(prompt) <= MODEL_ROUTING_FAST_MAX_CHARS and prompt.count("\n") < 3 and not COMPLEX_PROMPT_PATTERN.search(prompt)
+
+def is_transient_upstream_error(error):
+    """An open circuit, retryable statuses and network errors: failures a retry or another model may avoid."""
+    if isinstance(error, CircuitOpenError):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+class ModelHealth:
+    """Recent latencies and failures of one model. A slow, failing or rate-limited model is skipped for a while."""
+
+    def __init__(self, model):
+        self.model = model
+        self._samples = deque(maxlen=MODEL_HEALTH_WINDOW) # (seconds until the response arrived, succeeded)
+        self.degraded_until = 0.0
+        self.degraded_reason = None
+
+    def record(self, seconds, succeeded, rate_limited=False):
+        self._samples.append((seconds, succeeded))
+        if rate_limited:
+            self._degrade("rate_limited")
+        elif len(self._samples) >= MODEL_HEALTH_MIN_SAMPLES:
+            if self.error_rate() > MODEL_FAILOVER_ERROR_RATE:
+                self._degrade("errors")
+            elif (self.p95() or 0.0) > MODEL_FAILOVER_P95_SECONDS:
+                self._degrade("slow")
+
+    def _degrade(self, reason):
+        if not self.is_degraded():
+            log.warning(f"Model {self.model} is degraded ({reason}); routing around it for {MODEL_FAILOVER_COOLDOWN:g}s.")
+        self.degraded_until = time.monotonic() + MODEL_FAILOVER_COOLDOWN
+        self.degraded_reason = reason
+        # Judged afresh once the cooldown ends, rather than on the samples that degraded it.
+        self._samples.clear()
+
+    def is_degraded(self):
+        return time.monotonic() < self.degraded_until
+
+    def p95(self):
+        latencies = sorted(seconds for seconds, succeeded in self._samples if succeeded)
+        return latencies[int(0.95 * (len(latencies) - 1))] if latencies else None
+
+    def error_rate(self):
+        return sum(1 for _, succeeded in self._samples if not succeeded) / len(self._samples) if self._samples else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "samples": len(self._samples),
+            "p95_seconds": self.p95(),
+            "error_rate": self.error_rate(),
+            "degraded": self.is_degraded(),
+            "degraded_reason": self.degraded_reason if self.is_degraded() else None
+        }
+
+class ModelRouter:
+    """
+    Picks the model for a call kind from its tiers ("pro" and optionally "fast"): an explicit user choice
+    first, then prompt heuristics, and the fast model whenever the chosen one is degraded.
+    """
+
+    def __init__(self, kind, tiers):
+        self.kind = kind
+        self.tiers = {tier: model for tier, model in tiers.items() if model}
+        self.health = {model: ModelHealth(model) for model in set(self.tiers.values())}
+
+    def fallback_for(self, model):
+        fast_model = self.tiers.get("fast")
+        if not MODEL_FAILOVER_ENABLED or fast_model is None or model == fast_model:
+            return None
+        return fast_model
+
+    def endpoint_for(self, model):
+        """The fast model gets its own upstream endpoint, so its circuit breaker is independent of the primary's."""
+        return f"{self.kind}_fast" if model == self.tiers.get("fast") and model != self.tiers["pro"] else self.kind
+
+    def retries_for(self, model, default=UPSTREAM_MAX_RETRIES):
+        """Retries for a call; a model with a fallback fails over after fewer of them."""
+        return min(default, MODEL_FAILOVER_PRIMARY_RETRIES) if self.fallback_for(model) else default
+
+    def choose(self, prompt=None, requested_tier=None):
+        if requested_tier in self.tiers:
+            tier, reason = requested_tier, "requested"
+        elif MODEL_ROUTING_ENABLED and prompt is not None and "fast" in self.tiers and is_simple_prompt(prompt):
+            tier, reason = "fast", "simple_prompt"
+        else:
+            tier, reason = "pro", "default"
+        model = self.tiers[tier]
+        fallback = self.fallback_for(model)
+        if fallback is not None and self.health[model].is_degraded():
+            model, reason = fallback, "failover"
+        model_route_count.inc(kind=self.kind, model=model, reason=reason)
+        return model
+
+    def record(self, model, seconds, succeeded, rate_limited=False):
+        self.health[model].record(seconds, succeeded, rate_limited)
+
+    def stats(self) -> dict:
+        return {"tiers": self.tiers, "models": {model: health.stats() for model, health in self.health.items()}}
+
+model_routers = {
+    "text": ModelRouter("text", {"pro": GEMINI_PRO_MODEL, "fast": GEMINI_FAST_MODEL}),
+    "vision": ModelRouter("vision", {"pro": GEMINI_PRO_MODEL, "fast": GEMINI_FAST_MODEL}),
+    "image": ModelRouter("image", {"pro": IMAGEN_MODEL, "fast": IMAGEN_FAST_MODEL})
+}
+
+@contextlib.asynccontextmanager
+async def routed_response(router, model, open_response):
+    """
+    Opens open_response(model), an async context manager yielding an HTTP response, and raises for its
+    status. The time until the response arrived and the outcome are recorded for the router. When the
+    model is overloaded, rate limited or unavailable, the call is made once more on the fallback model.
+    Yields (response, model that answered).
+    """
+    while True:
+        start_time = time.perf_counter()
+        opened = False
+        try:
+            async with open_response(model) as response:
+                response.raise_for_status()
+                opened = True
+                router.record(model, time.perf_counter() - start_time, succeeded=True)
+                yield response, model
+            return
+        except Exception as e:
+            if opened or not is_transient_upstream_error(e):
+                raise
+            rate_limited = isinstance(e, aiohttp.ClientResponseError) and e.status == 429
+            router.record(model, time.perf_counter() - start_time, succeeded=False, rate_limited=rate_limited)
+            fallback = router.fallback_for(model)
+            if fallback is None:
+                raise
+            model_failover_count.inc(kind=router.kind, model=model)
+            log.warning(f"{model} failed ({e}); failing over to {fallback}.")
+            model = fallback
+
+def _report_model(on_model, model):
+    if on_model is not None:
+        on_model(model)
+
+def get_model_routing_stats() -> dict:
+    return {kind: router.stats() for kind, router in model_routers.items()}
+
+# --- Rate Limiting ---
+class RateLimitExceeded(app_commands.CheckFailure):
+    """Raised by rate_limited checks; retry_after is the number of seconds until the request would fit."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limit reached. Try again in {retry_after:.1f} seconds.")
+        self.retry_after = retry_after
+
+class RateLimiter:
+    """
+    Weighted token buckets per upstream pool: one global bucket sized from the pool's quota, plus per-guild
+    and per-user buckets holding a share of it. Buckets are kept in the state backend.
+    """
+
+    def __init__(self, backend, pool_quotas):
+        self.backend = backend
+        self.pool_quotas = pool_quotas # pool -> requests (or images) per minute
+        self.allowed = 0
+        self.limited = 0
+        self.errors = 0
+
+    def _buckets(self, pool, guild_id=None, user_id=None):
+        per_minute = self.pool_quotas[pool]
+        buckets = [(f"{pool}:global", per_minute, per_minute / 60)]
+        if not _is_priority_user(user_id):
+            if guild_id:
+                buckets.append((f"{pool}:guild:{guild_id}", per_minute * RATE_LIMIT_GUILD_SHARE, per_minute * RATE_LIMIT_GUILD_SHARE / 60))
+            if user_id is not None:
+                buckets.append((f"{pool}:user:{user_id}", per_minute * RATE_LIMIT_USER_SHARE, per_minute * RATE_LIMIT_USER_SHARE / 60))
+        return buckets
+
+    async def acquire(self, pool, cost, guild_id=None, user_id=None):
+        """Takes cost tokens from the pool's buckets. Returns 0.0 if allowed, else seconds until it would be."""
+        try:
+            retry_after = await asyncio.to_thread(self.backend.take_tokens, self._buckets(pool, guild_id, user_id), cost)
+        except Exception as e:
+            # Fail open: an unreachable state backend should not take the whole bot down.
+            self.errors += 1
+            log.error(f"Error checking rate limit for {pool}: {e}")
+            return 0.0
+        if retry_after:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return retry_after
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "limited": self.limited, "errors": self.errors, "pool_quotas": dict(self.pool_quotas)}
+
+rate_limiter = RateLimiter(state_backend, {"gemini": GEMINI_REQUESTS_PER_MINUTE, "imagen": IMAGEN_IMAGES_PER_MINUTE})
+
+def get_rate_limit_stats() -> dict:
+    return rate_limiter.stats()
+
+def ai_request_cost(namespace):
+    return RATE_LIMIT_COSTS["text"] + (RATE_LIMIT_COSTS["search"] if getattr(namespace, "search", False) else 0)
+
+def aiupload_request_cost(namespace):
+    image = getattr(namespace, "image", None)
+    image_megabytes = math.ceil(image.size / (1024 * 1024)) if image is not None else 0
+    search_cost = RATE_LIMIT_COSTS["search"] if getattr(namespace, "search", False) and getattr(namespace, "text", None) else 0
+    return RATE_LIMIT_COSTS["vision"] + RATE_LIMIT_COSTS["vision_per_mb"] * image_megabytes + search_cost
+
+def generateimage_request_cost(namespace):
+    return RATE_LIMIT_COSTS["image"] * (getattr(namespace, "variants", None) or 1)
+
+def aiupload_request_rejection(image, text=None, search=False) -> str | None:
+    """Returns the message /aiupload turns the request away with, or None if it is valid."""
+    if image is None or not image.content_type or not image.content_type.startswith('image/'):
+        return "Please upload a valid image file (e.g., PNG, JPG, GIF)."
+    if image.size > MAX_UPLOAD_IMAGE_BYTES:
+        return f"That image is too large. Please upload an image under {MAX_UPLOAD_IMAGE_BYTES // (1024 * 1024)} MB."
+    if search and (not text or not text.strip()):
+        return "To use web search with an image, please also provide some text for the search query in the 'text' field."
+    return None
+
+def generateimage_request_rejection(prompt) -> str | None:
+    """Returns the message /generateimage turns the request away with, or None if it is valid."""
+    if not prompt or not prompt.strip():
+        return "Please provide a prompt to generate an image."
+    return None
+
+def rate_limited(pool, cost_function, rejection=None):
+    """
+    Slash command check that charges the request's cost to the pool's buckets, or raises RateLimitExceeded.
+    Requests the command turns away itself (no permission, or a message from rejection(namespace)) are let
+    through uncharged, so invalid uploads and empty prompts do not use up the caller's quota.
+    """
+    async def predicate(interaction: discord.Interaction) -> bool:
+        if not can_use_command(interaction) or (rejection is not None and rejection(interaction.namespace)):
+            return True
+        retry_after = await rate_limiter.acquire(pool, cost_function(interaction.namespace), interaction.guild_id, interaction.user.id)
+        if retry_after:
+            raise RateLimitExceeded(retry_after)
+        return True
+    return app_commands.check(predicate)
+
+# --- Response Cache ---
+class ResponseCache:
+    """
+    TTL and size-bounded LRU cache for AI responses, optionally backed by one JSON file per entry on disk
+    and by a shared state backend, so every bot process benefits from each other's answers.
+    """
+
+    def __init__(self, max_entries, ttl, directory=None, disk_max_entries=0, backend=None, namespace="responses"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_max_entries = disk_max_entries
+        self.backend = backend
+        self.namespace = namespace
+        self._entries = OrderedDict() # key -> (stored_at_wall_time, value)
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _disk_path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _read_disk_entry(self, key):
+        try:
+            with open(self._disk_path(key), 'r') as f:
+                entry = json.load(f)
+            return entry["stored_at"], entry["value"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk_entry(self, key, stored_at, value):
+        filepath = self._disk_path(key)
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, 'w') as f:
+            json.dump({"stored_at": stored_at, "value": value}, f)
+        os.replace(tmp_filepath, filepath)
+
+    def _prune_disk(self):
+        """Deletes expired entries, then the oldest ones beyond disk_max_entries."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json"):
+                filepath = os.path.join(self.directory, filename)
+                try:
+                    entries.append((os.path.getmtime(filepath), filepath))
+                except OSError:
+                    continue
+        entries.sort()
+        cutoff = time.time() - self.ttl
+        excess = len(entries) - self.disk_max_entries
+        for i, (mtime, filepath) in enumerate(entries):
+            if mtime < cutoff or i < excess:
+                with contextlib.suppress(OSError):
+                    os.remove(filepath)
+
+    def _store_in_memory(self, key, stored_at, value):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+        if self.directory:
+            entry = await asyncio.to_thread(self._read_disk_entry, key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                self._store_in_memory(key, *entry)
+                self.disk_hits += 1
+                return entry[1]
+        if self.backend is not None:
+            try:
+                value = await asyncio.to_thread(self.backend.get_value, self.namespace, key)
+            except Exception as e:
+                log.error(f"Error reading shared {self.namespace} cache: {e}")
+                value = None
+            if value is not None:
+                self._store_in_memory(key, time.time(), value)
+                self.shared_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key, value):
+        stored_at = time.time()
+        self._store_in_memory(key, stored_at, value)
+        if self.directory:
+            try:
+                await asyncio.to_thread(self._write_disk_entry, key, stored_at, value)
+                self._disk_writes += 1
+                if self._disk_writes % 50 == 0:
+                    await asyncio.to_thread(self._prune_disk)
+            except OSError as e:
+                log.error(f"Error writing response cache entry to disk: {e}")
+        if self.backend is not None:
+            try:
+                await asyncio.to_thread(self.backend.set_value, self.namespace, key, value, self.ttl)
+            except Exception as e:
+                log.error(f"Error writing shared {self.namespace} cache: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL,
+    directory=RESPONSE_CACHE_DIR or None,
+    disk_max_entries=RESPONSE_CACHE_DISK_MAX_ENTRIES,
+    backend=shared_state_backend
+)
+
+def response_cache_enabled_for(command_name):
+    """Commands listed in RESPONSE_CACHE_DISABLED_COMMANDS opt out of the response cache."""
+    return RESPONSE_CACHE_ENABLED and command_name not in RESPONSE_CACHE_DISABLED_COMMANDS
+
+def normalize_prompt(prompt):
+    return " ".join((prompt or "").lower().split())
+
+def make_response_cache_key(kind, api_url, prompt, generation_config, image_hash=None, perform_search=False):
+    """Builds a cache key from the normalized prompt, model, generation config and optional image hash."""
+    key_material = json.dumps([
+        kind,
+        api_url.split("?")[0], # The model endpoint, without the API key
+        normalize_prompt(prompt),
+        generation_config,
+        image_hash,
+        perform_search
+    ], sort_keys=True)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+def get_response_cache_stats() -> dict:
+    return response_cache.stats()
+
+conversation_reset_generations = {} # conversation key -> times its history was reset with /resetai
+
+def bump_conversation_reset_generation(conversation_key):
+    """Retires a conversation's cached search answers, which were generated with the history being reset."""
+    conversation_reset_generations[conversation_key] = conversation_reset_generations.get(conversation_key, 0) + 1
+
+def search_answer_cache_key(api_url, prompt, guild_id=None, conversation_key=None):
+    """
+    Key of a search-augmented answer. The answer was generated with the conversation's history, so the
+    conversation key is part of it: one user's DM or channel context never answers another's prompt.
+    So is the number of times the conversation was reset, so answers from before /resetai are not reused.
+    """
+    persona = get_system_persona(guild_id)
+    generation_config = {**TEXT_GENERATION_CONFIG, "systemInstruction": persona} if persona else TEXT_GENERATION_CONFIG
+    if conversation_key is not None:
+        generation_config = {**generation_config, "conversation": list(conversation_key)}
+        reset_generation = conversation_reset_generations.get(conversation_key)
+        if reset_generation:
+            generation_config["reset_generation"] = reset_generation
+    return make_response_cache_key("text", api_url, prompt, generation_config, perform_search=True)
+
+# --- Request Coalescing ---
+coalesced_call_count = metrics.counter("bot_coalesced_calls_total", "Calls that waited for an identical in-flight call instead of making their own, by call type.")
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls: the first caller for a key does the work, and later callers
+    with the same key wait for its result instead of making their own upstream call.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {} # key -> future or task of the call in progress
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key):
+        """Returns the in-flight call for key (to await), counting the caller as coalesced, or None."""
+        flight = self._flights.get(key)
+        if flight is not None and flight.done():
+            return None # Finished; its done callback has not removed it yet
+        if flight is not None:
+            self.coalesced += 1
+            coalesced_call_count.inc(call=self.name)
+        return flight
+
+    def _track(self, key, flight):
+        self._flights[key] = flight
+        self.leaders += 1
+        flight.add_done_callback(lambda done: self._flights.pop(key, None) if self._flights.get(key) is done else None)
+
+    def lead(self, key):
+        """Registers the caller as the one doing the work for key. It must resolve the returned future."""
+        future = asyncio.get_running_loop().create_future()
+        self._track(key, future)
+        return future
+
+    async def do(self, key, coroutine_function):
+        """Runs coroutine_function() once for concurrent callers with the same key. A None key is never shared."""
+        if key is None:
+            return await coroutine_function()
+        flight = self.join(key)
+        if flight is None:
+            flight = asyncio.create_task(coroutine_function())
+            self._track(key, flight)
+        # Shielded so a caller that gives up does not cancel the call for everyone else.
+        return await asyncio.shield(flight)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+singleflights = {name: SingleFlight(name) for name in ("search", "ai_search")}
+
+# Call type -> function building the key that identifies identical requests (None = never shared).
+coalescing_key_functions = {
+    "search": lambda query, num_results: f"{num_results}:{normalize_prompt(query)}",
+    "ai_search": search_answer_cache_key,
+    "image": lambda prompt, sample_count: (normalize_prompt(prompt), sample_count)
+}
+
+def set_coalescing_key(call_type, key_function):
+    """Changes how requests of a call type are matched, e.g. to make image prompts case-sensitive."""
+    if call_type not in coalescing_key_functions:
+        raise ValueError(f"Unknown call type: {call_type}")
+    coalescing_key_functions[call_type] = key_function
+
+def coalescing_key(call_type, *args):
+    """Returns the coalescing key of a request, or None if its call type is not coalesced."""
+    if call_type not in COALESCE_CALL_TYPES:
+        return None
+    return coalescing_key_functions[call_type](*args)
+
+def get_coalescing_stats() -> dict:
+    stats = {name: flight.stats() for name, flight in singleflights.items()}
+    stats["image"] = {"coalesced": image_job_queue.deduplicated}
+    stats["enabled"] = sorted(COALESCE_CALL_TYPES)
+    return stats
 
 # --- Google Search Function ---
+class SearchBackend:
+    """Interface for the web search provider used by search_google. Tests can substitute a local stub."""
+
+    def configuration_error(self):
+        """Returns a user-facing message if the backend cannot be used, otherwise None."""
+        return None
+
+    async def search(self, query: str, num_results: int) -> list:
+        """Returns a list of result items with 'title', 'snippet' and 'link' keys."""
+        raise NotImplementedError
+
+class GoogleCustomSearchBackend(SearchBackend):
+    """Calls the Custom Search JSON API directly over the shared HTTP session, with no discovery client."""
+
+    def __init__(self, api_key, cse_id, api_url=GOOGLE_SEARCH_API_URL):
+        self.api_key = api_key
+        self.cse_id = cse_id
+        self.api_url = api_url
+
+    def configuration_error(self):
+        if not self.cse_id or self.cse_id == "YOUR_GOOGLE_CSE_ID_HERE":
+            log.warning("Google CSE ID is not configured. Skipping search.")
+            return "Search is not configured by the bot owner."
+        if not self.api_key or self.api_key == "YOUR_GOOGLE_API_KEY_FOR_SEARCH_HERE": # Ensure this placeholder matches
+            log.warning("Google API Key for Search is not configured. Skipping search.")
+            return "Search API key is not configured by the bot owner."
+        return None
+
+    async def search(self, query: str, num_results: int) -> list:
+        params = {"key": self.api_key, "cx": self.cse_id, "q": query, "num": num_results}
+        async with resilient_request("search", "GET", self.api_url, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+        return data.get('items', [])
+
+search_backend = GoogleCustomSearchBackend(GOOGLE_API_KEY, GOOGLE_CSE_ID)
+search_cache = ResponseCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL, backend=shared_state_backend, namespace="search")
+
+def set_search_backend(backend: SearchBackend):
+    """Replaces the search backend (e.g. with a local stub) and clears cached results."""
+    global search_backend, search_cache
+    search_backend = backend
+    search_cache = ResponseCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL, backend=shared_state_backend, namespace="search")
+
+async def _fetch_search_items(cache_key, query, num_results):
+    items = await search_backend.search(query, num_results)
+    await search_cache.set(cache_key, items)
+    return items
+
 async def search_google(query: str, num_results: int = 3) -> str | None:
-    """Performs a Google search using the Custom Search API."""
+    """
+    Performs a web search through the configured backend (the Custom Search API by default).
+    Results are cached by normalized query, and identical searches already in flight are shared.
+    """
     if not query or not query.strip():
         return "Search query was empty."
-    if not GOOGLE_CSE_ID or GOOGLE_CSE_ID == "YOUR_GOOGLE_CSE_ID_HERE":
-        print("Google CSE ID is not configured. Skipping search.")
-        return "Search is not configured by the bot owner."
-    if not GOOGLE_API_KEY or GOOGLE_API_KEY == "YOUR_GOOGLE_API_KEY_FOR_SEARCH_HERE": # Ensure this placeholder matches
-        print("Google API Key for Search is not configured. Skipping search.")
-        return "Search API key is not configured by the bot owner."
+    configuration_error = search_backend.configuration_error()
+    if configuration_error:
+        return configuration_error
 
+    cache_key = f"{num_results}:{normalize_prompt(query)}"
     try:
-        service = await asyncio.to_thread(build, "customsearch", "v1", developerKey=GOOGLE_API_KEY)
-        result = await asyncio.to_thread(
-            service.cse().list(q=query, cx=GOOGLE_CSE_ID, num=num_results).execute
-        )
-        items = result.get('items', [])
+        with span("search"):
+            items = await search_cache.get(cache_key)
+            if items is None:
+                items = await singleflights["search"].do(
+                    coalescing_key("search", query, num_results),
+                    lambda: _fetch_search_items(cache_key, query, num_results)
+                )
         if not items:
             return "No relevant search results found."
         search_results_str = ""
@@ -146,18 +2297,334 @@ async def search_google(query: str, num_results: int = 3) -> str | None:
             search_results_str += f"{i+1}. {title}: {snippet} (Source: {link})\n"
         return search_results_str.strip()
     except Exception as e:
-        print(f"Google Search API error: {e}")
+        error_count.inc(component="search", reason=type(e).__name__)
+        log.error(f"Google Search API error: {e}")
         return f"An error occurred while trying to search: {str(e)[:200]}"
 
+# --- Image Preprocessing ---
+image_worker_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKER_COUNT, thread_name_prefix="image-worker")
+
+def _preprocess_vision_image(image_bytes, content_type):
+    """
+    Downscales an image to VISION_MAX_IMAGE_DIMENSION, keeps only the first frame of animations and
+    re-encodes it (JPEG, or PNG if it has transparency). Falls back to the original bytes if the image
+    cannot be decoded. Returns (mime_type, base64_data, sha256_of_original).
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.seek(0) # First frame of animated GIF/WebP/APNG
+            max_size = (VISION_MAX_IMAGE_DIMENSION, VISION_MAX_IMAGE_DIMENSION)
+            img.draft("RGB", max_size) # Lets JPEG decoding skip straight to a reduced scale
+            has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+            img = img.convert("RGBA" if has_alpha else "RGB")
+            img.thumbnail(max_size)
+            output = io.BytesIO()
+            if has_alpha:
+                img.save(output, format="PNG", optimize=True)
+                mime_type = "image/png"
+            else:
+                img.save(output, format="JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+                mime_type = "image/jpeg"
+            encoded = output.getbuffer()
+    except Exception as e:
+        log.warning(f"Could not preprocess uploaded image ({e}); sending it unchanged.")
+        mime_type = content_type
+        encoded = image_bytes
+    return mime_type, base64.b64encode(encoded).decode('ascii'), image_hash
+
+async def preprocess_vision_image(image_bytes, content_type):
+    """Runs image preprocessing and base64 encoding in the worker pool, off the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_worker_pool, _preprocess_vision_image, image_bytes, content_type)
+
 # --- Gemini API Interaction ---
-async def get_ai_response(original_prompt: str, perform_search: bool, guild_id=None, user_id=None, is_dm=False) -> str:
-    """Gets a response from the Gemini API, optionally performing a web search first."""
-    # UPDATED MODEL TO gemini-2.5-pro-preview-05-06
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro-preview-05-06:generateContent?key={GEMINI_API_KEY}"
-    
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+TEXT_GENERATION_CONFIG = {"temperature": 0.7, "topK": 1, "topP": 1, "maxOutputTokens": 8192}
+VISION_GENERATION_CONFIG = {"temperature": 0.4, "topK": 32, "topP": 1, "maxOutputTokens": 4096}
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
+]
+JSON_HEADERS = {"Content-Type": "application/json"} # Payloads are encoded up front by run_blocking rather than by aiohttp
+
+class PayloadTemplate:
+    """A request body whose static fields are JSON-encoded once; each request encodes only its own fields."""
+
+    def __init__(self, **static_fields):
+        self.static_fields = static_fields
+        self._encoded_static_fields = json.dumps(static_fields)[1:-1]
+
+    def render(self, fields) -> str:
+        return "{" + json.dumps(fields)[1:-1] + "," + self._encoded_static_fields + "}"
+
+TEXT_PAYLOAD = PayloadTemplate(generationConfig=TEXT_GENERATION_CONFIG, safetySettings=SAFETY_SETTINGS)
+VISION_PAYLOAD = PayloadTemplate(generationConfig=VISION_GENERATION_CONFIG, safetySettings=SAFETY_SETTINGS)
+
+guild_personas = {} # guild_id -> persona, loaded from GUILD_PERSONAS_FILE at startup
+
+def load_guild_personas():
+    """Reads per-guild persona overrides, if the file exists."""
+    try:
+        with open(GUILD_PERSONAS_FILE, 'r') as f:
+            return {int(guild_id): persona for guild_id, persona in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.error(f"Error reading {GUILD_PERSONAS_FILE}: {e}")
+        return {}
+
+def get_system_persona(guild_id=None) -> str:
+    return guild_personas.get(guild_id, AI_SYSTEM_PERSONA) if guild_id else AI_SYSTEM_PERSONA
+
+# --- Gemini Context Cache ---
+def _conversation_key(guild_id=None, user_id=None, is_dm=False, context_key=None):
+    """Returns ("dm", user_id) or ("guild", context_key) for a conversation, or None if it has no history."""
+    if is_dm and user_id:
+        return ("dm", user_id)
+    if guild_id:
+        return ("guild", context_key or (guild_id,))
+    return None
+
+def _stored_history(conversation_key):
+    kind, key = conversation_key
+    return (dm_conversation_histories if kind == "dm" else guild_conversation_histories).peek(key)
+
+def _cacheable_prefix_bounds(history):
+    """
+    Returns (start, end) of the older turns worth caching: from the first user turn up to the newest
+    CONTEXT_CACHE_RECENT_ENTRIES entries, ending right before a user turn.
+    """
+    start = next((index for index, entry in enumerate(history) if entry.get("role") == "user"), len(history))
+    end = len(history) - CONTEXT_CACHE_RECENT_ENTRIES
+    while end > start and history[end].get("role") != "user":
+        end -= 1
+    return start, end
+
+class ContextCacheEntry:
+    def __init__(self, name, persona, last_entry, expires_at):
+        self.name = name # "cachedContents/..."
+        self.persona = persona
+        self.last_entry = last_entry # Newest history entry inside the cache; the uncached turns follow it
+        self.expires_at = expires_at # time.monotonic() deadline
+
+class ContextCacheManager:
+    """
+    Keeps one Gemini cachedContents resource per conversation and model, holding the persona and older
+    turns, so requests only send the turns after it. A cache only serves the model it was created for, so
+    a conversation routed to several models gets one for each. Caches are created, extended and replaced
+    in the background after replies, and deleted when a conversation is reset or no longer continues the
+    cached turns.
+    """
+
+    def __init__(self, enabled=CONTEXT_CACHE_ENABLED, ttl=CONTEXT_CACHE_TTL, min_tokens=CONTEXT_CACHE_MIN_TOKENS, max_uncached_tokens=CONTEXT_CACHE_MAX_UNCACHED_TOKENS):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.max_uncached_tokens = max_uncached_tokens
+        self._entries = {} # (conversation key, model) -> ContextCacheEntry
+        self._refresh_tasks = {} # (conversation key, model) -> running refresh
+        self._background_tasks = set()
+        self._next_prune = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.extended = 0
+        self.invalidated = 0
+        self.errors = 0
+
+    @staticmethod
+    def _tail_start(entry, history):
+        """Index right after the cached turns in history, or None if history no longer contains them."""
+        for index in range(len(history) - 1, -1, -1):
+            if history[index] is entry.last_entry:
+                return index + 1
+        return None
+
+    def _valid_entry(self, key, persona):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[key] # Gemini has already deleted it
+            return None
+        if entry.persona != persona:
+            self._drop(key)
+            return None
+        return entry
+
+    def plan(self, key, model, persona, token_budget):
+        """
+        Returns (cache name, newer turns) when the conversation's cache for model can serve a request, or
+        None. The newer turns are everything in the stored history after the cached ones.
+        """
+        if not self.enabled or key is None:
+            return None
+        entry = self._valid_entry((key, model), persona)
+        history = _stored_history(key)
+        if entry is None or history is None:
+            self.misses += 1
+            return None
+        tail_start = self._tail_start(entry, history)
+        if tail_start is None:
+            # The history was reset, reloaded or trimmed past the cached turns.
+            self._drop((key, model))
+            self.misses += 1
+            return None
+        tail = history[tail_start:]
+        if not tail or sum(estimate_entry_tokens(e) for e in tail) > token_budget:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.name, tail
+
+    def schedule_refresh(self, key, model, persona):
+        """Creates, extends or replaces a conversation's cache for model in the background after a reply."""
+        entry_key = (key, model)
+        if not self.enabled or key is None or entry_key in self._refresh_tasks:
+            return
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._entries = {k: e for k, e in self._entries.items() if e.expires_at > now}
+            self._next_prune = now + self.ttl
+        task = asyncio.create_task(self._refresh(key, model, persona))
+        self._refresh_tasks[entry_key] = task
+        task.add_done_callback(lambda _: self._refresh_tasks.pop(entry_key, None))
+
+    async def _refresh(self, key, model, persona):
+        entry_key = (key, model)
+        try:
+            history = _stored_history(key)
+            if history is None:
+                return
+            history = list(history)
+            entry = self._valid_entry(entry_key, persona)
+            start, end = _cacheable_prefix_bounds(history)
+            if entry is not None:
+                tail_start = self._tail_start(entry, history)
+                if tail_start is not None and (end <= tail_start or sum(estimate_entry_tokens(e) for e in history[tail_start:]) <= self.max_uncached_tokens):
+                    if entry.expires_at - time.monotonic() < self.ttl / 2:
+                        await self._request("PATCH", f"{entry.name}?updateMask=ttl", {"ttl": f"{self.ttl}s"})
+                        entry.expires_at = time.monotonic() + self.ttl
+                        self.extended += 1
+                    return
+            prefix = history[start:end]
+            if sum(estimate_entry_tokens(e) for e in prefix) + len(persona) // CHARS_PER_TOKEN < self.min_tokens:
+                return
+            fields = {"model": f"models/{model}", "contents": prefix, "ttl": f"{self.ttl}s"}
+            if persona:
+                fields["systemInstruction"] = {"parts": [{"text": persona}]}
+            created = await self._request("POST", "cachedContents", fields)
+            self.created += 1
+            self._drop(entry_key) # The new cache replaces the old one
+            self._entries[entry_key] = ContextCacheEntry(created["name"], persona, prefix[-1], time.monotonic() + self.ttl)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            log.warning(f"Error refreshing Gemini context cache: {e}")
+
+    async def _request(self, method, path, fields=None):
+        body = await run_blocking(json.dumps, fields, size=_estimate_history_size(fields.get("contents", []))) if fields is not None else None
+        url = f"{GEMINI_API_BASE}/{path}{'&' if '?' in path else '?'}key={GEMINI_API_KEY}"
+        async with resilient_request("cache", method, url, data=body, headers=JSON_HEADERS) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def _delete(self, name):
+        try:
+            await self._request("DELETE", name)
+        except Exception as e:
+            log.warning(f"Error deleting Gemini context cache {name}: {e}")
+
+    def _drop(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None and entry.expires_at > time.monotonic():
+            self.invalidated += 1
+            task = asyncio.create_task(self._delete(entry.name))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    def invalidate(self, key, model=None):
+        """
+        Forgets a conversation's caches, or only its cache for model, and deletes them from Gemini in the
+        background, e.g. on /resetai.
+        """
+        matches = lambda entry_key: entry_key[0] == key and model in (None, entry_key[1])
+        for entry_key in [k for k in self._refresh_tasks if matches(k)]:
+            self._refresh_tasks.pop(entry_key).cancel()
+        for entry_key in [k for k in self._entries if matches(k)]:
+            self._drop(entry_key)
+
+    async def close(self):
+        """Deletes every live cache so none keep being billed after shutdown."""
+        for task in list(self._refresh_tasks.values()):
+            task.cancel()
+        for entry_key in list(self._entries):
+            self._drop(entry_key)
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "live": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "extended": self.extended,
+            "invalidated": self.invalidated,
+            "errors": self.errors
+        }
+
+context_cache = ContextCacheManager()
+
+def get_context_cache_stats() -> dict:
+    return context_cache.stats()
+
+async def _encode_text_request(conversation_key, model, persona, window, token_budget, use_context_cache=True):
+    """
+    Encodes a generateContent body for model. When the conversation's context cache for that model holds
+    the older turns, only the turns after them are sent. Returns (body, whether the context cache was used).
+    """
+    plan = context_cache.plan(conversation_key, model, persona, token_budget) if use_context_cache else None
+    if plan is not None:
+        cache_name, newer_turns = plan
+        fields = {"cachedContent": cache_name, "contents": newer_turns}
+    else:
+        fields = {"contents": window}
+        if persona:
+            fields["systemInstruction"] = {"parts": [{"text": persona}]}
+    body = await run_blocking(TEXT_PAYLOAD.render, fields, size=_estimate_history_size(fields["contents"]))
+    return body, plan is not None
+
+@contextlib.asynccontextmanager
+async def gemini_text_request(model, method, conversation_key, persona, window, token_budget):
+    """
+    Sends a Gemini text request to model through resilient_request, using the conversation's context cache
+    when possible. If Gemini no longer accepts the cache, it is dropped and the request is sent again in full.
+    """
+    router = model_routers["text"]
+    api_url = gemini_model_url(model, method)
+    request_options = {"max_retries": router.retries_for(model), "headers": JSON_HEADERS}
+    body, used_context_cache = await _encode_text_request(conversation_key, model, persona, window, token_budget)
+    async with resilient_request(router.endpoint_for(model), "POST", api_url, data=body, **request_options) as response:
+        if not used_context_cache or response.status not in (400, 403, 404):
+            yield response
+            return
+    log.warning(f"Gemini rejected a context cache (HTTP {response.status}); retrying without it.")
+    context_cache.invalidate(conversation_key, model)
+    body, _ = await _encode_text_request(conversation_key, model, persona, window, token_budget, use_context_cache=False)
+    async with resilient_request(router.endpoint_for(model), "POST", api_url, data=body, **request_options) as response:
+        yield response
+
+async def _prepare_ai_request(original_prompt: str, perform_search: bool, guild_id=None, user_id=None, is_dm=False, token_budget: int = AI_HISTORY_TOKEN_BUDGET, context_key=None) -> list:
+    """Runs the optional web search, records the user turn and returns the history window to send."""
     current_turn_user_text = original_prompt
     if perform_search and original_prompt and original_prompt.strip():
-        print(f"Performing search for: {original_prompt}")
+        log.debug(f"Performing search for: {original_prompt}")
         search_results_output = await search_google(original_prompt)
         if search_results_output:
             if search_results_output.startswith("No relevant search results found."):
@@ -167,54 +2634,254 @@ async def get_ai_response(original_prompt: str, perform_search: bool, guild_id=N
             else:
                 current_turn_user_text = f"Web Search Results:\n{search_results_output}\n\nBased on these results, please answer: {original_prompt}"
     
-    add_to_conversation_history(current_turn_user_text, "user", guild_id, user_id, is_dm)
-    conversation_history = get_conversation_history(guild_id, user_id, is_dm)
+    await add_to_conversation_history(current_turn_user_text, "user", guild_id, user_id, is_dm, context_key)
+    return await get_conversation_history(guild_id, user_id, is_dm, token_budget=token_budget, context_key=context_key)
 
-    payload = {
-        "contents": conversation_history,
-        "generationConfig": {"temperature": 0.7, "topK": 1, "topP": 1, "maxOutputTokens": 8192},
-        "safetySettings": [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-        ]
-    }
+async def _get_cached_search_answer(api_url, original_prompt, perform_search, use_cache, guild_id, user_id, is_dm, context_key=None):
+    """
+    Looks up a cached answer for a search-augmented prompt. On a hit both turns are recorded in the
+    conversation history as if the model had answered. Returns (cache_key, cached_text).
+    """
+    if not (use_cache and perform_search and original_prompt and original_prompt.strip()):
+        return None, None
+    cache_key = search_answer_cache_key(api_url, original_prompt, guild_id, _conversation_key(guild_id, user_id, is_dm, context_key))
+    cached_text = await response_cache.get(cache_key)
+    if cached_text is not None:
+        await add_to_conversation_history(original_prompt, "user", guild_id, user_id, is_dm, context_key)
+        await add_to_conversation_history(cached_text, "model", guild_id, user_id, is_dm, context_key)
+    return cache_key, cached_text
+
+def _ai_search_flight_key(api_url, original_prompt, perform_search, use_cache, guild_id, conversation_key):
+    """
+    Search-augmented answers are shared like cached ones: only within one conversation, since they are
+    generated with its history, and never for requests that opted out of the response cache.
+    """
+    if not (use_cache and perform_search and original_prompt and original_prompt.strip()):
+        return None
+    return coalescing_key("ai_search", api_url, original_prompt, guild_id, conversation_key)
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(api_url, json=payload) as response:
-                response.raise_for_status()
-                data = await response.json()
-                if data.get("candidates") and data["candidates"][0].get("content", {}).get("parts"):
-                    ai_response_text = data["candidates"][0]["content"]["parts"][0]["text"]
-                    add_to_conversation_history(ai_response_text, "model", guild_id, user_id, is_dm)
-                    return ai_response_text
-                elif data.get("promptFeedback", {}).get("blockReason"):
-                    return f"I couldn't generate a response because the prompt was blocked. Reason: {data['promptFeedback']['blockReason']}."
-                else:
-                    print(f"Unexpected Gemini API response structure: {data}")
-                    return "Sorry, I received an unexpected response from the AI. No content found."
-        except aiohttp.ClientResponseError as e:
-            # FIXED AttributeError: 'ClientResponseError' object has no attribute 'text'
-            print(f"HTTP error calling Gemini API: {e.status} {e.message}")
-            print(f"URL: {e.request_info.url}") # Log the URL that was called
-            print(f"Headers: {e.headers}") # Log response headers if needed
-            # e.message usually contains the server's error message for 4xx/5xx
-            return f"Sorry, I encountered an error trying to reach the AI service (HTTP {e.status}: {e.message}). Please check the model name and API key."
-        except Exception as e:
-            print(f"Error in get_ai_response: {e}")
-            return "Sorry, an unexpected error occurred."
+async def _await_shared_answer(flight, original_prompt, guild_id, user_id, is_dm, context_key):
+    """
+    Waits for an identical search-augmented request that is already running. An answer is recorded in
+    this conversation's history like a cache hit. Returns None if that request was abandoned.
+    """
+    ai_response_text, answered = await asyncio.shield(flight)
+    if answered:
+        await add_to_conversation_history(original_prompt, "user", guild_id, user_id, is_dm, context_key)
+        await add_to_conversation_history(ai_response_text, "model", guild_id, user_id, is_dm, context_key)
+    return ai_response_text
+
+async def get_ai_response(original_prompt: str, perform_search: bool, guild_id=None, user_id=None, is_dm=False, token_budget: int = AI_HISTORY_TOKEN_BUDGET, on_queued=None, use_cache: bool = True, context_key=None, model_tier=None, on_model=None) -> str:
+    """
+    Gets a response from the Gemini API, optionally performing a web search first.
+    Identical search-augmented prompts that arrive while one is running share its answer.
+    The model is picked by the text router (model_tier "pro" or "fast" overrides its heuristics),
+    and on_model is called with the model that answered.
+    """
+    model = model_routers["text"].choose(original_prompt, model_tier)
+    api_url = gemini_model_url(model, "generateContent")
+    cache_key, cached_text = await _get_cached_search_answer(api_url, original_prompt, perform_search, use_cache, guild_id, user_id, is_dm, context_key)
+    if cached_text is not None:
+        _report_model(on_model, model)
+        return cached_text
+    request_args = (model, cache_key, original_prompt, perform_search, guild_id, user_id, is_dm, token_budget, on_queued, context_key, on_model)
+    flight_key = _ai_search_flight_key(api_url, original_prompt, perform_search, use_cache, guild_id, _conversation_key(guild_id, user_id, is_dm, context_key))
+    if flight_key is None:
+        return (await _request_ai_response(*request_args))[0]
+    flight = singleflights["ai_search"].join(flight_key)
+    if flight is not None:
+        shared_text = await _await_shared_answer(flight, original_prompt, guild_id, user_id, is_dm, context_key)
+        if shared_text is not None:
+            _report_model(on_model, model)
+            return shared_text
+    leader_future = singleflights["ai_search"].lead(flight_key)
+    result = (None, False)
+    try:
+        result = await _request_ai_response(*request_args)
+        return result[0]
+    finally:
+        leader_future.set_result(result)
+
+async def _request_ai_response(model, cache_key, original_prompt, perform_search, guild_id, user_id, is_dm, token_budget, on_queued, context_key, on_model):
+    """Makes the Gemini text request. Returns (text for the user, whether the model answered)."""
+    window = await _prepare_ai_request(original_prompt, perform_search, guild_id, user_id, is_dm, token_budget, context_key)
+    conversation_key = _conversation_key(guild_id, user_id, is_dm, context_key)
+    persona = get_system_persona(guild_id)
+
+    try:
+        async with upstream_schedulers["text"].slot(_fair_queue_key(guild_id, user_id), _is_priority_user(user_id), on_queued):
+            with span("gemini_call"):
+                open_response = lambda routed_model: gemini_text_request(routed_model, "generateContent", conversation_key, persona, window, token_budget)
+                async with routed_response(model_routers["text"], model, open_response) as (response, model):
+                    body = await response.read()
+        _report_model(on_model, model)
+        with span("response_parse"):
+            data = await run_blocking(json.loads, body, size=len(body))
+        record_token_usage("text", data)
+        if data.get("candidates") and data["candidates"][0].get("content", {}).get("parts"):
+            ai_response_text = data["candidates"][0]["content"]["parts"][0]["text"]
+            await add_to_conversation_history(ai_response_text, "model", guild_id, user_id, is_dm, context_key)
+            context_cache.schedule_refresh(conversation_key, model, persona)
+            if cache_key:
+                await response_cache.set(cache_key, ai_response_text)
+            return ai_response_text, True
+        elif data.get("promptFeedback", {}).get("blockReason"):
+            block_count.inc(kind="text")
+            return f"I couldn't generate a response because the prompt was blocked. Reason: {data['promptFeedback']['blockReason']}.", False
+        else:
+            error_count.inc(component="gemini_text", reason="unexpected_response")
+            log.warning("Unexpected Gemini API response structure", extra={"fields": {"response": data}})
+            return "Sorry, I received an unexpected response from the AI. No content found.", False
+    except CircuitOpenError as e:
+        error_count.inc(component="gemini_text", reason="circuit_open")
+        return f"Sorry, {e}", False
+    except aiohttp.ClientResponseError as e:
+        # FIXED AttributeError: 'ClientResponseError' object has no attribute 'text'
+        error_count.inc(component="gemini_text", reason=f"http_{e.status}")
+        log.error(f"HTTP error calling Gemini API: {e.status} {e.message}", extra={"fields": {"url": _redact_url(e.request_info.url), "response_headers": dict(e.headers or {})}})
+        # e.message usually contains the server's error message for 4xx/5xx
+        return f"Sorry, I encountered an error trying to reach the AI service (HTTP {e.status}: {e.message}). Please check the model name and API key.", False
+    except Exception as e:
+        error_count.inc(component="gemini_text", reason=type(e).__name__)
+        log.exception(f"Error in get_ai_response: {e}")
+        return "Sorry, an unexpected error occurred.", False
 
-async def get_multimodal_ai_response(image_bytes: bytes, image_content_type: str, text_prompt: str = None, perform_search: bool = False) -> str:
-    """Gets a response from Gemini Vision API, with optional search."""
-    # UPDATED MODEL TO gemini-2.5-pro-preview-05-06
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro-preview-05-06:generateContent?key={GEMINI_API_KEY}"
+class StreamNotice(str):
+    """An error or block message yielded by stream_ai_response in place of reply text."""
+
+async def stream_ai_response(original_prompt: str, perform_search: bool, guild_id=None, user_id=None, is_dm=False, token_budget: int = AI_HISTORY_TOKEN_BUDGET, on_queued=None, use_cache: bool = True, context_key=None, model_tier=None, on_model=None):
+    """
+    Streams a response from Gemini's streamGenerateContent SSE endpoint, yielding text pieces as they arrive.
+    The complete reply is added to the conversation history once the stream finishes.
+    Errors are yielded as a final StreamNotice holding the user-facing message, after any text that
+    was already streamed; a reply cut short is still recorded in the history as far as it got.
+    A search-augmented prompt identical to one already running gets that reply in one piece when it is done.
+    Models are routed as in get_ai_response; a failover can only happen before the first piece.
+    """
+    model = model_routers["text"].choose(original_prompt, model_tier)
+    # Keyed on the generateContent endpoint so streamed and non-streamed answers share cache entries and flights.
+    answer_url = gemini_model_url(model, "generateContent")
+    cache_key, cached_text = await _get_cached_search_answer(answer_url, original_prompt, perform_search, use_cache, guild_id, user_id, is_dm, context_key)
+    if cached_text is not None:
+        _report_model(on_model, model)
+        yield cached_text
+        return
+    leader_future = None
+    flight_key = _ai_search_flight_key(answer_url, original_prompt, perform_search, use_cache, guild_id, _conversation_key(guild_id, user_id, is_dm, context_key))
+    if flight_key is not None:
+        flight = singleflights["ai_search"].join(flight_key)
+        if flight is not None:
+            shared_text = await _await_shared_answer(flight, original_prompt, guild_id, user_id, is_dm, context_key)
+            if shared_text is not None:
+                _report_model(on_model, model)
+                yield shared_text
+                return
+        leader_future = singleflights["ai_search"].lead(flight_key)
+
+    pieces = []
+    notice = None
+    outcome = {"finished": False, "answered": False}
+    try:
+        async for piece in _stream_ai_request(model, cache_key, original_prompt, perform_search, guild_id, user_id, is_dm, token_budget, on_queued, context_key, on_model, outcome):
+            if isinstance(piece, StreamNotice):
+                notice = piece
+            else:
+                pieces.append(piece)
+            yield piece
+        outcome["finished"] = True
+    finally:
+        if leader_future is not None:
+            if outcome["answered"]:
+                leader_future.set_result(("".join(pieces), True))
+            else:
+                # Requests waiting on a failed reply get its error, not the partial text.
+                leader_future.set_result((notice, False) if outcome["finished"] else (None, False))
+
+async def _stream_ai_request(model, cache_key, original_prompt, perform_search, guild_id, user_id, is_dm, token_budget, on_queued, context_key, on_model, outcome):
+    """Streams the Gemini text request, setting outcome["answered"] once the model's reply is complete."""
+    notice = None
+    window = await _prepare_ai_request(original_prompt, perform_search, guild_id, user_id, is_dm, token_budget, context_key)
+    conversation_key = _conversation_key(guild_id, user_id, is_dm, context_key)
+    persona = get_system_persona(guild_id)
+
+    response_pieces = []
+    usage_data = {}
+    try:
+        async with upstream_schedulers["text"].slot(_fair_queue_key(guild_id, user_id), _is_priority_user(user_id), on_queued):
+            # Covers the whole stream, including the time the caller spends delivering each piece.
+            with span("gemini_stream"):
+                start_time = time.perf_counter()
+                open_response = lambda routed_model: gemini_text_request(routed_model, "streamGenerateContent", conversation_key, persona, window, token_budget)
+                async with routed_response(model_routers["text"], model, open_response) as (response, model):
+                    _report_model(on_model, model)
+                    async for line in response.content:
+                        line = line.strip()
+                        if not line.startswith(b"data:"):
+                            continue
+                        data = json.loads(line[len(b"data:"):])
+                        if data.get("usageMetadata"):
+                            # Each chunk reports the running totals, so only the last one is counted.
+                            usage_data = data
+                        if data.get("promptFeedback", {}).get("blockReason"):
+                            block_count.inc(kind="text")
+                            notice = StreamNotice(f"I couldn't generate a response because the prompt was blocked. Reason: {data['promptFeedback']['blockReason']}.")
+                            break
+                        for candidate in data.get("candidates", [])[:1]:
+                            for part in candidate.get("content", {}).get("parts", []):
+                                if part.get("text"):
+                                    if not response_pieces:
+                                        stage_latency.observe(time.perf_counter() - start_time, stage="gemini_first_token", outcome="ok")
+                                    response_pieces.append(part["text"])
+                                    yield part["text"]
+    except CircuitOpenError as e:
+        error_count.inc(component="gemini_stream", reason="circuit_open")
+        notice = StreamNotice(f"Sorry, {e}")
+    except aiohttp.ClientResponseError as e:
+        error_count.inc(component="gemini_stream", reason=f"http_{e.status}")
+        log.error(f"HTTP error calling Gemini streaming API: {e.status} {e.message}", extra={"fields": {"url": _redact_url(e.request_info.url), "response_headers": dict(e.headers or {})}})
+        notice = StreamNotice(f"Sorry, I encountered an error trying to reach the AI service (HTTP {e.status}: {e.message}). Please check the model name and API key.")
+    except Exception as e:
+        error_count.inc(component="gemini_stream", reason=type(e).__name__)
+        log.exception(f"Error in stream_ai_response: {e}")
+        notice = StreamNotice("Sorry, an unexpected error occurred.")
+    finally:
+        record_token_usage("stream", usage_data)
+
+    if response_pieces:
+        # Also recorded when the stream broke off, so the user turn is followed by the part the user saw.
+        ai_response_text = "".join(response_pieces)
+        await add_to_conversation_history(ai_response_text, "model", guild_id, user_id, is_dm, context_key)
+        if notice is None:
+            context_cache.schedule_refresh(conversation_key, model, persona)
+            if cache_key:
+                await response_cache.set(cache_key, ai_response_text)
+            outcome["answered"] = True
+    elif notice is None:
+        error_count.inc(component="gemini_stream", reason="unexpected_response")
+        log.warning("Gemini streaming API returned no content.")
+        notice = StreamNotice("Sorry, I received an unexpected response from the AI. No content found.")
+    if notice is not None:
+        yield notice
+
+async def get_multimodal_ai_response(image_bytes: bytes, image_content_type: str, text_prompt: str = None, perform_search: bool = False, guild_id=None, user_id=None, on_queued=None, use_cache: bool = True, model_tier=None, on_model=None) -> str:
+    """Gets a response from Gemini Vision API, with optional search. Models are routed as in get_ai_response."""
+    router = model_routers["vision"]
+    model = router.choose(text_prompt or "", model_tier)
+    api_url = gemini_model_url(model, "generateContent")
+
+    image_mime_type, image_data, image_hash = await preprocess_vision_image(image_bytes, image_content_type)
+    cache_key = None
+    if use_cache:
+        cache_key = make_response_cache_key("vision", api_url, text_prompt, VISION_GENERATION_CONFIG, image_hash=image_hash, perform_search=perform_search)
+        cached_text = await response_cache.get(cache_key)
+        if cached_text is not None:
+            _report_model(on_model, model)
+            return cached_text
 
     final_text_prompt_for_llm = text_prompt if text_prompt and text_prompt.strip() else "Describe this image."
 
     if perform_search and text_prompt and text_prompt.strip():
-        print(f"Performing search for (multimodal): {text_prompt}")
+        log.debug(f"Performing search for (multimodal): {text_prompt}")
         search_results_output = await search_google(text_prompt)
         if search_results_output:
             if search_results_output.startswith("No relevant search results found."):
@@ -224,123 +2891,494 @@ async def get_multimodal_ai_response(image_bytes: bytes, image_content_type: str
             else:
                 final_text_prompt_for_llm = f"Web Search Results:\n{search_results_output}\n\nBased on these search results and the image, please respond to: {text_prompt}"
     
-    parts = [{"inline_data": {"mime_type": image_content_type, "data": base64.b64encode(image_bytes).decode('utf-8')}}]
+    parts = [{"inline_data": {"mime_type": image_mime_type, "data": image_data}}]
     parts.insert(0, {"text": final_text_prompt_for_llm})
     
-    payload = {
-        "contents": [{"role": "user", "parts": parts}],
-        "generationConfig": {"temperature": 0.4, "topK": 32, "topP": 1, "maxOutputTokens": 4096},
-        "safetySettings": [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-        ]
-    }
+    # The payload carries the whole base64 image, so encoding it can take several milliseconds.
+    request_body = await run_blocking(VISION_PAYLOAD.render, {"contents": [{"role": "user", "parts": parts}]}, size=len(image_data))
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(api_url, json=payload) as response:
-                response.raise_for_status()
-                data = await response.json()
-                if data.get("candidates") and data["candidates"][0].get("content", {}).get("parts"):
-                    return data["candidates"][0]["content"]["parts"][0]["text"]
-                elif data.get("promptFeedback", {}).get("blockReason"):
-                    return f"Image analysis blocked. Reason: {data['promptFeedback']['blockReason']}."
-                else:
-                    print(f"Unexpected Gemini Vision API response structure: {data}")
-                    return "Sorry, I received an unexpected response from the AI for the image."
-        except aiohttp.ClientResponseError as e:
-            # FIXED AttributeError
-            print(f"HTTP error calling Gemini Vision API: {e.status} {e.message}")
-            print(f"URL: {e.request_info.url}")
-            print(f"Headers: {e.headers}")
-            return f"Sorry, I encountered an error trying to reach the AI vision service (HTTP {e.status}: {e.message})."
-        except Exception as e:
-            print(f"Error in get_multimodal_ai_response: {e}")
-            return "Sorry, an unexpected error occurred with image processing."
+    try:
+        async with upstream_schedulers["vision"].slot(_fair_queue_key(guild_id, user_id), _is_priority_user(user_id), on_queued):
+            with span("gemini_vision_call"):
+                open_response = lambda routed_model: resilient_request(router.endpoint_for(routed_model), "POST", gemini_model_url(routed_model, "generateContent"), max_retries=router.retries_for(routed_model), data=request_body, headers=JSON_HEADERS)
+                async with routed_response(router, model, open_response) as (response, model):
+                    body = await response.read()
+        _report_model(on_model, model)
+        with span("response_parse"):
+            data = await run_blocking(json.loads, body, size=len(body))
+        record_token_usage("vision", data)
+        if data.get("candidates") and data["candidates"][0].get("content", {}).get("parts"):
+            ai_vision_text = data["candidates"][0]["content"]["parts"][0]["text"]
+            if cache_key:
+                await response_cache.set(cache_key, ai_vision_text)
+            return ai_vision_text
+        elif data.get("promptFeedback", {}).get("blockReason"):
+            block_count.inc(kind="vision")
+            return f"Image analysis blocked. Reason: {data['promptFeedback']['blockReason']}."
+        else:
+            error_count.inc(component="gemini_vision", reason="unexpected_response")
+            log.warning("Unexpected Gemini Vision API response structure", extra={"fields": {"response": data}})
+            return "Sorry, I received an unexpected response from the AI for the image."
+    except CircuitOpenError as e:
+        error_count.inc(component="gemini_vision", reason="circuit_open")
+        return f"Sorry, {e}"
+    except aiohttp.ClientResponseError as e:
+        # FIXED AttributeError
+        error_count.inc(component="gemini_vision", reason=f"http_{e.status}")
+        log.error(f"HTTP error calling Gemini Vision API: {e.status} {e.message}", extra={"fields": {"url": _redact_url(e.request_info.url), "response_headers": dict(e.headers or {})}})
+        return f"Sorry, I encountered an error trying to reach the AI vision service (HTTP {e.status}: {e.message})."
+    except Exception as e:
+        error_count.inc(component="gemini_vision", reason=type(e).__name__)
+        log.exception(f"Error in get_multimodal_ai_response: {e}")
+        return "Sorry, an unexpected error occurred with image processing."
 
 # --- Imagen API Interaction (Image Generation) with Retries ---
-async def generate_image_from_prompt(
-    prompt: str, 
-    max_retries: int = 3, 
-    backoff_factor: float = 1.0
-) -> str | None:
+IMAGEN_API_URL = f"{GEMINI_API_BASE}/models/{IMAGEN_MODEL}:predict" # Identifies cached images, whichever Imagen model made them
+_BASE64_IMAGE_PATTERN = re.compile(rb'"bytesBase64Encoded"\s*:\s*"([A-Za-z0-9+/=]*)"')
+
+class ImageGenerationResult:
     """
-    Generates an image using Imagen 3 model with retries and exponential backoff.
-    Returns base64 encoded string or an error message string.
+    Outcome of an Imagen request: the decoded PNG bytes of each image on success, otherwise an
+    error_kind ("not_configured", "blocked", "no_image", "api_error", "unavailable" or "unexpected")
+    and the message shown to the user.
     """
-    if not GEMINI_API_KEY or GEMINI_API_KEY == "YOUR_GEMINI_API_KEY_HERE":
-        print("Error: Gemini API Key for Imagen is not configured.")
-        return "Image generation failed: API Key not configured."
 
-    # Using the generativelanguage.googleapis.com endpoint for Imagen as per original user code structure.
-    # Ensure GEMINI_API_KEY is authorized for imagen-3.0-generate-002 via this endpoint.
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/imagen-3.0-generate-002:predict?key={GEMINI_API_KEY}"
+    def __init__(self, images=None, error=None, error_kind=None, from_cache=False, model=None):
+        self.images = images or []
+        self.error = error
+        self.error_kind = error_kind
+        self.from_cache = from_cache
+        self.model = model # The Imagen model that generated the images, if known
+
+    @classmethod
+    def failure(cls, error_kind, error):
+        return cls(error=error, error_kind=error_kind)
+
+    @property
+    def ok(self):
+        return self.error is None and bool(self.images)
+
+class GeneratedImageCache:
+    """On-disk cache of generated PNGs, one file per image, so repeated prompts skip Imagen."""
+
+    def __init__(self, directory, ttl, max_files):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_files = max_files
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _paths(self, key, count):
+        return [os.path.join(self.directory, f"{key}_{index}.png") for index in range(count)]
+
+    def _read(self, key, count):
+        images = []
+        cutoff = time.time() - self.ttl
+        try:
+            for filepath in self._paths(key, count):
+                if os.path.getmtime(filepath) < cutoff:
+                    return None
+                with open(filepath, 'rb') as f:
+                    images.append(f.read())
+        except OSError:
+            return None
+        return images
+
+    def _write(self, key, images):
+        for filepath, image in zip(self._paths(key, len(images)), images):
+            tmp_filepath = f"{filepath}.tmp"
+            with open(tmp_filepath, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_filepath, filepath)
+
+    def _prune(self):
+        """Deletes expired images, then the oldest ones beyond max_files."""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".png"):
+                filepath = os.path.join(self.directory, filename)
+                try:
+                    entries.append((os.path.getmtime(filepath), filepath))
+                except OSError:
+                    continue
+        entries.sort()
+        cutoff = time.time() - self.ttl
+        excess = len(entries) - self.max_files
+        for i, (mtime, filepath) in enumerate(entries):
+            if mtime < cutoff or i < excess:
+                with contextlib.suppress(OSError):
+                    os.remove(filepath)
+
+    async def get(self, key, count):
+        images = await asyncio.to_thread(self._read, key, count)
+        if images is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return images
+
+    async def set(self, key, images):
+        try:
+            await asyncio.to_thread(self._write, key, images)
+            self._writes += 1
+            if self._writes % 50 == 0:
+                await asyncio.to_thread(self._prune)
+        except OSError as e:
+            log.error(f"Error writing generated image to disk cache: {e}")
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+image_cache = GeneratedImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_TTL, IMAGE_CACHE_MAX_FILES) if IMAGE_CACHE_DIR else None
+
+def _decode_image_predictions(body):
+    """
+    Decodes every bytesBase64Encoded field straight from the raw response body through a memoryview,
+    so the base64 text is never copied into Python strings. Returns None if no field is found.
+    """
+    body_view = memoryview(body)
+    images = [binascii.a2b_base64(body_view[match.start(1):match.end(1)]) for match in _BASE64_IMAGE_PATTERN.finditer(body)]
+    return images or None
+
+def _image_error_result(error):
+    """Maps an exception raised while calling Imagen to the result shown to the user."""
+    if isinstance(error, CircuitOpenError):
+        return ImageGenerationResult.failure("unavailable", f"Image generation failed: {error}")
+    if isinstance(error, aiohttp.ClientResponseError):
+        # For aiohttp.ClientResponseError, e.message often contains the server's text
+        return ImageGenerationResult.failure("api_error", f"Failed to generate image: API error {error.status} {error.message}")
+    return ImageGenerationResult.failure("unexpected", "Sorry, an unexpected error occurred during image generation.")
+
+async def _request_images(
+    prompt: str,
+    sample_count: int = 1,
+    max_retries: int = 3,
+    backoff_factor: float = 1.0,
+    guild_id=None,
+    user_id=None,
+    on_queued=None
+) -> ImageGenerationResult:
+    """
+    Calls Imagen 3 once for sample_count images, or serves them from the image cache.
+    API answers without image data come back as failed results; transport failures are raised.
+    """
+    if not GEMINI_API_KEY or GEMINI_API_KEY == "YOUR_GEMINI_API_KEY_HERE":
+        log.error("Gemini API Key for Imagen is not configured.")
+        return ImageGenerationResult.failure("not_configured", "Image generation failed: API Key not configured.")
 
     payload = {
         "instances": [{"prompt": prompt}],
-        "parameters": {"sampleCount": 1}
+        "parameters": {"sampleCount": sample_count}
     }
 
-    for attempt in range(max_retries):
-        print(f"Attempt {attempt + 1} of {max_retries} to generate image for prompt: \"{prompt[:50]}...\"")
-        async with aiohttp.ClientSession() as session:
+    cache_key = None
+    if image_cache is not None and response_cache_enabled_for("generateimage"):
+        cache_key = make_response_cache_key("image", IMAGEN_API_URL, prompt, payload["parameters"])
+        cached_images = await image_cache.get(cache_key, sample_count)
+        if cached_images is not None:
+            log.debug(f"Image cache hit for prompt: \"{prompt[:50]}...\"")
+            return ImageGenerationResult(images=cached_images, from_cache=True)
+
+    # Using the generativelanguage.googleapis.com endpoint for Imagen as per original user code structure.
+    # Ensure GEMINI_API_KEY is authorized for the Imagen models via this endpoint.
+    router = model_routers["image"]
+    model = router.choose()
+
+    log.info(f"Generating {sample_count} image(s) (up to {max_retries} attempts) with {model} for prompt: \"{prompt[:50]}...\"")
+    async with upstream_schedulers["image"].slot(_fair_queue_key(guild_id, user_id), _is_priority_user(user_id), on_queued):
+        with span("imagen_call"):
+            open_response = lambda routed_model: resilient_request(
+                router.endpoint_for(routed_model), "POST", gemini_model_url(routed_model, "predict"),
+                max_retries=router.retries_for(routed_model, max_retries - 1), backoff_factor=backoff_factor, json=payload
+            )
+            async with routed_response(router, model, open_response) as (response, model):
+                body = await response.read()
+
+    with span("response_parse"):
+        try:
+            images = await run_blocking(_decode_image_predictions, body, size=len(body))
+        except binascii.Error as e:
+            error_count.inc(component="imagen", reason="malformed_image")
+            log.warning(f"Imagen API returned malformed image data: {e}")
+            return ImageGenerationResult.failure("no_image", "Failed to generate image: the image data returned was malformed.")
+    if images:
+        log.info(f"{len(images)} image(s) generated successfully.")
+        if cache_key is not None:
+            await image_cache.set(cache_key, images)
+        return ImageGenerationResult(images=images, model=model)
+
+    data = await run_blocking(json.loads, body, size=len(body))
+    if data.get("promptFeedback", {}).get("blockReason"):
+        block_reason = data['promptFeedback']['blockReason']
+        block_count.inc(kind="image")
+        log.info(f"Imagen API blocked prompt. Reason: {block_reason}")
+        return ImageGenerationResult.failure("blocked", f"Image generation blocked. Reason: {block_reason}")
+
+    # A successful response without image data is usually a content filter, so it is not retried.
+    error_detail = data.get("error", {}).get("message") or "No image data in response."
+    error_count.inc(component="imagen", reason="no_image")
+    log.warning(f"Imagen API did not return image data. Details: {error_detail}")
+    return ImageGenerationResult.failure("no_image", f"Failed to generate image: {error_detail}")
+
+async def generate_images_from_prompt(prompt: str, sample_count: int = 1, **kwargs) -> ImageGenerationResult:
+    """
+    Generates sample_count images in a single Imagen 3 call. Transient failures are retried by the shared
+    resilience layer. Never raises; failures are reported through the result's error fields.
+    """
+    try:
+        return await _request_images(prompt, sample_count, **kwargs)
+    except Exception as e:
+        error_count.inc(component="imagen", reason=type(e).__name__)
+        log.error(f"Error in generate_images_from_prompt: {e}")
+        return _image_error_result(e)
+
+async def generate_image_from_prompt(
+    prompt: str, 
+    max_retries: int = 3, 
+    backoff_factor: float = 1.0,
+    guild_id=None,
+    user_id=None,
+    on_queued=None
+) -> ImageGenerationResult:
+    """
+    Generates an image using Imagen 3 model. Transient failures are retried by the shared
+    resilience layer (max_retries counts total attempts).
+    """
+    return await generate_images_from_prompt(prompt, 1, max_retries=max_retries, backoff_factor=backoff_factor, guild_id=guild_id, user_id=user_id, on_queued=on_queued)
+
+# --- Image Generation Job Queue ---
+class ImageJobWaiter:
+    """One user waiting on an image job, with callbacks for position updates and the final result."""
+
+    def __init__(self, deliver, on_position=None):
+        self.deliver = deliver # deliver(result) with an ImageGenerationResult
+        self.on_position = on_position # on_position(position, estimated_wait); 0 = generating, None = waiting to retry
+        self.position = None
+        self.shown_position = None
+        self.delivered = False
+        self.lock = asyncio.Lock() # Keeps position edits from landing after the result
+
+class ImageJob:
+    def __init__(self, key, prompt, sample_count, guild_id=None, user_id=None):
+        self.key = key
+        self.prompt = prompt
+        self.sample_count = sample_count
+        self.fair_key = _fair_queue_key(guild_id, user_id)
+        self.lane_index = 0 if _is_priority_user(user_id) else 1
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.waiters = []
+        self.attempts = 0
+        self.requeue_handle = None # Timer that re-queues the job after a transient failure
+
+class ImageJobQueue:
+    """
+    Runs Imagen requests from a bounded, per-guild fair queue on a fixed pool of worker tasks.
+    Identical pending prompts share one job. Waiters get position updates and their result through
+    callbacks, so nothing is held open per user while a job waits or is retried.
+    """
+
+    def __init__(self, worker_count, max_pending):
+        self.worker_count = worker_count
+        self.max_pending = max_pending
+        self._lanes = [OrderedDict(), OrderedDict()] # [priority, normal]; each maps fair key -> deque of jobs
+        self._jobs = {} # dedupe key -> job, while queued, running or waiting to retry
+        self._running = set()
+        self._ready = asyncio.Event()
+        self._workers = []
+        self._background_tasks = set()
+        self._avg_job_seconds = 15.0
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.requeued = 0
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def close(self):
+        """
+        Stops the workers and delivers a failure to everyone waiting on an unfinished job, so no reply
+        is left showing its queue position after shutdown.
+        """
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        result = ImageGenerationResult.failure("unavailable", "Image generation was cancelled because the bot is shutting down. Please try again later.")
+        for job in self._jobs.values():
+            if job.requeue_handle is not None:
+                job.requeue_handle.cancel()
+            for waiter in job.waiters:
+                self._spawn(self._deliver(waiter, result))
+        self._jobs.clear()
+        self._lanes = [OrderedDict(), OrderedDict()]
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    def queue_depth(self):
+        return sum(len(jobs) for lane in self._lanes for jobs in lane.values())
+
+    def estimated_wait(self, position):
+        """Seconds until a job at this position finishes, assuming every worker is busy."""
+        return ((position + self.worker_count - 1) // self.worker_count + 1) * self._avg_job_seconds
+
+    def _job_position(self, job):
+        if job in self._running:
+            return 0
+        jobs = self._lanes[job.lane_index].get(job.fair_key)
+        if jobs is None or job not in jobs:
+            return None # Waiting to be re-queued after a transient failure
+        return _fair_lane_position(self._lanes, job.lane_index, job.fair_key, job)
+
+    def submit(self, prompt, sample_count, deliver, on_position=None, guild_id=None, user_id=None):
+        """
+        Queues an image job, or joins an identical pending one. Returns the job's queue position
+        (0 if it is already generating), or -1 if the queue is full.
+        """
+        key = coalescing_key("image", prompt, sample_count)
+        if key is None:
+            key = object() # Never shared
+        waiter = ImageJobWaiter(deliver, on_position)
+        job = self._jobs.get(key)
+        if job is not None:
+            self.deduplicated += 1
+            coalesced_call_count.inc(call="image")
+            log.debug(f"Joined pending image job for prompt: \"{prompt[:50]}...\"")
+        elif self.queue_depth() >= self.max_pending:
+            self.rejected += 1
+            return -1
+        else:
+            job = ImageJob(key, prompt, sample_count, guild_id, user_id)
+            self._jobs[key] = job
+            self._lanes[job.lane_index].setdefault(job.fair_key, deque()).append(job)
+            self.submitted += 1
+            self._ready.set()
+        job.waiters.append(waiter)
+        position = self._job_position(job)
+        self._notify(waiter, position, self.estimated_wait(position) if position is not None else 0)
+        return position
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def _notify(self, waiter, position, estimated_wait):
+        waiter.position = position
+        if waiter.on_position is not None and position != waiter.shown_position:
+            self._spawn(self._send_position(waiter, estimated_wait))
+
+    async def _send_position(self, waiter, estimated_wait):
+        async with waiter.lock:
+            if waiter.delivered or waiter.position == waiter.shown_position:
+                return # A newer update already went out, or the result did
+            waiter.shown_position = waiter.position
             try:
-                async with session.post(api_url, json=payload) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-
-                    if data.get("predictions") and len(data["predictions"]) > 0 and data["predictions"][0].get("bytesBase64Encoded"):
-                        print("Image generated successfully.")
-                        return data["predictions"][0]["bytesBase64Encoded"]
-                    else:
-                        error_detail = "No image data in response."
-                        if data.get("error", {}).get("message"):
-                            error_detail = data["error"]["message"]
-                        elif data.get("promptFeedback", {}).get("blockReason"):
-                            block_reason = data['promptFeedback']['blockReason']
-                            print(f"Imagen API blocked prompt. Reason: {block_reason}")
-                            return f"Image generation blocked. Reason: {block_reason}"
-                        
-                        print(f"Imagen API did not return image data on attempt {attempt + 1}. Details: {error_detail}")
-                        if "No image data in response" in error_detail and attempt < max_retries - 1:
-                            pass
-                        elif attempt == max_retries -1:
-                             return f"Failed to generate image after {max_retries} attempts: {error_detail}"
-
-            except aiohttp.ClientResponseError as e:
-                error_message_text = f"HTTP error calling Imagen API on attempt {attempt + 1}: {e.status} {e.message}"
-                try:
-                    # For aiohttp.ClientResponseError, e.message often contains the server's text
-                    # If you need the full response body for debugging, you'd typically read it *before* raise_for_status
-                    # or catch it and then read. Here, we'll rely on e.message.
-                    print(f"{error_message_text} - URL: {e.request_info.url}")
-                except Exception as e_detail:
-                    print(f"{error_message_text} (could not get further details: {e_detail})")
-
-                if attempt == max_retries - 1:
-                    return f"Failed to generate image due to API error after {max_retries} attempts: {e.status} {e.message}"
+                await waiter.on_position(waiter.position, estimated_wait)
+            except Exception as e:
+                log.error(f"Error sending image queue feedback: {e}")
+
+    def _notify_positions(self):
+        for job in self._jobs.values():
+            position = self._job_position(job)
+            if position is None:
+                continue
+            for waiter in job.waiters:
+                self._notify(waiter, position, self.estimated_wait(position))
+
+    async def _deliver(self, waiter, result):
+        waiter.delivered = True
+        async with waiter.lock:
+            try:
+                await waiter.deliver(result)
             except Exception as e:
-                print(f"Unexpected error in generate_image_from_prompt (attempt {attempt + 1}): {e}")
-                if attempt == max_retries - 1:
-                    return f"Sorry, an unexpected error occurred during image generation after {max_retries} attempts."
-
-            if attempt < max_retries - 1:
-                delay = backoff_factor * (2 ** attempt) + random.uniform(0, 1)
-                print(f"Waiting {delay:.2f} seconds before next retry...")
-                await asyncio.sleep(delay)
+                log.error(f"Error delivering generated image: {e}")
+
+    def _requeue(self, job):
+        job.requeue_handle = None
+        # Retried jobs go to the front of their guild's queue rather than starting over at the back.
+        self._lanes[job.lane_index].setdefault(job.fair_key, deque()).appendleft(job)
+        self._ready.set()
+        self._notify_positions()
+
+    async def _worker(self):
+        while True:
+            job = _pop_fair_lane(self._lanes)
+            if job is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            self._running.add(job)
+            self._notify_positions()
+            start_time = time.monotonic()
+            try:
+                result = await _request_images(job.prompt, job.sample_count, guild_id=job.guild_id, user_id=job.user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.attempts += 1
+                if is_transient_upstream_error(e) and job.attempts < IMAGE_JOB_MAX_ATTEMPTS:
+                    delay = e.retry_in if isinstance(e, CircuitOpenError) else IMAGE_JOB_RETRY_DELAY * job.attempts
+                    log.warning(f"Image job hit a transient failure ({e}); re-queuing in {delay:.1f}s")
+                    self._running.discard(job)
+                    self.requeued += 1
+                    for waiter in job.waiters:
+                        self._notify(waiter, None, delay)
+                    job.requeue_handle = asyncio.get_running_loop().call_later(delay, self._requeue, job)
+                    continue
+                log.error(f"Image job failed: {e}")
+                result = _image_error_result(e)
             else:
-                print(f"All {max_retries} retries failed for prompt: \"{prompt[:50]}...\"")
-    
-    return f"Failed to generate image after {max_retries} attempts. Please check logs."
+                if not result.from_cache:
+                    self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * (time.monotonic() - start_time)
+            finally:
+                self._running.discard(job)
+            del self._jobs[job.key]
+            if result.ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            for waiter in job.waiters:
+                self._spawn(self._deliver(waiter, result))
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.worker_count,
+            "running": len(self._running),
+            "queue_depth": self.queue_depth(),
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "requeued": self.requeued,
+            "avg_job_seconds": self._avg_job_seconds
+        }
+
+image_job_queue = ImageJobQueue(IMAGE_JOB_WORKERS, IMAGE_JOB_QUEUE_MAX)
+
+def get_image_job_queue_stats() -> dict:
+    stats = image_job_queue.stats()
+    stats["disk_cache"] = image_cache.stats() if image_cache is not None else None
+    return stats
 
 # --- Bot Events ---
 @bot.event
 async def on_application_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     """Handles errors from slash commands."""
+    command_name = interaction.command.name if interaction.command else "unknown"
+    is_rate_limited = isinstance(error, (app_commands.CommandOnCooldown, RateLimitExceeded))
+    command_count.inc(command=command_name, outcome="rate_limited" if is_rate_limited else "error")
     try:
-        if isinstance(error, app_commands.CommandOnCooldown):
+        if is_rate_limited:
             if not interaction.response.is_done():
                 await interaction.response.send_message(
                     f"You are on cooldown. Try again in {error.retry_after:.1f} seconds.",
@@ -354,8 +3392,7 @@ async def on_application_command_error(interaction: discord.Interaction, error:
             return
         
         error_message_str = str(error)
-        print(f"Unhandled command error: {error_message_str}")
-        print(f"Error type: {type(error)}")
+        log.error(f"Unhandled command error: {error_message_str}", exc_info=error, extra={"fields": {"command": command_name, "error_type": type(error).__name__}})
         
         user_error_message = "An unexpected error occurred with that command."
         
@@ -375,7 +3412,7 @@ async def on_application_command_error(interaction: discord.Interaction, error:
             await interaction.followup.send(user_error_message, ephemeral=True)
 
     except Exception as e_handler:
-        print(f"Error in on_application_command_error handler itself: {e_handler}")
+        log.error(f"Error in on_application_command_error handler itself: {e_handler}")
         try:
             # Fallback message
             fallback_msg = "An error occurred processing your command and handling the error."
@@ -388,17 +3425,136 @@ async def on_application_command_error(interaction: discord.Interaction, error:
         except Exception:
             pass
 
+# discord.py reports slash command errors through the command tree rather than a bot event.
+bot.tree.on_error = on_application_command_error
+
 @bot.event
-async def on_ready():
-    """Event that runs when the bot is ready and connected to Discord."""
-    print(f'Logged in as {bot.user.name} (ID: {bot.user.id})')
-    print('------')
-    load_guild_conversation_histories()
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    """Records how long each successful slash command took, measured from when the user invoked it."""
+    command_latency.observe((discord.utils.utcnow() - interaction.created_at).total_seconds(), command=command.name)
+    command_count.inc(command=command.name, outcome="ok")
+
+# One-time startup state. on_ready fires again whenever the gateway opens a new session, so
+# everything that should happen once per process is guarded by bot_initialized.
+bot_initialized = False
+command_sync_task = None
+startup_metrics = {
+    "setup_hook_seconds": None,
+    "time_to_ready_seconds": None,
+    "ready_events": 0,
+    "command_sync": None, # "synced", "skipped" or "failed"
+    "command_sync_seconds": None
+}
+
+def get_startup_metrics() -> dict:
+    return dict(startup_metrics)
+
+# Every subsystem's stats are exported on the metrics endpoint next to the request metrics.
+for stats_section, stats_function in {
+    "http_pool": get_http_pool_stats,
+    "upstream": get_upstream_health_stats,
+    "scheduler": get_upstream_scheduler_stats,
+    "rate_limit": get_rate_limit_stats,
+    "response_cache": get_response_cache_stats,
+    "coalescing": get_coalescing_stats,
+    "model_routing": get_model_routing_stats,
+    "search_cache": lambda: search_cache.stats(), # set_search_backend replaces search_cache
+    "guild_history_cache": get_guild_history_cache_stats,
+    "dm_history_cache": get_dm_history_cache_stats,
+    "dm_history_flush": get_dm_history_flush_stats,
+    "image_jobs": get_image_job_queue_stats,
+    "event_loop": get_event_loop_stats,
+    "context_cache": get_context_cache_stats,
+    "startup": get_startup_metrics
+}.items():
+    metrics.add_stats_source(stats_section, stats_function)
+
+def _command_tree_hash():
+    """Hashes the slash command definitions together with the application they are registered to."""
+    command_payloads = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda c: c["name"])
+    key_material = json.dumps([bot.application_id, command_payloads], sort_keys=True)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+def _read_command_tree_hash():
+    try:
+        with open(COMMAND_SYNC_HASH_FILE, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _write_command_tree_hash(command_hash):
+    with open(COMMAND_SYNC_HASH_FILE, 'w') as f:
+        f.write(command_hash)
+
+async def sync_command_tree_if_changed():
+    """Syncs slash commands only when their definitions changed since the last successful sync."""
+    start_time = time.perf_counter()
     try:
+        command_hash = _command_tree_hash()
+        if not FORCE_COMMAND_SYNC and await asyncio.to_thread(_read_command_tree_hash) == command_hash:
+            startup_metrics["command_sync"] = "skipped"
+            log.info("Slash commands unchanged since the last sync; skipping sync.")
+            return
         synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} slash command(s)")
+        await asyncio.to_thread(_write_command_tree_hash, command_hash)
+        startup_metrics["command_sync"] = "synced"
+        log.info(f"Synced {len(synced)} slash command(s)")
     except Exception as e:
-        print(f"Error syncing slash commands: {e}")
+        startup_metrics["command_sync"] = "failed"
+        log.error(f"Error syncing slash commands: {e}")
+    finally:
+        startup_metrics["command_sync_seconds"] = time.perf_counter() - start_time
+
+@bot.event
+async def setup_hook():
+    """Runs once before the bot connects; creates long-lived shared resources."""
+    global guild_history_flush_task, dm_history_flush_task
+    start_time = time.perf_counter()
+    await get_http_session()
+    await asyncio.to_thread(prepare_guild_history_storage)
+    guild_personas.update(await asyncio.to_thread(load_guild_personas))
+    guild_history_flush_task = asyncio.create_task(guild_history_flush_loop())
+    dm_history_flush_task = asyncio.create_task(dm_history_flush_loop())
+    image_job_queue.start()
+    loop_watchdog.start()
+    await start_metrics_server()
+    startup_metrics["setup_hook_seconds"] = time.perf_counter() - start_time
+
+async def close_bot_resources():
+    """Stops background tasks, flushes pending writes and closes shared resources."""
+    for task in (guild_history_flush_task, dm_history_flush_task, command_sync_task):
+        if task is not None:
+            task.cancel()
+    await image_job_queue.close()
+    loop_watchdog.stop()
+    await flush_guild_histories()
+    await flush_dm_histories()
+    await stop_metrics_server()
+    await context_cache.close()
+    await close_http_session()
+    state_backend.close()
+    image_worker_pool.shutdown(wait=False)
+    blocking_worker_pool.shutdown(wait=False)
+
+@bot.event
+async def on_ready():
+    """Event that runs when the bot is ready and connected to Discord."""
+    global bot_initialized, command_sync_task
+    startup_metrics["ready_events"] += 1
+    if bot_initialized:
+        log.info(f"Reconnected as {bot.user.name} (ready event #{startup_metrics['ready_events']}); skipping startup tasks.")
+        return
+    bot_initialized = True
+    startup_metrics["time_to_ready_seconds"] = time.monotonic() - bot_start_time
+    log.info(f"Logged in as {bot.user.name} (ID: {bot.user.id})")
+    log.info(f"Ready in {startup_metrics['time_to_ready_seconds']:.2f}s (setup took {startup_metrics['setup_hook_seconds'] or 0:.2f}s)", extra={"fields": {"time_to_ready_seconds": startup_metrics["time_to_ready_seconds"], "setup_hook_seconds": startup_metrics["setup_hook_seconds"]}})
+    shard_ids = getattr(bot, "shard_ids", None)
+    if shard_ids is not None:
+        log.info(f"Running shard(s) {', '.join(map(str, shard_ids))} of {bot.shard_count}")
+    # Commands are global, so only the process running shard 0 (or the only process) syncs them.
+    # Syncing runs in the background so a slow or rate-limited sync never delays handling commands.
+    if shard_ids is None or 0 in shard_ids:
+        command_sync_task = asyncio.create_task(sync_command_tree_if_changed())
 
 # --- Helper for Permission Check ---
 def can_use_command(interaction: discord.Interaction) -> bool:
@@ -414,160 +3570,372 @@ def can_use_command(interaction: discord.Interaction) -> bool:
     # return False # Or True if you want to allow by default
     return True # Currently allows everyone
 
+# --- Reply Delivery ---
+# Discord's limits for one message.
+DISCORD_EMBED_FIELD_LIMIT = 1024
+DISCORD_EMBED_DESCRIPTION_LIMIT = 4096
+DISCORD_MESSAGE_EMBED_LIMIT = 10
+DISCORD_MESSAGE_EMBED_CHARS = 6000 # Total across all embeds in one message
+_CODE_FENCE_PATTERN = re.compile(r"^[ \t]*```([^\s`]*)", re.M)
+reply_delivery_locks = weakref.WeakValueDictionary() # channel (or DM user) id -> lock held while a multi-message reply is sent
+
+def _open_code_block(text):
+    """Returns the language of the code block left open at the end of text ("" if it has none), or None if all are closed."""
+    language = None
+    for match in _CODE_FENCE_PATTERN.finditer(text):
+        language = match.group(1) if language is None else None
+    return language
+
+def split_markdown_once(text, limit):
+    """
+    Cuts one chunk of at most limit characters off text, preferring paragraph, line, sentence and word
+    boundaries. A code block cut in two is closed at the end of the chunk and reopened at the start of
+    the rest. Returns (chunk, rest).
+    """
+    if len(text) <= limit:
+        return text, ""
+    window = text[:limit - 4] # Leaves room to close a code block
+    cut = len(window)
+    for separator in ("\n\n", "\n", ". ", " "):
+        index = window.rfind(separator)
+        if index >= len(window) // 2:
+            cut = index + len(separator)
+            break
+    chunk, rest = text[:cut], text[cut:]
+    language = _open_code_block(chunk)
+    if language is None:
+        return chunk.rstrip(), rest.lstrip()
+    return chunk.rstrip("\n") + "\n```", f"```{language}\n" + rest.lstrip("\n")
+
+def pack_reply_chunks(text, first_message_room):
+    """
+    Splits text into continuation embed descriptions and groups them into as few messages as Discord's
+    limits allow. The first group shares its message with the reply embed, which leaves first_message_room
+    characters and one embed fewer. Returns one list of descriptions per message.
+    """
+    pages = [[]]
+    room = first_message_room
+    embed_limit = DISCORD_MESSAGE_EMBED_LIMIT - 1
+    while text:
+        if len(pages[-1]) >= embed_limit or room < REPLY_MIN_EMBED_CHARS:
+            pages.append([])
+            room = DISCORD_MESSAGE_EMBED_CHARS
+            embed_limit = DISCORD_MESSAGE_EMBED_LIMIT
+        chunk, text = split_markdown_once(text, min(DISCORD_EMBED_DESCRIPTION_LIMIT, room))
+        if not chunk.strip():
+            continue # Whitespace between splits; Discord rejects empty descriptions
+        pages[-1].append(chunk)
+        room -= len(chunk)
+    return pages
+
+def layout_reply(embed, field_index, text, empty_text, allow_file=True):
+    """
+    Puts the start of a reply into the embed's field and lays out the rest with pack_reply_chunks.
+    Replies over REPLY_FILE_THRESHOLD are attached as a file instead when allow_file is set.
+    Returns (pages, attach_file).
+    """
+    head, rest = split_markdown_once(text, DISCORD_EMBED_FIELD_LIMIT - 3)
+    embed.set_field_at(field_index, name=embed.fields[field_index].name, value=(head + "..." if rest else head) or empty_text, inline=False)
+    if allow_file and len(text) > REPLY_FILE_THRESHOLD:
+        embed.add_field(name="Full Reply", value=f"Attached as {REPLY_FILE_NAME} ({len(text):,} characters).", inline=False)
+        return [[]], True
+    if not rest:
+        return [[]], False
+    return pack_reply_chunks(rest, DISCORD_MESSAGE_EMBED_CHARS - len(embed)), False
+
+def continuation_embeds(page):
+    return [discord.Embed(description=chunk, color=discord.Color.orange()) for chunk in page]
+
+def reply_file(text):
+    return discord.File(io.BytesIO(text.encode("utf-8")), filename=REPLY_FILE_NAME)
+
+def reply_delivery_lock(interaction):
+    """Keeps the messages of one reply together when several multi-message replies go to a channel at once."""
+    key = interaction.channel_id or interaction.user.id
+    lock = reply_delivery_locks.get(key)
+    if lock is None:
+        lock = reply_delivery_locks[key] = asyncio.Lock()
+    return lock
+
+async def deliver_reply(interaction: discord.Interaction, text: str, embed: discord.Embed, field_index: int, message=None, empty_text: str = "(No response)"):
+    """
+    Sends a reply in as few messages as possible: the embed carrying the start of the reply, followed by
+    continuation embeds packed up to Discord's per-message limits, or a .md attachment for very long replies.
+    The first message is edited into `message` when given, replacing any text content. Everything is laid out before the first request,
+    so the sends go out back to back, in order.
+    """
+    pages, attach_file = layout_reply(embed, field_index, text, empty_text)
+    messages = [[embed] + continuation_embeds(pages[0])] + [continuation_embeds(page) for page in pages[1:]]
+    first_message_fields = {"attachments" if message is not None else "files": [reply_file(text)]} if attach_file else {}
+    lock = reply_delivery_lock(interaction) if len(messages) > 1 else contextlib.nullcontext()
+    async with lock:
+        with span("discord_send"):
+            for index, embeds in enumerate(messages):
+                if index > 0:
+                    await interaction.followup.send(embeds=embeds)
+                elif message is not None:
+                    await message.edit(content=None, embeds=embeds, **first_message_fields)
+                else:
+                    await interaction.followup.send(embeds=embeds, **first_message_fields)
+
+# --- Streaming Delivery ---
+async def deliver_streamed_response(interaction: discord.Interaction, message, embed: discord.Embed, field_index: int, response_stream) -> str:
+    """
+    Progressively edits an already-sent embed message as streamed text arrives. The text is laid out like
+    deliver_reply lays out a finished reply: continuation embeds go on the same message first and then on
+    extra messages, which are edited the same way. Edits are spaced by AI_STREAM_EDIT_INTERVAL to stay inside
+    Discord's limits. A reply that ends up over REPLY_FILE_THRESHOLD is attached as a file once it is complete.
+    A StreamNotice takes the reply's place if no text arrived before it, and is sent as its own message otherwise.
+    Returns the full response text.
+    """
+    overflow_messages = []
+    notice = None
+    shown_head = embed.fields[field_index].value
+    shown_pages = [[]]
+    response_text = ""
+    last_edit_time = 0.0
+
+    async def render(final=False):
+        nonlocal shown_head, shown_pages
+        # While streaming, text past the file threshold is held back; the finished reply becomes a file.
+        visible_text = response_text if final else response_text[:REPLY_FILE_THRESHOLD]
+        pages, attach_file = layout_reply(embed, field_index, visible_text, "(No response)", allow_file=final)
+        if attach_file:
+            await message.edit(embeds=[embed], attachments=[reply_file(response_text)])
+            for overflow_message in overflow_messages:
+                await overflow_message.delete()
+            return
+        head = embed.fields[field_index].value
+        if head != shown_head or pages[0] != shown_pages[0]:
+            await message.edit(embeds=[embed] + continuation_embeds(pages[0]))
+        for i, page in enumerate(pages[1:]):
+            if i >= len(overflow_messages):
+                overflow_messages.append(await interaction.followup.send(embeds=continuation_embeds(page)))
+            elif page != shown_pages[i + 1]:
+                await overflow_messages[i].edit(embeds=continuation_embeds(page))
+        shown_head, shown_pages = head, pages
+
+    async for piece in response_stream:
+        if isinstance(piece, StreamNotice):
+            notice = piece
+            continue
+        response_text += piece
+        now = time.monotonic()
+        if now - last_edit_time >= AI_STREAM_EDIT_INTERVAL:
+            with span("discord_send"):
+                await render()
+            last_edit_time = time.monotonic()
+    if notice is not None and not response_text:
+        response_text, notice = notice, None
+    with span("discord_send"):
+        await render(final=True)
+        if notice is not None:
+            notice_embed = discord.Embed(title="Reply Interrupted", description=notice, color=discord.Color.red())
+            notice_embed.set_footer(text="Made by @visualtfx <3")
+            await interaction.followup.send(embed=notice_embed)
+    return response_text
+
 # --- Slash Commands ---
 # Define your cooldown bypass user IDs here. Example: [12345, 67890]
-COOLDOWN_BYPASS_USER_IDS = [0] # Replace 0 with actual user IDs or leave empty if not needed
-
-@bot.tree.command(name="ai", description="Chat with Gemini 2.5 Pro. Optionally, enable web search.")
-@app_commands.describe(prompt="Your message or query for the AI.", search="Set to True to allow the AI to search the web based on your prompt.")
-@app_commands.checks.cooldown(1, 5.0, key=lambda i: (i.guild_id, i.user.id) if i.user.id not in COOLDOWN_BYPASS_USER_IDS else None)
-async def ai_command(interaction: discord.Interaction, prompt: str, search: bool = False):
+COOLDOWN_BYPASS_USER_IDS = [0] # Users exempt from per-user and per-guild rate limits. Replace 0 with actual user IDs or leave empty if not needed
+
+MODEL_CHOICES = [
+    app_commands.Choice(name="Auto (fast model for simple questions)", value="auto"),
+    app_commands.Choice(name="Fast (Gemini Flash)", value="fast"),
+    app_commands.Choice(name="Pro (Gemini Pro)", value="pro")
+]
+
+@bot.tree.command(name="ai", description="Chat with Gemini (Pro, or Flash for quick questions). Optionally, enable web search.")
+@app_commands.describe(prompt="Your message or query for the AI.", search="Set to True to allow the AI to search the web based on your prompt.", model="Which model answers. Auto picks one from your prompt.")
+@app_commands.choices(model=MODEL_CHOICES)
+@rate_limited("gemini", ai_request_cost)
+async def ai_command(interaction: discord.Interaction, prompt: str, search: bool = False, model: app_commands.Choice[str] = None):
     """Handles the /ai slash command."""
     if not can_use_command(interaction):
         await interaction.response.send_message("Sorry, you don't have permission to use this command here.", ephemeral=True)
         return
 
-    await interaction.response.defer(ephemeral=False)
+    with span("discord_defer"):
+        await interaction.response.defer(ephemeral=False)
 
     is_dm_context = interaction.guild is None
     guild_id_context = interaction.guild.id if interaction.guild else None
     user_id_context = interaction.user.id
+    context_key = get_conversation_context_key(interaction)
+    model_tier = model.value if model else None
+
+    def footer_text(model_name):
+        return f"Made by @visualtfx <3 | Interacting with: {interaction.user.display_name} | Model: {model_name} | Search: {'Enabled' if search else 'Disabled'}"
+
+    if AI_STREAM_RESPONSES:
+        embed = discord.Embed(title="AI Response (Gemini)", color=discord.Color.orange())
+        embed.add_field(name="You Asked", value=prompt if len(prompt) < 1024 else prompt[:1020]+"...", inline=False)
+        embed.add_field(name="AI Says", value="(Thinking...)", inline=False)
+        embed.set_footer(text=footer_text(model.name if model else "Auto"))
+        message = await interaction.followup.send(embed=embed)
+
+        async def show_stream_queue_position(position, estimated_wait):
+            embed.set_field_at(1, name="AI Says", value=format_queue_status(position, estimated_wait), inline=False)
+            await message.edit(embed=embed)
+
+        # The footer shows the answering model from the next edit on.
+        response_stream = stream_ai_response(
+            prompt, search, guild_id_context, user_id_context, is_dm_context, token_budget=AI_HISTORY_TOKEN_BUDGET, on_queued=show_stream_queue_position,
+            use_cache=response_cache_enabled_for("ai"), context_key=context_key, model_tier=model_tier, on_model=lambda model_name: embed.set_footer(text=footer_text(model_name))
+        )
+        await deliver_streamed_response(interaction, message, embed, 1, response_stream)
+        return
 
-    ai_response = await get_ai_response(prompt, search, guild_id_context, user_id_context, is_dm_context)
+    queue_status_shown = False
 
-    embed = discord.Embed(title="AI Response (Gemini 2.5 Pro)", color=discord.Color.orange())
-    embed.add_field(name="You Asked", value=prompt if len(prompt) < 1024 else prompt[:1020]+"...", inline=False)
-    
-    first_chunk_max_len = 1020 
-    response_first_chunk = ai_response[:first_chunk_max_len]
-    if len(ai_response) > first_chunk_max_len:
-        response_first_chunk += "..."
-    
-    embed.add_field(name="AI Says", value=response_first_chunk if response_first_chunk else "(No response)", inline=False)
-    embed.set_footer(text=f"Made by @visualtfx <3 | Interacting with: {interaction.user.display_name} | Model: gemini-2.5-pro-preview-05-06 | Search: {'Enabled' if search else 'Disabled'}")
-    
-    await interaction.followup.send(embed=embed)
+    async def show_queue_position(position, estimated_wait):
+        nonlocal queue_status_shown
+        queue_status_shown = True
+        await interaction.edit_original_response(content=format_queue_status(position, estimated_wait))
 
-    if len(ai_response) > first_chunk_max_len:
-        remaining_response = ai_response[first_chunk_max_len:]
-        for i in range(0, len(remaining_response), 1980): 
-            chunk = remaining_response[i:i+1980]
-            await interaction.followup.send(content=chunk)
+    answering_models = []
+    ai_response = await get_ai_response(
+        prompt, search, guild_id_context, user_id_context, is_dm_context, token_budget=AI_HISTORY_TOKEN_BUDGET, on_queued=show_queue_position,
+        use_cache=response_cache_enabled_for("ai"), context_key=context_key, model_tier=model_tier, on_model=answering_models.append
+    )
+
+    embed = discord.Embed(title="AI Response (Gemini)", color=discord.Color.orange())
+    embed.add_field(name="You Asked", value=prompt if len(prompt) < 1024 else prompt[:1020]+"...", inline=False)
+    embed.add_field(name="AI Says", value="(No response)", inline=False)
+    embed.set_footer(text=footer_text(answering_models[-1] if answering_models else "none"))
+    # The queue status took the place of the deferred response, so the reply replaces it there.
+    await deliver_reply(interaction, ai_response, embed, 1, message=await interaction.original_response() if queue_status_shown else None)
 
 
-@bot.tree.command(name="aiupload", description="Send an image (and optional text) to Gemini 2.5 Pro. Optionally enable web search.")
-@app_commands.describe(image="Upload an image for the AI to see.", text="Optional text or question about the image. This will be searched if 'search' is True.", search="Set to True to search the web based on your 'text' field content.")
-@app_commands.checks.cooldown(1, 15.0, key=lambda i: (i.guild_id, i.user.id) if i.user.id not in COOLDOWN_BYPASS_USER_IDS else None)
-async def aiupload_command(interaction: discord.Interaction, image: discord.Attachment, text: str = None, search: bool = False):
+@bot.tree.command(name="aiupload", description="Send an image (and optional text) to Gemini. Optionally enable web search.")
+@app_commands.describe(image="Upload an image for the AI to see.", text="Optional text or question about the image. This will be searched if 'search' is True.", search="Set to True to search the web based on your 'text' field content.", model="Which model answers. Auto picks one from your text.")
+@app_commands.choices(model=MODEL_CHOICES)
+@rate_limited("gemini", aiupload_request_cost, rejection=lambda namespace: aiupload_request_rejection(namespace.image, namespace.text, namespace.search))
+async def aiupload_command(interaction: discord.Interaction, image: discord.Attachment, text: str = None, search: bool = False, model: app_commands.Choice[str] = None):
     """Handles the /aiupload slash command for multimodal input."""
     if not can_use_command(interaction):
         await interaction.response.send_message("Sorry, you don't have permission to use this command here.", ephemeral=True)
         return
 
-    if not image.content_type or not image.content_type.startswith('image/'):
-        await interaction.response.send_message("Please upload a valid image file (e.g., PNG, JPG, GIF).", ephemeral=True)
+    rejection = aiupload_request_rejection(image, text, search)
+    if rejection:
+        await interaction.response.send_message(rejection, ephemeral=True)
         return
 
-    await interaction.response.defer(ephemeral=False)
-
-    if search and (not text or not text.strip()):
-        await interaction.followup.send("To use web search with an image, please also provide some text for the search query in the 'text' field.", ephemeral=True)
-        return
+    with span("discord_defer"):
+        await interaction.response.defer(ephemeral=False)
 
     search_status_footer_text = "Disabled"
     if search and text and text.strip(): search_status_footer_text = "Enabled"
         
-    processing_message_embed = discord.Embed(title="AI Vision Processing (Gemini 2.5 Pro)...", description="The AI is looking at your image. This might take a moment.", color=discord.Color.orange())
+    processing_message_embed = discord.Embed(title="AI Vision Processing (Gemini)...", description="The AI is looking at your image. This might take a moment.", color=discord.Color.orange())
     if image.url: processing_message_embed.set_thumbnail(url=image.url)
-    processing_message_embed.set_footer(text=f"Made by @visualtfx <3 | Requested by: {interaction.user.display_name} | Model: gemini-2.5-pro-preview-05-06 | Search: {search_status_footer_text}")
+    processing_message_embed.set_footer(text=f"Made by @visualtfx <3 | Requested by: {interaction.user.display_name} | Model: {model.name if model else 'Auto'} | Search: {search_status_footer_text}")
     
     processing_message_handle = await interaction.followup.send(embed=processing_message_embed)
 
     try:
         image_bytes = await image.read()
     except Exception as e:
-        print(f"Error reading attachment: {e}")
+        log.error(f"Error reading attachment: {e}")
         error_embed = discord.Embed(title="Error", description="Sorry, I couldn't read the uploaded image file.", color=discord.Color.red())
         error_embed.set_footer(text="Made by @visualtfx <3")
         await processing_message_handle.edit(embed=error_embed)
         return
 
-    ai_vision_response = await get_multimodal_ai_response(image_bytes, image.content_type, text, search)
+    async def show_queue_position(position, estimated_wait):
+        processing_message_embed.description = format_queue_status(position, estimated_wait)
+        await processing_message_handle.edit(embed=processing_message_embed)
 
-    reply_embed = discord.Embed(title="AI Vision Response (Gemini 2.5 Pro)", color=discord.Color.orange())
+    guild_id_context = interaction.guild.id if interaction.guild else None
+    answering_models = []
+    ai_vision_response = await get_multimodal_ai_response(
+        image_bytes, image.content_type, text, search, guild_id=guild_id_context, user_id=interaction.user.id, on_queued=show_queue_position,
+        use_cache=response_cache_enabled_for("aiupload"), model_tier=model.value if model else None, on_model=answering_models.append
+    )
+
+    reply_embed = discord.Embed(title="AI Vision Response (Gemini)", color=discord.Color.orange())
     if text:
         reply_embed.add_field(name="Your Question/Text", value=text if len(text) < 1024 else text[:1020]+"...", inline=False)
-    
-    first_chunk_max_len = 1020
-    response_first_chunk = ai_vision_response[:first_chunk_max_len]
-    if len(ai_vision_response) > first_chunk_max_len:
-        response_first_chunk += "..."
-        
-    reply_embed.add_field(name="AI's Response", value=response_first_chunk if response_first_chunk else "(No text response generated)", inline=False)
+    reply_embed.add_field(name="AI's Response", value="(No text response generated)", inline=False)
     
     if image.url: reply_embed.set_image(url=image.url) 
-    reply_embed.set_footer(text=f"Made by @visualtfx <3 | Processed for: {interaction.user.display_name} | Model: gemini-2.5-pro-preview-05-06 | Search: {search_status_footer_text}")
-
-    await processing_message_handle.edit(embed=reply_embed)
+    reply_embed.set_footer(text=f"Made by @visualtfx <3 | Processed for: {interaction.user.display_name} | Model: {answering_models[-1] if answering_models else 'none'} | Search: {search_status_footer_text}")
 
-    if len(ai_vision_response) > first_chunk_max_len:
-        remaining_response = ai_vision_response[first_chunk_max_len:]
-        for i in range(0, len(remaining_response), 1980):
-            chunk = remaining_response[i:i+1980]
-            await interaction.followup.send(content=chunk)
+    await deliver_reply(interaction, ai_vision_response, reply_embed, len(reply_embed.fields) - 1, message=processing_message_handle, empty_text="(No text response generated)")
 
 
 @bot.tree.command(name="generateimage", description="Generates an image based on your prompt using AI (Imagen 3).")
-@app_commands.checks.cooldown(1, 45.0, key=lambda i: (i.guild_id, i.user.id) if i.user.id not in COOLDOWN_BYPASS_USER_IDS else None)
-async def generateimage_command(interaction: discord.Interaction, prompt: str):
+@app_commands.describe(prompt="Describe the image you want.", variants=f"How many variations to generate (1-{IMAGE_MAX_VARIANTS}).")
+@rate_limited("imagen", generateimage_request_cost, rejection=lambda namespace: generateimage_request_rejection(namespace.prompt))
+async def generateimage_command(interaction: discord.Interaction, prompt: str, variants: app_commands.Range[int, 1, IMAGE_MAX_VARIANTS] = 1):
     """Handles the /generateimage slash command."""
     if not can_use_command(interaction):
         await interaction.response.send_message("Sorry, you don't have permission to use this command here.", ephemeral=True)
         return
 
-    if not prompt or not prompt.strip():
-        await interaction.response.send_message("Please provide a prompt to generate an image.", ephemeral=True)
+    rejection = generateimage_request_rejection(prompt)
+    if rejection:
+        await interaction.response.send_message(rejection, ephemeral=True)
         return
 
-    await interaction.response.defer(ephemeral=False)
+    with span("discord_defer"):
+        await interaction.response.defer(ephemeral=False)
 
+    prompt_preview = f"\"{prompt[:100]}{'...' if len(prompt) > 100 else ''}\""
     generating_embed = discord.Embed(
         title="🎨 Image Generation in Progress (Imagen 3)...",
-        description=f"Requesting an image for: \"{prompt[:100]}{'...' if len(prompt) > 100 else ''}\"",
+        description=f"Requesting {'an image' if variants == 1 else f'{variants} images'} for: {prompt_preview}",
         color=discord.Color.light_grey()
     )
     generating_embed.set_footer(text=f"Made by @visualtfx <3 | Requested by: {interaction.user.display_name}")
     status_message = await interaction.followup.send(embed=generating_embed)
+    request_description = generating_embed.description
 
-    base64_image_data_or_error_msg = await generate_image_from_prompt(prompt, max_retries=3, backoff_factor=1.0)
-
-    if base64_image_data_or_error_msg:
-        if base64_image_data_or_error_msg.startswith(("Failed to generate image:", "Image generation failed:", "Image generation blocked.", "Sorry, an unexpected error occurred")):
-            error_embed = discord.Embed(title="Image Generation Failed", description=base64_image_data_or_error_msg, color=discord.Color.red())
+    async def show_queue_position(position, estimated_wait):
+        if position is None:
+            status = f"⚠️ The image service is busy; retrying in ~{max(1, round(estimated_wait))}s"
+        elif position == 0:
+            status = "🖌️ Generating now..."
+        else:
+            status = format_queue_status(position, estimated_wait)
+        generating_embed.description = f"{request_description}\n{status}"
+        await status_message.edit(embed=generating_embed)
+
+    async def deliver_images(result):
+        # Runs on an image queue worker once the job finishes; the interaction itself has long returned.
+        if not result.ok:
+            error_embed = discord.Embed(title="Image Generation Failed", description=result.error or "No image data was returned from the AI, and no specific error message was provided.", color=discord.Color.red())
             error_embed.set_footer(text=f"Made by @visualtfx <3 | Attempted prompt by {interaction.user.display_name}: {prompt[:100]}{'...' if len(prompt) > 100 else ''}")
             await status_message.edit(embed=error_embed)
             return
 
-        try:
-            image_bytes = base64.b64decode(base64_image_data_or_error_msg)
-            image_file_obj = io.BytesIO(image_bytes)
-            discord_image_file = discord.File(fp=image_file_obj, filename="generated_image.png")
+        # BytesIO shares the decoded bytes rather than copying them, even when several waiters get the same images.
+        image_files = [
+            discord.File(fp=io.BytesIO(image_bytes), filename=f"generated_image_{index}.png")
+            for index, image_bytes in enumerate(result.images, start=1)
+        ]
 
-            embed = discord.Embed(title="🖼️ Image Generated! (Imagen 3)", color=discord.Color.orange())
-            embed.set_image(url="attachment://generated_image.png")
-            embed.add_field(name="Prompt", value=prompt if len(prompt) < 1024 else prompt[:1020]+"...", inline=False)
-            embed.set_footer(text=f"Made by @visualtfx <3 | Generated for: {interaction.user.display_name}")
+        embed = discord.Embed(title="🖼️ Image Generated! (Imagen 3)" if len(image_files) == 1 else f"🖼️ {len(image_files)} Images Generated! (Imagen 3)", color=discord.Color.orange())
+        embed.set_image(url="attachment://generated_image_1.png")
+        embed.add_field(name="Prompt", value=prompt if len(prompt) < 1024 else prompt[:1020]+"...", inline=False)
+        embed.set_footer(text=f"Made by @visualtfx <3 | Generated for: {interaction.user.display_name}" + (f" | Model: {result.model}" if result.model else ""))
 
-            await status_message.edit(embed=embed, attachments=[discord_image_file])
+        try:
+            with span("discord_send"):
+                await status_message.edit(embed=embed, attachments=image_files)
         except Exception as e:
-            print(f"Error decoding or sending image: {e}")
-            error_embed = discord.Embed(title="Image Display Error", description="Could not decode or display the generated image.", color=discord.Color.red())
+            log.error(f"Error sending image: {e}")
+            error_embed = discord.Embed(title="Image Display Error", description="Could not display the generated image.", color=discord.Color.red())
             error_embed.set_footer(text="Made by @visualtfx <3")
             await status_message.edit(embed=error_embed)
-    else:
-        error_embed = discord.Embed(title="Image Generation Failed", description="No image data was returned from the AI, and no specific error message was provided.", color=discord.Color.red())
-        error_embed.set_footer(text="Made by @visualtfx <3")
-        await status_message.edit(embed=error_embed)
+
+    guild_id_context = interaction.guild.id if interaction.guild else None
+    position = image_job_queue.submit(prompt, variants, deliver_images, show_queue_position, guild_id=guild_id_context, user_id=interaction.user.id)
+    if position == -1:
+        busy_embed = discord.Embed(title="Image Queue Full", description="Too many images are being generated right now. Please try again in a few minutes.", color=discord.Color.red())
+        busy_embed.set_footer(text="Made by @visualtfx <3")
+        await status_message.edit(embed=busy_embed)
 
 
 @bot.tree.command(name="resetai", description="Resets your conversation history with the AI.")
@@ -579,36 +3947,83 @@ async def resetai_command(interaction: discord.Interaction):
 
     is_dm_context = interaction.guild is None
     user_id_context = interaction.user.id
-    guild_id_context = interaction.guild.id if interaction.guild else None
+    context_key = get_conversation_context_key(interaction)
 
     confirmation_message = ""
     if is_dm_context:
-        if user_id_context in dm_conversation_histories and dm_conversation_histories[user_id_context]:
-            dm_conversation_histories[user_id_context] = []
-            save_dm_conversation_history(user_id_context, [])
+        if await get_user_dm_history(user_id_context):
+            mark_dm_history_dirty(user_id_context)
+            dm_conversation_histories.set(user_id_context, [])
+            history_token_counts.pop(("dm", user_id_context), None)
+            context_cache.invalidate(("dm", user_id_context))
+            bump_conversation_reset_generation(("dm", user_id_context))
             confirmation_message = "Your DM conversation history with the AI has been reset."
         else:
             confirmation_message = "You have no DM conversation history with the AI to reset."
     else:
-        if guild_id_context in guild_conversation_histories and guild_conversation_histories[guild_id_context]:
-            guild_conversation_histories[guild_id_context] = []
-            save_guild_conversation_histories()
-            confirmation_message = f"The conversation history for this server ({interaction.guild.name}) with the AI has been reset."
+        context_name = f"this server ({interaction.guild.name})" if len(context_key) == 1 else "this channel"
+        if await get_guild_context_history(context_key):
+            queue_guild_history_record(context_key, {"op": "reset"})
+            guild_conversation_histories.set(context_key, [])
+            history_token_counts.pop(("guild", context_key), None)
+            context_cache.invalidate(("guild", context_key))
+            bump_conversation_reset_generation(("guild", context_key))
+            confirmation_message = f"The conversation history for {context_name} with the AI has been reset."
         else:
-            confirmation_message = f"There is no conversation history for this server ({interaction.guild.name}) with the AI to reset."
+            confirmation_message = f"There is no conversation history for {context_name} with the AI to reset."
     
     await interaction.response.send_message(confirmation_message, ephemeral=True)
 
+def format_event_loop_report() -> str:
+    """Summarizes loop lag and the most recent blocking stack samples for /debugloop."""
+    lag_summary = loop_lag.snapshot().get("total")
+    stats = loop_watchdog.stats()
+    lines = []
+    if lag_summary:
+        lines.append(f"Event loop lag: p50 {lag_summary['p50'] * 1000:.1f} ms | p95 {lag_summary['p95'] * 1000:.1f} ms | p99 {lag_summary['p99'] * 1000:.1f} ms | max {stats['max_lag_seconds'] * 1000:.1f} ms")
+    else:
+        lines.append("Event loop lag: no measurements yet.")
+    lines.append(f"Blocks over {LOOP_BLOCK_THRESHOLD * 1000:.0f} ms: {stats['blocks']}")
+    report = "\n".join(lines)
+    for sample in reversed(loop_watchdog.samples):
+        sampled_at = datetime.datetime.fromtimestamp(sample["at"], datetime.timezone.utc).strftime("%H:%M:%S UTC")
+        entry = f"\n**{sample['blocked_seconds'] * 1000:.0f} ms** in task `{sample['task']}` at {sampled_at}\n```py\n{''.join(sample['stack'])[-900:]}```"
+        if len(report) + len(entry) > 1990:
+            break
+        report += entry
+    return report
+
+@bot.tree.command(name="debugloop", description="Shows event loop lag and recent blocking stack samples (bot owner only).")
+async def debugloop_command(interaction: discord.Interaction):
+    """Handles the /debugloop slash command."""
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("Sorry, only the bot owner can use this command.", ephemeral=True)
+        return
+    await interaction.response.send_message(format_event_loop_report(), ephemeral=True)
+
 # --- Main Execution ---
 if __name__ == "__main__":
+    setup_bot_logging()
     # Basic check for placeholder tokens/keys
     if DISCORD_BOT_TOKEN == "YOUR_DISCORD_BOT_TOKEN_HERE" or \
        GEMINI_API_KEY == "YOUR_GEMINI_API_KEY_HERE" or \
        GOOGLE_API_KEY == "YOUR_GOOGLE_API_KEY_FOR_SEARCH_HERE" or \
        GOOGLE_CSE_ID == "YOUR_GOOGLE_CSE_ID_HERE":
-        print("ERROR: Bot token, API keys, or Google CSE ID might not be correctly configured.")
-        print("Please replace placeholder values (like 'YOUR_DISCORD_BOT_TOKEN_HERE') in the script,")
-        print("or ensure they are set as environment variables and accessible by the script's environment.")
-        print("The script will not run with placeholder values.")
+        log.error(
+            "Bot token, API keys, or Google CSE ID might not be correctly configured. "
+            "Please replace placeholder values (like 'YOUR_DISCORD_BOT_TOKEN_HERE') in the script, "
+            "or ensure they are set as environment variables and accessible by the script's environment. "
+            "The script will not run with placeholder values."
+        )
     else:
-        bot.run(DISCORD_BOT_TOKEN)
+        async def main():
+            async with bot:
+                try:
+                    await bot.start(DISCORD_BOT_TOKEN)
+                finally:
+                    await close_bot_resources()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+BOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="session")
+def bot():
+    """Imports the bot with placeholder credentials. It runs in a scratch directory so no real history files are touched."""
+    os.environ.update({
+        "DISCORD_BOT_TOKEN": "test",
+        "GEMINI_API_KEY": "test",
+        "GOOGLE_API_KEY": "test",
+        "GOOGLE_CSE_ID": "test",
+        "METRICS_PORT": "0",
+        "STATE_BACKEND_URL": "file"
+    })
+    os.chdir(tempfile.mkdtemp(prefix="discord-ai-bot-tests-"))
+    sys.path.insert(0, BOT_DIRECTORY)
+    import github as bot_module
+    return bot_module
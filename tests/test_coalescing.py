@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+def test_concurrent_calls_share_one_result(bot):
+    flight = bot.SingleFlight("test")
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        return await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["result"] * 5
+    assert len(calls) == 1
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 4}
+
+def test_none_key_is_never_shared(bot):
+    flight = bot.SingleFlight("test")
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(flight.do(None, work), flight.do(None, work))
+
+    asyncio.run(run())
+    assert len(calls) == 2 and flight.leaders == 0
+
+def test_finished_flight_is_not_joined(bot):
+    flight = bot.SingleFlight("test")
+
+    async def run():
+        future = flight.lead("key")
+        future.set_result("done")
+        # The done callback has not run yet, so the finished future is still registered.
+        assert flight.join("key") is None
+        await asyncio.sleep(0)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(run())
+
+def test_errors_reach_every_waiter(bot):
+    flight = bot.SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream failed")
+
+    async def run():
+        return await asyncio.gather(flight.do("key", work), flight.do("key", work), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight.coalesced == 1
+
+def test_cancelled_waiter_does_not_cancel_the_call(bot):
+    flight = bot.SingleFlight("test")
+
+    async def work():
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def run():
+        first = asyncio.create_task(flight.do("key", work))
+        second = asyncio.create_task(flight.do("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "result"
+
+def test_lead_and_join(bot):
+    flight = bot.SingleFlight("test")
+
+    async def run():
+        future = flight.lead("key")
+        joined = flight.join("key")
+        assert joined is future
+        future.set_result("answer")
+        return await joined
+
+    assert asyncio.run(run()) == "answer"
+
+def test_ai_search_flights_are_scoped_to_one_conversation(bot):
+    url = "https://example.com/generateContent"
+    dm_one = bot._ai_search_flight_key(url, "weather today", True, True, None, ("dm", 1))
+    dm_two = bot._ai_search_flight_key(url, "weather today", True, True, None, ("dm", 2))
+    channel = bot._ai_search_flight_key(url, "weather today", True, True, 10, ("guild", (10, 20)))
+    same_channel = bot._ai_search_flight_key(url, "Weather  today", True, True, 10, ("guild", (10, 20)))
+    assert dm_one != dm_two
+    assert channel == same_channel
+    assert bot._ai_search_flight_key(url, "weather today", True, False, 10, ("guild", (10, 20))) is None
+    assert bot._ai_search_flight_key(url, "weather today", False, True, 10, ("guild", (10, 20))) is None
+    assert bot._ai_search_flight_key(url, "  ", True, True, 10, ("guild", (10, 20))) is None
+
+def test_set_coalescing_key_rejects_unknown_call_types(bot):
+    with pytest.raises(ValueError):
+        bot.set_coalescing_key("video", lambda prompt: prompt)
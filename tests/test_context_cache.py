@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+import pytest
+
+KEY = ("dm", 1)
+MODEL = "gemini-pro"
+
+def conversation(turns):
+    return [{"role": "user" if index % 2 == 0 else "model", "parts": [{"text": f"{index:03d} " + "x" * 396}]} for index in range(turns)]
+
+@pytest.fixture
+def histories(bot, monkeypatch):
+    stored = {}
+    monkeypatch.setattr(bot, "_stored_history", stored.get)
+    return stored
+
+@pytest.fixture
+def manager(bot):
+    manager = bot.ContextCacheManager(enabled=True, ttl=100, min_tokens=100, max_uncached_tokens=1000)
+    manager.requests = []
+
+    async def request(method, path, fields=None):
+        manager.requests.append((method, path, fields))
+        return {"name": f"cachedContents/{len(manager.requests)}"} if method == "POST" else {}
+
+    manager._request = request
+    return manager
+
+async def refresh(manager, persona="persona", model=MODEL):
+    manager.schedule_refresh(KEY, model, persona)
+    await asyncio.gather(*manager._refresh_tasks.values())
+
+def test_short_conversations_are_not_cached(manager, histories):
+    histories[KEY] = conversation(3)
+    asyncio.run(refresh(manager))
+    assert manager.requests == []
+    assert manager.plan(KEY, MODEL, "persona", 10_000) is None
+
+def test_refresh_caches_older_turns(manager, histories):
+    history = histories[KEY] = conversation(10)
+    asyncio.run(refresh(manager))
+    (method, path, fields), = manager.requests
+    assert (method, path) == ("POST", "cachedContents")
+    assert fields["contents"] == history[:4] # Everything but the newest CONTEXT_CACHE_RECENT_ENTRIES, ending before a user turn
+    assert fields["systemInstruction"] == {"parts": [{"text": "persona"}]}
+    assert fields["model"] == f"models/{MODEL}"
+    assert manager.plan(KEY, MODEL, "persona", 10_000) == ("cachedContents/1", history[4:])
+    assert manager.stats()["hits"] == 1
+
+def test_plan_follows_new_turns(manager, histories):
+    history = histories[KEY] = conversation(10)
+    asyncio.run(refresh(manager))
+    history.extend(conversation(2))
+    name, tail = manager.plan(KEY, MODEL, "persona", 10_000)
+    assert tail == history[4:]
+    assert manager.plan(KEY, MODEL, "persona", 100) is None # The newer turns no longer fit the budget
+
+def test_refresh_extends_cache_nearing_expiry(manager, histories):
+    histories[KEY] = conversation(10)
+    asyncio.run(refresh(manager))
+    asyncio.run(refresh(manager))
+    assert len(manager.requests) == 1 # Fresh enough; nothing to do
+    manager._entries[KEY, MODEL].expires_at = time.monotonic() + 10
+    asyncio.run(refresh(manager))
+    assert manager.requests[-1][:2] == ("PATCH", "cachedContents/1?updateMask=ttl")
+    assert manager._entries[KEY, MODEL].expires_at > time.monotonic() + 90
+    assert manager.stats()["extended"] == 1
+
+def test_refresh_replaces_cache_once_too_much_is_uncached(manager, histories):
+    history = histories[KEY] = conversation(10)
+    asyncio.run(refresh(manager))
+    history.extend(conversation(10))
+
+    async def run():
+        await refresh(manager)
+        await asyncio.gather(*manager._background_tasks)
+    asyncio.run(run())
+    assert [request[:2] for request in manager.requests] == [("POST", "cachedContents"), ("POST", "cachedContents"), ("DELETE", "cachedContents/1")]
+    name, tail = manager.plan(KEY, MODEL, "persona", 10_000)
+    assert name == "cachedContents/2" and len(tail) < 10
+
+def test_expired_cache_is_forgotten_without_deleting(manager, histories):
+    histories[KEY] = conversation(10)
+    asyncio.run(refresh(manager))
+    manager._entries[KEY, MODEL].expires_at = time.monotonic() - 1
+    assert manager.plan(KEY, MODEL, "persona", 10_000) is None
+    assert (KEY, MODEL) not in manager._entries
+    assert len(manager.requests) == 1
+
+def test_reset_history_drops_cache(manager, histories):
+    histories[KEY] = conversation(10)
+
+    async def run():
+        await refresh(manager)
+        histories[KEY] = conversation(10) # Same text, but reloaded entries are new objects
+        assert manager.plan(KEY, MODEL, "persona", 10_000) is None
+        await asyncio.gather(*manager._background_tasks)
+    asyncio.run(run())
+    assert manager.requests[-1][:2] == ("DELETE", "cachedContents/1")
+    assert manager.stats()["invalidated"] == 1
+
+def test_persona_change_drops_cache(manager, histories):
+    histories[KEY] = conversation(10)
+
+    async def run():
+        await refresh(manager)
+        assert manager.plan(KEY, MODEL, "new persona", 10_000) is None
+        await asyncio.gather(*manager._background_tasks)
+    asyncio.run(run())
+    assert manager.requests[-1][:2] == ("DELETE", "cachedContents/1")
+
+def test_each_model_gets_its_own_cache(manager, histories):
+    history = histories[KEY] = conversation(10)
+
+    async def run():
+        await refresh(manager)
+        assert manager.plan(KEY, "gemini-flash", "persona", 10_000) is None
+        await refresh(manager, model="gemini-flash")
+        assert manager.plan(KEY, "gemini-flash", "persona", 10_000) == ("cachedContents/2", history[4:])
+        assert manager.plan(KEY, MODEL, "persona", 10_000) == ("cachedContents/1", history[4:])
+        manager.invalidate(KEY, "gemini-flash")
+        assert manager.plan(KEY, MODEL, "persona", 10_000) is not None
+        manager.invalidate(KEY)
+        await asyncio.gather(*manager._background_tasks)
+    asyncio.run(run())
+    assert [fields["model"] for method, path, fields in manager.requests if method == "POST"] == [f"models/{MODEL}", "models/gemini-flash"]
+    assert sorted(path for method, path, fields in manager.requests if method == "DELETE") == ["cachedContents/1", "cachedContents/2"]
+    assert manager.stats()["live"] == 0
+
+def test_close_deletes_live_caches(manager, histories):
+    histories[KEY] = conversation(10)
+
+    async def run():
+        await refresh(manager)
+        await manager.close()
+    asyncio.run(run())
+    assert manager.requests[-1][:2] == ("DELETE", "cachedContents/1")
+    assert manager.stats()["live"] == 0
+
+def test_disabled_manager_does_nothing(bot, histories):
+    manager = bot.ContextCacheManager(enabled=False)
+    histories[KEY] = conversation(10)
+    manager.schedule_refresh(KEY, MODEL, "persona")
+    assert manager.plan(KEY, MODEL, "persona", 10_000) is None
+    assert manager.stats()["misses"] == 0
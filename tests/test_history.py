@@ -0,0 +1,98 @@
+import asyncio
+import threading
+
+def entry(role, characters):
+    return {"role": role, "parts": [{"text": "x" * characters}]}
+
+def test_estimate_counts_characters_and_overhead(bot):
+    assert bot.estimate_entry_tokens(entry("user", 40)) == 40 // bot.CHARS_PER_TOKEN + 4
+
+def test_trim_keeps_newest_entries_within_budget(bot):
+    history = [entry("user", 400) for _ in range(5)] # 104 estimated tokens each
+    trimmed = bot.trim_history_to_budget(history, 250)
+    assert trimmed == history[-2:]
+
+def test_trim_always_keeps_latest_entry(bot):
+    history = [entry("user", 40), entry("model", 40_000)]
+    assert bot.trim_history_to_budget(history, 10) == history[-1:]
+
+def test_trim_caps_entry_count(bot):
+    history = [entry("user", 4) for _ in range(10)]
+    assert bot.trim_history_to_budget(history, 10_000, max_entries=3) == history[-3:]
+
+def test_trim_empty_history(bot):
+    assert bot.trim_history_to_budget([], 100) == []
+
+def test_replay_applies_resets_in_order(bot):
+    first, second = entry("user", 4), entry("model", 4)
+    records = [{"op": "append", "entry": first}, {"op": "reset"}, {"op": "append", "entry": second}]
+    assert bot._replay_history_records(records) == ([second], 3)
+
+def test_channel_context_starts_from_guild_history(bot):
+    guild_history = [entry("user", 8), entry("model", 8)]
+    bot.state_backend.replace_history("guild", (501,), guild_history)
+    bot.state_backend.replace_history("guild", (501, 2), [entry("user", 12)])
+
+    async def run():
+        seeded = await bot.get_guild_context_history((501, 1))
+        assert seeded == guild_history
+        own = await bot.get_guild_context_history((501, 2))
+        assert own == [entry("user", 12)]
+        await bot.flush_guild_histories()
+
+    asyncio.run(run())
+    # The seed is written to the channel's own log, and the guild-wide log is left as it was.
+    assert bot.state_backend.load_history("guild", (501, 1)) == (guild_history, 2)
+    assert bot.state_backend.load_history("guild", (501,)) == (guild_history, 2)
+
+def blocked_dm_writes(bot, monkeypatch):
+    """Holds every DM flush inside its threaded write until release is set."""
+    started, release = threading.Event(), threading.Event()
+    write = bot._write_dm_history_batch
+
+    def blocked_write(snapshots):
+        started.set()
+        release.wait(5)
+        write(snapshots)
+
+    monkeypatch.setattr(bot, "_write_dm_history_batch", blocked_write)
+    return started, release
+
+def test_dm_history_evicted_during_flush_is_persisted(bot, monkeypatch):
+    user_id = 7001
+    started, release = blocked_dm_writes(bot, monkeypatch)
+
+    async def run():
+        await bot.add_to_conversation_history("hello", "user", user_id=user_id, is_dm=True)
+        flush = asyncio.create_task(bot.flush_dm_histories())
+        await asyncio.to_thread(started.wait, 5)
+        bot.dm_conversation_histories._evict(user_id)
+        # Reachable while the write is in flight, so a reload does not read the stale store.
+        assert [e["parts"][0]["text"] for e in bot.evicted_dm_histories[user_id]] == ["hello"]
+        release.set()
+        await flush
+
+    asyncio.run(run())
+    assert user_id not in bot.evicted_dm_histories # Not resurrected once it is on disk
+    assert user_id not in bot.dirty_dm_history_user_ids
+    history, _ = bot.state_backend.load_history("dm", user_id)
+    assert [e["parts"][0]["text"] for e in history] == ["hello"]
+
+def test_dm_turn_added_after_eviction_during_flush_is_kept(bot, monkeypatch):
+    user_id = 7002
+    started, release = blocked_dm_writes(bot, monkeypatch)
+
+    async def run():
+        await bot.add_to_conversation_history("hello", "user", user_id=user_id, is_dm=True)
+        flush = asyncio.create_task(bot.flush_dm_histories())
+        await asyncio.to_thread(started.wait, 5)
+        bot.dm_conversation_histories._evict(user_id)
+        await bot.add_to_conversation_history("hi there", "model", user_id=user_id, is_dm=True)
+        release.set()
+        await flush
+        await bot.flush_dm_histories()
+
+    asyncio.run(run())
+    history, _ = bot.state_backend.load_history("dm", user_id)
+    assert [e["parts"][0]["text"] for e in history] == ["hello", "hi there"]
+    assert user_id not in bot.evicted_dm_histories
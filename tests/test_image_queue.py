@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+class FakeImagen:
+    """Stands in for _request_images; each call waits for release() unless auto_release is set."""
+
+    def __init__(self, bot, auto_release=True, failures=()):
+        self.bot = bot
+        self.calls = []
+        self.failures = list(failures)
+        self.released = asyncio.Event()
+        if auto_release:
+            self.released.set()
+
+    async def __call__(self, prompt, sample_count=1, **kwargs):
+        self.calls.append((prompt, sample_count))
+        await self.released.wait()
+        if self.failures:
+            raise self.failures.pop(0)
+        return self.bot.ImageGenerationResult(images=[b"png"] * sample_count, model="imagen")
+
+class Waiter:
+    def __init__(self):
+        self.results = []
+        self.positions = []
+        self.done = asyncio.Event()
+
+    async def deliver(self, result):
+        self.results.append(result)
+        self.done.set()
+
+    async def on_position(self, position, estimated_wait):
+        self.positions.append(position)
+
+@pytest.fixture
+def imagen(bot, monkeypatch):
+    def install(**kwargs):
+        fake = FakeImagen(bot, **kwargs)
+        monkeypatch.setattr(bot, "_request_images", fake)
+        return fake
+    return install
+
+def wait_all(waiters):
+    return asyncio.wait_for(asyncio.gather(*(waiter.done.wait() for waiter in waiters)), 1)
+
+def test_identical_prompts_share_one_job(bot, imagen):
+    fake = imagen()
+    queue = bot.ImageJobQueue(worker_count=1, max_pending=10)
+    waiters = [Waiter(), Waiter()]
+
+    async def run():
+        assert queue.submit("A red fox", 1, waiters[0].deliver, guild_id=1, user_id=1) == 1
+        assert queue.submit("a  red FOX", 1, waiters[1].deliver, guild_id=2, user_id=2) == 1
+        queue.start()
+        await wait_all(waiters)
+        await queue.close()
+
+    asyncio.run(run())
+    assert fake.calls == [("A red fox", 1)]
+    assert waiters[0].results[0] is waiters[1].results[0]
+    assert (queue.submitted, queue.deduplicated, queue.completed) == (1, 1, 1)
+
+def test_sample_counts_are_separate_jobs(bot, imagen):
+    fake = imagen()
+    queue = bot.ImageJobQueue(worker_count=1, max_pending=10)
+    waiters = [Waiter(), Waiter()]
+
+    async def run():
+        assert queue.submit("A red fox", 1, waiters[0].deliver) == 1
+        assert queue.submit("A red fox", 4, waiters[1].deliver) == 2
+        queue.start()
+        await wait_all(waiters)
+        await queue.close()
+
+    asyncio.run(run())
+    assert fake.calls == [("A red fox", 1), ("A red fox", 4)]
+    assert [len(waiter.results[0].images) for waiter in waiters] == [1, 4]
+    assert queue.deduplicated == 0
+
+def test_full_queue_turns_new_prompts_away(bot, imagen):
+    imagen()
+    queue = bot.ImageJobQueue(worker_count=1, max_pending=1)
+
+    async def run():
+        assert queue.submit("first", 1, Waiter().deliver) == 1
+        assert queue.submit("second", 1, Waiter().deliver) == -1
+        assert queue.submit("first", 1, Waiter().deliver) == 1 # Joining a queued job takes no room
+        await queue.close()
+
+    asyncio.run(run())
+    assert (queue.submitted, queue.rejected, queue.deduplicated) == (1, 1, 1)
+
+def test_transient_failure_requeues_the_job(bot, imagen):
+    fake = imagen(failures=[bot.CircuitOpenError("image", 0.01)])
+    queue = bot.ImageJobQueue(worker_count=1, max_pending=10)
+    waiter = Waiter()
+
+    async def run():
+        queue.submit("A red fox", 1, waiter.deliver, waiter.on_position)
+        queue.start()
+        await wait_all([waiter])
+        await queue.close()
+
+    asyncio.run(run())
+    assert len(fake.calls) == 2
+    assert waiter.results[0].ok
+    assert None in waiter.positions # Told the job is waiting to be retried
+    assert (queue.requeued, queue.completed, queue.failed) == (1, 1, 0)
+
+def test_close_resolves_every_waiter(bot, imagen):
+    imagen(auto_release=False)
+    queue = bot.ImageJobQueue(worker_count=1, max_pending=10)
+    running, queued, retrying = Waiter(), Waiter(), Waiter()
+
+    async def run():
+        queue.submit("running", 1, running.deliver)
+        queue.submit("queued", 1, queued.deliver)
+        queue.start()
+        await asyncio.sleep(0.01)
+        assert queue.stats()["running"] == 1
+        # A job waiting out a retry delay is in neither the lanes nor the running set.
+        job = bot.ImageJob("retrying", "retrying", 1)
+        job.waiters.append(bot.ImageJobWaiter(retrying.deliver))
+        job.requeue_handle = asyncio.get_running_loop().call_later(60, queue._requeue, job)
+        queue._jobs[job.key] = job
+        await asyncio.wait_for(queue.close(), 1)
+        return job
+
+    job = asyncio.run(run())
+    for waiter in (running, queued, retrying):
+        result, = waiter.results
+        assert not result.ok and result.error_kind == "unavailable"
+    assert job.requeue_handle.cancelled()
+    assert queue.stats()["queue_depth"] == 0
@@ -0,0 +1,78 @@
+import asyncio
+import base64
+import binascii
+import json
+
+import pytest
+from aiohttp import web
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256))
+
+def predictions(*images):
+    return json.dumps({"predictions": [{"mimeType": "image/png", "bytesBase64Encoded": base64.b64encode(image).decode()} for image in images]}).encode()
+
+def test_decode_single_prediction(bot):
+    assert bot._decode_image_predictions(predictions(PNG)) == [PNG]
+
+def test_decode_multiple_predictions_in_order(bot):
+    images = [PNG, PNG[::-1], b"third"]
+    assert bot._decode_image_predictions(predictions(*images)) == images
+
+def test_decode_accepts_bytearray(bot):
+    assert bot._decode_image_predictions(bytearray(predictions(PNG))) == [PNG]
+
+def test_decode_without_image_field(bot):
+    assert bot._decode_image_predictions(b'{"predictions": [{"mimeType": "image/png"}]}') is None
+    assert bot._decode_image_predictions(b"{}") is None
+
+def test_decode_malformed_base64_raises(bot):
+    with pytest.raises(binascii.Error):
+        bot._decode_image_predictions(b'{"predictions": [{"bytesBase64Encoded": "abc"}]}')
+
+def test_result_ok(bot):
+    assert bot.ImageGenerationResult(images=[PNG]).ok
+    assert not bot.ImageGenerationResult().ok # No images and no error is still a failure
+    failure = bot.ImageGenerationResult.failure("blocked", "Image generation blocked.")
+    assert not failure.ok and failure.images == [] and failure.error_kind == "blocked"
+
+@pytest.fixture
+def imagen_stub(bot, monkeypatch):
+    for name in ("image", "image_fast"):
+        monkeypatch.setitem(bot.upstream_endpoints, name, bot.UpstreamEndpoint(name))
+    monkeypatch.setitem(bot.model_routers, "image", bot.ModelRouter("image", {"pro": "imagen"}))
+    monkeypatch.setattr(bot, "image_cache", None)
+
+    def request_images(body):
+        async def handler(request):
+            return web.Response(body=body, content_type="application/json")
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/models/{method}", handler)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            host, port = runner.addresses[0][:2]
+            monkeypatch.setattr(bot, "GEMINI_API_BASE", f"http://{host}:{port}")
+            try:
+                return await bot.generate_images_from_prompt("A red fox", 2)
+            finally:
+                await bot.close_http_session()
+                await runner.cleanup()
+
+        return asyncio.run(run())
+    return request_images
+
+def test_request_returns_every_image(imagen_stub):
+    result = imagen_stub(predictions(PNG, PNG[::-1]))
+    assert result.ok and result.images == [PNG, PNG[::-1]] and result.model == "imagen"
+
+def test_request_without_image_data_fails(imagen_stub):
+    result = imagen_stub(b'{"predictions": [{"mimeType": "image/png"}]}')
+    assert (result.ok, result.error_kind) == (False, "no_image")
+
+def test_request_with_malformed_image_data_fails(imagen_stub):
+    result = imagen_stub(b'{"predictions": [{"bytesBase64Encoded": "abc"}]}')
+    assert (result.ok, result.error_kind) == (False, "no_image")
+    assert "malformed" in result.error
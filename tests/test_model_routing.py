@@ -0,0 +1,189 @@
+import asyncio
+import json
+import types
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+PRO = "pro-model"
+FAST = "fast-model"
+
+@pytest.fixture
+def router(bot, monkeypatch):
+    for name in ("text", "text_fast"):
+        monkeypatch.setitem(bot.upstream_endpoints, name, bot.UpstreamEndpoint(name))
+    router = bot.ModelRouter("text", {"pro": PRO, "fast": FAST})
+    monkeypatch.setitem(bot.model_routers, "text", router)
+    return router
+
+def degrade(bot, health):
+    for _ in range(bot.MODEL_HEALTH_MIN_SAMPLES):
+        health.record(0.1, succeeded=False)
+
+def let_cooldown_pass(bot, health):
+    health.degraded_until -= bot.MODEL_FAILOVER_COOLDOWN + 1
+
+async def start_gemini(handler):
+    app = web.Application()
+    app.router.add_post("/models/{method}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+def gemini_stub(failing_status, calls):
+    """Answers as the fast model; the pro model fails with failing_status."""
+    async def handler(request):
+        model, method = request.match_info["method"].split(":")
+        calls.append(model)
+        if model == PRO:
+            return web.Response(status=failing_status, headers={"Retry-After": "0"})
+        reply = {"candidates": [{"content": {"role": "model", "parts": [{"text": f"Answer from {model}"}]}}]}
+        if method == "streamGenerateContent":
+            return web.Response(body=b"data: " + json.dumps(reply).encode() + b"\r\n\r\n", content_type="text/event-stream")
+        return web.json_response(reply)
+    return handler
+
+def test_health_degrades_after_errors_and_recovers(bot):
+    health = bot.ModelHealth(PRO)
+    for _ in range(bot.MODEL_HEALTH_MIN_SAMPLES - 1):
+        health.record(0.1, succeeded=False)
+    assert not health.is_degraded() # Too few samples to judge
+    health.record(0.1, succeeded=False)
+    assert health.is_degraded() and health.stats()["degraded_reason"] == "errors"
+    let_cooldown_pass(bot, health)
+    assert not health.is_degraded()
+    assert health.stats()["samples"] == 0 # Judged afresh after the cooldown
+
+def test_health_degrades_when_slow_or_rate_limited(bot):
+    health = bot.ModelHealth(PRO)
+    for _ in range(bot.MODEL_HEALTH_MIN_SAMPLES):
+        health.record(bot.MODEL_FAILOVER_P95_SECONDS + 1, succeeded=True)
+    assert health.stats()["degraded_reason"] == "slow"
+    health = bot.ModelHealth(PRO)
+    health.record(0.1, succeeded=False, rate_limited=True)
+    assert health.stats()["degraded_reason"] == "rate_limited"
+
+def test_simple_prompt_goes_to_fast_model(router):
+    assert router.choose("What's the capital of France?") == FAST
+    assert router.choose("Explain step by step how a compiler works.") == PRO
+    assert router.choose("```print(1)```") == PRO
+
+def test_explicit_tier_overrides_heuristic(router):
+    assert router.choose("hi", "pro") == PRO
+    assert router.choose("Explain step by step how a compiler works.", "fast") == FAST
+
+def test_degraded_model_fails_over_until_cooldown(bot, router):
+    prompt = "Explain step by step how a compiler works."
+    degrade(bot, router.health[PRO])
+    assert router.choose(prompt) == FAST
+    assert router.choose(prompt, "pro") == FAST
+    let_cooldown_pass(bot, router.health[PRO])
+    assert router.choose(prompt) == PRO
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_routed_response_fails_over(bot, router, status):
+    calls = []
+
+    async def run():
+        runner, url = await start_gemini(gemini_stub(status, calls))
+        open_response = lambda model: bot.resilient_request(router.endpoint_for(model), "POST", f"{url}/models/{model}:generateContent", max_retries=router.retries_for(model))
+        try:
+            async with bot.routed_response(router, PRO, open_response) as (response, model):
+                return model, await response.json()
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    model, data = asyncio.run(run())
+    assert model == FAST
+    assert data["candidates"][0]["content"]["parts"][0]["text"] == f"Answer from {FAST}"
+    assert calls == [PRO] * (router.retries_for(PRO) + 1) + [FAST]
+    assert router.health[PRO].is_degraded() == (status == 429)
+    assert router.health[FAST].stats()["samples"] == 1
+
+def test_routed_response_raises_without_fallback(bot, monkeypatch):
+    monkeypatch.setitem(bot.upstream_endpoints, "text", bot.UpstreamEndpoint("text"))
+    router = bot.ModelRouter("text", {"pro": PRO})
+    calls = []
+
+    async def run():
+        runner, url = await start_gemini(gemini_stub(503, calls))
+        open_response = lambda model: bot.resilient_request("text", "POST", f"{url}/models/{model}:generateContent", max_retries=0)
+        try:
+            async with bot.routed_response(router, PRO, open_response):
+                pass
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(run())
+    assert calls == [PRO]
+
+class FakeMessage:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def edit(self, **fields):
+        self.interaction.record(fields)
+
+    async def delete(self):
+        pass
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **fields):
+        self.interaction.record(fields)
+        return FakeMessage(self.interaction)
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, user_id):
+        self.user = types.SimpleNamespace(id=user_id, display_name="tester")
+        self.guild = None
+        self.guild_id = None
+        self.channel_id = None
+        self.channel = None
+        self.response = FakeResponse()
+        self.followup = FakeFollowup(self)
+        self.embeds = []
+
+    def record(self, fields):
+        self.embeds.extend(embed for embed in fields.get("embeds") or [fields.get("embed")] if embed is not None)
+
+    async def edit_original_response(self, **fields):
+        self.record(fields)
+
+    async def original_response(self):
+        return FakeMessage(self)
+
+@pytest.mark.parametrize("streamed", [True, False])
+def test_footer_names_the_model_that_answered(bot, router, monkeypatch, streamed):
+    monkeypatch.setattr(bot, "AI_STREAM_RESPONSES", streamed)
+    interaction = FakeInteraction(6100 + streamed)
+    calls = []
+
+    async def run():
+        runner, url = await start_gemini(gemini_stub(503, calls))
+        monkeypatch.setattr(bot, "GEMINI_API_BASE", url)
+        try:
+            model = types.SimpleNamespace(name="Pro", value="pro")
+            await bot.ai_command.callback(interaction, f"Explain failover, streamed={streamed}.", False, model)
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert calls[-1] == FAST
+    embed = interaction.embeds[-1]
+    assert embed.fields[1].value == f"Answer from {FAST}"
+    assert f"Model: {FAST} |" in embed.footer.text
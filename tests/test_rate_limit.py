@@ -0,0 +1,101 @@
+import asyncio
+import types
+
+import pytest
+
+BUCKETS = [("global", 10, 1.0), ("user", 2, 0.5)]
+
+def test_takes_from_every_bucket(bot):
+    retry_after, states = bot._take_from_buckets({}, BUCKETS, 1, 100.0)
+    assert retry_after == 0.0
+    assert states == {"global": (9, 100.0), "user": (1, 100.0)}
+
+def test_takes_from_no_bucket_when_one_is_short(bot):
+    states = {"global": (10, 100.0), "user": (0.5, 100.0)}
+    retry_after, new_states = bot._take_from_buckets(states, BUCKETS, 1, 100.0)
+    assert retry_after == pytest.approx(1.0) # 0.5 tokens missing at 0.5 per second
+    assert new_states == {"global": (10, 100.0), "user": (0.5, 100.0)}
+
+def test_buckets_refill_up_to_capacity(bot):
+    states = {"global": (0, 0.0), "user": (0, 0.0)}
+    retry_after, new_states = bot._take_from_buckets(states, BUCKETS, 1, 1000.0)
+    assert retry_after == 0.0
+    assert new_states == {"global": (9, 1000.0), "user": (1, 1000.0)}
+
+def test_cost_above_capacity_needs_a_full_bucket(bot):
+    retry_after, new_states = bot._take_from_buckets({}, BUCKETS, 5, 100.0)
+    assert retry_after == 0.0
+    assert new_states["user"] == (0, 100.0)
+
+@pytest.fixture(params=["file", "sqlite", "redis"])
+def backend(bot, request, tmp_path):
+    if request.param == "file":
+        state_backend = bot.FileStateBackend()
+    elif request.param == "sqlite":
+        state_backend = bot.SQLiteStateBackend(str(tmp_path / "state.db"))
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        pytest.importorskip("lupa") # fakeredis runs Lua scripts through lupa
+        state_backend = bot.RedisStateBackend(client=fakeredis.FakeRedis(), prefix="test")
+    yield state_backend
+    if request.param != "file": # The file backend would save its buckets into the working directory
+        state_backend.close()
+
+def test_take_tokens_until_limited(backend):
+    buckets = [(f"test-{id(backend)}", 3, 0.01)]
+    assert [backend.take_tokens(buckets, 1) for _ in range(3)] == [0.0, 0.0, 0.0]
+    retry_after = backend.take_tokens(buckets, 1)
+    assert 0 < retry_after <= 100
+    assert backend.take_tokens([(f"other-{id(backend)}", 3, 0.01)], 3) == 0.0
+
+def test_take_tokens_is_all_or_nothing(backend):
+    small, large = f"small-{id(backend)}", f"large-{id(backend)}"
+    assert backend.take_tokens([(small, 1, 0.01)], 1) == 0.0
+    assert backend.take_tokens([(large, 5, 0.01), (small, 1, 0.01)], 1) > 0
+    # The large bucket was not charged for the rejected request.
+    assert [backend.take_tokens([(large, 5, 0.01)], 1) for _ in range(5)] == [0.0] * 5
+
+def fake_interaction(user_id=1, guild_id=None, **namespace):
+    return types.SimpleNamespace(namespace=types.SimpleNamespace(**namespace), guild_id=guild_id, guild=None, user=types.SimpleNamespace(id=user_id))
+
+def test_rate_limited_check_raises_when_exhausted(bot, monkeypatch):
+    limiter = bot.RateLimiter(bot.FileStateBackend(), {"gemini": 60})
+    monkeypatch.setattr(bot, "rate_limiter", limiter)
+
+    @bot.rate_limited("gemini", lambda namespace: 2)
+    async def command(interaction):
+        pass
+    check = command.__discord_app_commands_checks__[0]
+
+    async def run():
+        # A different user each time, so only the global bucket runs out.
+        for user_id in range(60 // 2):
+            assert await check(fake_interaction(user_id=user_id))
+        with pytest.raises(bot.RateLimitExceeded):
+            await check(fake_interaction(user_id=60))
+
+    asyncio.run(run())
+    assert limiter.stats()["limited"] == 1
+
+def test_rejected_requests_are_not_charged(bot, monkeypatch):
+    limiter = bot.RateLimiter(bot.FileStateBackend(), {"gemini": 60})
+    monkeypatch.setattr(bot, "rate_limiter", limiter)
+    check = bot.aiupload_command.checks[0]
+    text_file = types.SimpleNamespace(content_type="text/plain", size=10)
+    image = types.SimpleNamespace(content_type="image/png", size=10)
+
+    async def run():
+        assert await check(fake_interaction(image=text_file, text=None, search=False))
+        assert await check(fake_interaction(image=image, text=None, search=True))
+        assert limiter.stats()["allowed"] == 0
+        assert await check(fake_interaction(image=image, text="what is this?", search=True))
+        assert limiter.stats()["allowed"] == 1
+
+    asyncio.run(run())
+
+def test_request_rejections(bot):
+    image = types.SimpleNamespace(content_type="image/png", size=bot.MAX_UPLOAD_IMAGE_BYTES + 1)
+    assert bot.aiupload_request_rejection(image).startswith("That image is too large.")
+    assert bot.aiupload_request_rejection(None) is not None
+    assert bot.generateimage_request_rejection("  ") == "Please provide a prompt to generate an image."
+    assert bot.generateimage_request_rejection("a cat") is None
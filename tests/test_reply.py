@@ -0,0 +1,69 @@
+import discord
+
+def paragraphs(count, length=900):
+    return "\n\n".join(f"{index:03d} " + "word " * ((length - 4) // 5) for index in range(count))
+
+def test_short_text_is_not_split(bot):
+    assert bot.split_markdown_once("hello", 10) == ("hello", "")
+
+def test_split_prefers_paragraph_boundaries(bot):
+    text = "first paragraph\n\nsecond paragraph"
+    chunk, rest = bot.split_markdown_once(text, 24)
+    assert (chunk, rest) == ("first paragraph", "second paragraph")
+
+def test_split_falls_back_to_words(bot):
+    chunk, rest = bot.split_markdown_once("alpha beta gamma delta epsilon", 20)
+    assert len(chunk) <= 20
+    assert f"{chunk} {rest}" == "alpha beta gamma delta epsilon"
+
+def test_split_code_block_is_closed_and_reopened(bot):
+    code = "```python\n" + "".join(f"line_{index} = {index}\n" for index in range(40)) + "```"
+    chunk, rest = bot.split_markdown_once(code, 200)
+    assert len(chunk) <= 200
+    assert chunk.endswith("\n```") and bot._open_code_block(chunk) is None
+    assert rest.startswith("```python\n")
+
+def test_chunks_fit_discord_limits(bot):
+    text = paragraphs(60)
+    pages = bot.pack_reply_chunks(text, 3000)
+    assert len(pages) > 1
+    assert sum(len(chunk) for chunk in pages[0]) <= 3000
+    for index, page in enumerate(pages):
+        assert page
+        assert len(page) <= bot.DISCORD_MESSAGE_EMBED_LIMIT - (1 if index == 0 else 0)
+        assert sum(len(chunk) for chunk in page) <= bot.DISCORD_MESSAGE_EMBED_CHARS
+        assert all(0 < len(chunk) <= bot.DISCORD_EMBED_DESCRIPTION_LIMIT and chunk.strip() for chunk in page)
+    # Only whitespace is lost at the cuts.
+    assert " ".join(chunk for page in pages for chunk in page).split() == text.split()
+
+def test_little_room_starts_a_new_message(bot):
+    pages = bot.pack_reply_chunks("short reply", bot.REPLY_MIN_EMBED_CHARS - 1)
+    assert pages == [[], ["short reply"]]
+
+def test_layout_short_reply_fits_the_field(bot):
+    embed = discord.Embed(title="AI Response")
+    embed.add_field(name="AI Says", value="(Thinking...)")
+    assert bot.layout_reply(embed, 0, "short answer", "(No response)") == ([[]], False)
+    assert embed.fields[0].value == "short answer"
+
+def test_layout_long_reply_continues_in_embeds(bot):
+    embed = discord.Embed(title="AI Response")
+    embed.add_field(name="AI Says", value="(Thinking...)")
+    text = paragraphs(8)
+    pages, attach_file = bot.layout_reply(embed, 0, text, "(No response)")
+    assert not attach_file
+    assert embed.fields[0].value.endswith("...") and len(embed.fields[0].value) <= bot.DISCORD_EMBED_FIELD_LIMIT
+    assert len(embed) + sum(len(chunk) for chunk in pages[0]) <= bot.DISCORD_MESSAGE_EMBED_CHARS
+
+def test_layout_very_long_reply_is_attached(bot):
+    embed = discord.Embed(title="AI Response")
+    embed.add_field(name="AI Says", value="(Thinking...)")
+    pages, attach_file = bot.layout_reply(embed, 0, "x " * bot.REPLY_FILE_THRESHOLD, "(No response)")
+    assert (pages, attach_file) == ([[]], True)
+    assert embed.fields[-1].name == "Full Reply"
+
+def test_layout_empty_reply(bot):
+    embed = discord.Embed(title="AI Response")
+    embed.add_field(name="AI Says", value="(Thinking...)")
+    bot.layout_reply(embed, 0, "", "(No response)")
+    assert embed.fields[0].value == "(No response)"
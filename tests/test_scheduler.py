@@ -0,0 +1,77 @@
+import asyncio
+from collections import OrderedDict, deque
+
+def make_lanes(*lanes):
+    return [OrderedDict((key, deque(items)) for key, items in lane) for lane in lanes]
+
+def predicted_order(bot, lanes):
+    positions = {}
+    for lane_index, lane in enumerate(lanes):
+        for fair_key, items in lane.items():
+            for item in items:
+                positions[item] = bot._fair_lane_position(lanes, lane_index, fair_key, item)
+    return sorted(positions, key=positions.get)
+
+def served_order(bot, lanes):
+    order = []
+    while (item := bot._pop_fair_lane(lanes)) is not None:
+        order.append(item)
+    return order
+
+def test_round_robin_across_keys(bot):
+    lanes = make_lanes([], [("a", ["a1", "a2", "a3"]), ("b", ["b1"]), ("c", ["c1", "c2"])])
+    assert served_order(bot, lanes) == ["a1", "b1", "c1", "a2", "c2", "a3"]
+
+def test_priority_lane_served_first(bot):
+    lanes = make_lanes([("p", ["p1", "p2"])], [("a", ["a1"])])
+    assert bot._fair_lane_position(lanes, 1, "a", "a1") == 3
+    assert served_order(bot, lanes) == ["p1", "p2", "a1"]
+
+def test_positions_match_serving_order(bot):
+    lanes = make_lanes(
+        [("p", ["p1"]), ("q", ["q1", "q2"])],
+        [("a", ["a1", "a2", "a3"]), ("b", ["b1"]), ("c", ["c1", "c2", "c3", "c4"])]
+    )
+    assert predicted_order(bot, lanes) == served_order(bot, lanes)
+
+def test_positions_are_one_based_and_distinct(bot):
+    lanes = make_lanes([], [("a", ["a1", "a2"]), ("b", ["b1", "b2"])])
+    positions = [bot._fair_lane_position(lanes, 1, key, item) for key, item in (("a", "a1"), ("a", "a2"), ("b", "b1"), ("b", "b2"))]
+    assert positions == [1, 3, 2, 4]
+
+def test_pop_from_empty_lanes(bot):
+    assert bot._pop_fair_lane(make_lanes([], [])) is None
+
+def test_scheduler_caps_concurrency_and_serves_fairly(bot):
+    async def run():
+        scheduler = bot.UpstreamScheduler("test", 1)
+        started = []
+        release = asyncio.Event()
+
+        async def request(fair_key, name):
+            async with scheduler.slot(fair_key):
+                started.append(name)
+                await release.wait()
+
+        tasks = [asyncio.create_task(request(key, name)) for key, name in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"))]
+        await asyncio.sleep(0)
+        assert started == ["a1"] and scheduler.queue_depth() == 3
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == ["a1", "a2", "b1", "a3"]
+        assert scheduler.in_flight == 0
+    asyncio.run(run())
+
+def test_cancelled_waiter_leaves_the_queue(bot):
+    async def run():
+        scheduler = bot.UpstreamScheduler("test", 1)
+        await scheduler.acquire("a")
+        waiter = asyncio.create_task(scheduler.acquire("b"))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth() == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queue_depth() == 0
+        scheduler.release()
+        assert scheduler.in_flight == 0
+    asyncio.run(run())
@@ -0,0 +1,99 @@
+import asyncio
+import types
+
+import pytest
+
+class StubSearchBackend:
+    def __init__(self, items, delay=0.0):
+        self.items = items
+        self.delay = delay
+        self.queries = []
+
+    def configuration_error(self):
+        return None
+
+    async def search(self, query, num_results):
+        self.queries.append((query, num_results))
+        await asyncio.sleep(self.delay)
+        return self.items[:num_results]
+
+@pytest.fixture
+def stub_search(bot):
+    original = bot.search_backend
+    backend = StubSearchBackend([{"title": "Example", "snippet": "An\nexample", "link": "https://example.com"}], delay=0.05)
+    bot.set_search_backend(backend)
+    yield backend
+    bot.set_search_backend(original)
+
+def test_results_are_formatted(bot, stub_search):
+    result = asyncio.run(bot.search_google("example"))
+    assert result == "1. Example: An example (Source: https://example.com)"
+
+def test_repeated_query_is_served_from_cache(bot, stub_search):
+    async def run():
+        first = await bot.search_google("What is  Example?")
+        second = await bot.search_google("what is example?")
+        return first, second
+    first, second = asyncio.run(run())
+    assert first == second
+    assert len(stub_search.queries) == 1
+    assert bot.search_cache.stats()["hits"] == 1
+
+def test_concurrent_identical_queries_share_one_call(bot, stub_search):
+    async def run():
+        return await asyncio.gather(*(bot.search_google("example") for _ in range(5)))
+    results = asyncio.run(run())
+    assert len(set(results)) == 1
+    assert len(stub_search.queries) == 1
+
+def test_result_count_is_part_of_the_key(bot, stub_search):
+    async def run():
+        await bot.search_google("example", num_results=1)
+        await bot.search_google("example", num_results=3)
+    asyncio.run(run())
+    assert stub_search.queries == [("example", 1), ("example", 3)]
+
+def test_empty_query_and_errors(bot, stub_search):
+    async def failing_search(query, num_results):
+        raise RuntimeError("quota exceeded")
+    assert asyncio.run(bot.search_google("   ")) == "Search query was empty."
+    stub_search.search = failing_search
+    assert asyncio.run(bot.search_google("example")).startswith("An error occurred while trying to search: quota exceeded")
+
+def test_no_results(bot):
+    original = bot.search_backend
+    bot.set_search_backend(StubSearchBackend([]))
+    try:
+        assert asyncio.run(bot.search_google("nothing")) == "No relevant search results found."
+    finally:
+        bot.set_search_backend(original)
+
+def test_unconfigured_custom_search(bot):
+    backend = bot.GoogleCustomSearchBackend("key", "YOUR_GOOGLE_CSE_ID_HERE")
+    assert backend.configuration_error() == "Search is not configured by the bot owner."
+
+def test_resetai_retires_cached_search_answers(bot):
+    user_id = 9001
+    url = bot.gemini_model_url(bot.GEMINI_PRO_MODEL, "generateContent")
+    replies = []
+    other_key = bot.search_answer_cache_key(url, "weather today", None, ("dm", user_id + 1))
+
+    async def send_message(content, **fields):
+        replies.append(content)
+
+    interaction = types.SimpleNamespace(guild=None, user=types.SimpleNamespace(id=user_id), response=types.SimpleNamespace(send_message=send_message))
+
+    async def run():
+        await bot.add_to_conversation_history("earlier question", "user", user_id=user_id, is_dm=True)
+        old_key = bot.search_answer_cache_key(url, "weather today", None, ("dm", user_id))
+        await bot.response_cache.set(old_key, "answer from the old conversation")
+        _, cached_text = await bot._get_cached_search_answer(url, "weather today", True, True, None, user_id, True)
+        assert cached_text == "answer from the old conversation"
+        await bot.resetai_command.callback(interaction)
+        new_key, cached_text = await bot._get_cached_search_answer(url, "weather today", True, True, None, user_id, True)
+        assert new_key != old_key and cached_text is None
+
+    asyncio.run(run())
+    assert replies == ["Your DM conversation history with the AI has been reset."]
+    # Other conversations keep their cached answers.
+    assert bot.search_answer_cache_key(url, "weather today", None, ("dm", user_id + 1)) == other_key
@@ -0,0 +1,59 @@
+import pytest
+
+def entry(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+@pytest.fixture(params=["sqlite", "redis"])
+def backend(bot, request, tmp_path):
+    if request.param == "sqlite":
+        state_backend = bot.SQLiteStateBackend(str(tmp_path / "state.db"))
+    else:
+        fakeredis = pytest.importorskip("fakeredis")
+        state_backend = bot.RedisStateBackend(client=fakeredis.FakeRedis(), prefix="test")
+    yield state_backend
+    state_backend.close()
+
+def test_history_records_are_appended_and_replayed(backend):
+    backend.append_history_records("guild", (1, 2), [{"op": "append", "entry": entry("a")}])
+    backend.append_history_records("guild", (1, 2), [{"op": "reset"}, {"op": "append", "entry": entry("b")}])
+    assert backend.load_history("guild", (1, 2)) == ([entry("b")], 3)
+    assert backend.load_history("guild", (1, 3)) == ([], 0)
+    assert backend.load_history("dm", (1, 2)) == ([], 0)
+
+def test_replace_history_compacts_records(backend):
+    backend.append_history_records("dm", 7, [{"op": "append", "entry": entry(str(i))} for i in range(5)])
+    backend.replace_history("dm", 7, [entry("4")])
+    assert backend.load_history("dm", 7) == ([entry("4")], 1)
+    backend.replace_history("dm", 7, [])
+    assert backend.load_history("dm", 7) == ([], 0)
+
+def test_values_round_trip(backend):
+    backend.set_value("search", "key", {"items": [1]}, 60)
+    assert backend.get_value("search", "key") == {"items": [1]}
+    assert backend.get_value("responses", "key") is None
+
+def test_sqlite_values_expire(bot, tmp_path):
+    state_backend = bot.SQLiteStateBackend(str(tmp_path / "state.db"))
+    state_backend.set_value("search", "key", "value", -1)
+    assert state_backend.get_value("search", "key") is None
+    state_backend.close()
+
+def test_sqlite_is_shared_between_connections(bot, tmp_path):
+    path = str(tmp_path / "state.db")
+    first, second = bot.SQLiteStateBackend(path), bot.SQLiteStateBackend(path)
+    first.append_history_records("guild", (1,), [{"op": "append", "entry": entry("from first")}])
+    second.append_history_records("guild", (1,), [{"op": "append", "entry": entry("from second")}])
+    assert first.load_history("guild", (1,)) == ([entry("from first"), entry("from second")], 2)
+    first.close()
+    second.close()
+
+def test_state_keys(bot):
+    assert bot._state_key((1, 2)) == "1/2"
+    assert bot._state_key(5) == "5"
+
+def test_create_state_backend(bot, tmp_path):
+    state_backend = bot.create_state_backend(f"sqlite:///{tmp_path / 'state.db'}")
+    assert isinstance(state_backend, bot.SQLiteStateBackend) and state_backend.shared
+    state_backend.close()
+    with pytest.raises(ValueError):
+        bot.create_state_backend("postgres://localhost")
@@ -0,0 +1,107 @@
+import asyncio
+import json
+
+import discord
+from aiohttp import web
+
+def sse_chunk(text):
+    return b"data: " + json.dumps({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}).encode() + b"\r\n\r\n"
+
+async def start_gemini(handler):
+    app = web.Application()
+    app.router.add_post("/models/{method}", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+async def broken_stream(request):
+    """Sends one chunk of the reply, then drops the connection."""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    await response.write(sse_chunk("The first half"))
+    await asyncio.sleep(0.05)
+    request.transport.close()
+    return response
+
+class FakeMessage:
+    def __init__(self):
+        self.edits = []
+
+    async def edit(self, **fields):
+        self.edits.append(fields)
+
+    async def delete(self):
+        pass
+
+class FakeFollowup:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **fields):
+        self.sent.append({"content": content, **fields})
+        return FakeMessage()
+
+class FakeInteraction:
+    def __init__(self):
+        self.followup = FakeFollowup()
+
+def reply_embed():
+    embed = discord.Embed(title="AI Response (Gemini)")
+    embed.add_field(name="You Asked", value="question", inline=False)
+    embed.add_field(name="AI Says", value="(Thinking...)", inline=False)
+    return embed
+
+def test_stream_failing_after_first_chunk(bot, monkeypatch):
+    user_id = 6001
+
+    async def run():
+        runner, url = await start_gemini(broken_stream)
+        monkeypatch.setattr(bot, "GEMINI_API_BASE", url)
+        try:
+            pieces = [piece async for piece in bot.stream_ai_response("Tell me a story", False, user_id=user_id, is_dm=True, use_cache=False, model_tier="pro")]
+            history = list(await bot.get_user_dm_history(user_id))
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+        return pieces, history
+
+    pieces, history = asyncio.run(run())
+    assert pieces[0] == "The first half"
+    assert isinstance(pieces[-1], bot.StreamNotice) and pieces[-1].startswith("Sorry")
+    assert not any(isinstance(piece, bot.StreamNotice) for piece in pieces[:-1])
+    # The partial reply is recorded, so the next request does not send two user turns in a row.
+    assert [entry["role"] for entry in history] == ["user", "model"]
+    assert history[-1]["parts"][0]["text"] == "The first half"
+
+def test_interrupted_reply_gets_a_separate_notice(bot):
+    async def stream():
+        yield "The first half"
+        yield bot.StreamNotice("Sorry, an unexpected error occurred.")
+
+    async def run():
+        interaction, message, embed = FakeInteraction(), FakeMessage(), reply_embed()
+        text = await bot.deliver_streamed_response(interaction, message, embed, 1, stream())
+        return interaction, embed, text
+
+    interaction, embed, text = asyncio.run(run())
+    assert text == "The first half"
+    assert embed.fields[1].value == "The first half"
+    notice_embed, = [sent["embed"] for sent in interaction.followup.sent]
+    assert notice_embed.title == "Reply Interrupted"
+    assert notice_embed.description == "Sorry, an unexpected error occurred."
+
+def test_notice_before_any_text_replaces_the_reply(bot):
+    async def stream():
+        yield bot.StreamNotice("Sorry, the text service is temporarily unavailable.")
+
+    async def run():
+        interaction, message, embed = FakeInteraction(), FakeMessage(), reply_embed()
+        await bot.deliver_streamed_response(interaction, message, embed, 1, stream())
+        return interaction, embed
+
+    interaction, embed = asyncio.run(run())
+    assert embed.fields[1].value == "Sorry, the text service is temporarily unavailable."
+    assert interaction.followup.sent == []
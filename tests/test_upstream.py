@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+def open_circuit(bot, endpoint):
+    for _ in range(bot.CIRCUIT_FAILURE_THRESHOLD):
+        endpoint.before_attempt()
+        endpoint.record_failure()
+    assert endpoint.state == "open"
+
+def let_reset_timeout_pass(bot, endpoint):
+    endpoint.opened_at -= bot.CIRCUIT_RESET_TIMEOUT + 1
+
+def test_circuit_opens_after_consecutive_failures(bot):
+    endpoint = bot.UpstreamEndpoint("test")
+    for _ in range(bot.CIRCUIT_FAILURE_THRESHOLD - 1):
+        endpoint.before_attempt()
+        endpoint.record_failure()
+    assert endpoint.state == "closed"
+    endpoint.before_attempt()
+    endpoint.record_success()
+    assert endpoint.consecutive_failures == 0
+    open_circuit(bot, endpoint)
+    with pytest.raises(bot.CircuitOpenError):
+        endpoint.before_attempt()
+    assert endpoint.total_rejected == 1
+
+def test_half_open_lets_one_probe_through(bot):
+    endpoint = bot.UpstreamEndpoint("test")
+    open_circuit(bot, endpoint)
+    let_reset_timeout_pass(bot, endpoint)
+    endpoint.before_attempt()
+    assert endpoint.state == "half_open"
+    with pytest.raises(bot.CircuitOpenError):
+        endpoint.before_attempt()
+    endpoint.record_success()
+    assert endpoint.state == "closed"
+    endpoint.before_attempt()
+
+def test_failed_probe_reopens_circuit(bot):
+    endpoint = bot.UpstreamEndpoint("test")
+    open_circuit(bot, endpoint)
+    let_reset_timeout_pass(bot, endpoint)
+    endpoint.before_attempt()
+    endpoint.record_failure()
+    assert endpoint.state == "open"
+    with pytest.raises(bot.CircuitOpenError):
+        endpoint.before_attempt()
+
+def test_abandoned_probe_frees_half_open_circuit(bot):
+    endpoint = bot.UpstreamEndpoint("test")
+    open_circuit(bot, endpoint)
+    let_reset_timeout_pass(bot, endpoint)
+    endpoint.before_attempt()
+    endpoint.abandon_attempt()
+    endpoint.before_attempt()
+    assert endpoint.state == "half_open"
+
+def test_retry_delay_honors_retry_after_and_budget(bot):
+    endpoint = bot.UpstreamEndpoint("test")
+    assert endpoint.retry_delay(0, 3, retry_after=2.0) == 2.0
+    assert endpoint.retry_delay(0, 3, retry_after=bot.UPSTREAM_MAX_RETRY_DELAY + 1) is None
+    assert endpoint.retry_delay(3, 3) is None
+    endpoint._retry_tokens = 0
+    assert endpoint.retry_delay(0, 3) is None
+
+def test_parse_retry_after(bot):
+    assert bot.parse_retry_after("1.5") == 1.5
+    assert bot.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert bot.parse_retry_after("soon") is None
+    assert bot.parse_retry_after(None) is None
+
+async def start_server(handler):
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/"
+
+def test_resilient_request_retries_retryable_status(bot, monkeypatch):
+    monkeypatch.setitem(bot.upstream_endpoints, "test", bot.UpstreamEndpoint("test"))
+    statuses = [503, 200]
+
+    async def handler(request):
+        return web.Response(status=statuses.pop(0), headers={"Retry-After": "0"})
+
+    async def run():
+        runner, url = await start_server(handler)
+        try:
+            async with bot.resilient_request("test", "GET", url) as response:
+                return response.status
+        finally:
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == 200
+    endpoint = bot.upstream_endpoints["test"]
+    assert (endpoint.total_requests, endpoint.total_retries, endpoint.state) == (1, 1, "closed")
+
+def test_cancelled_probe_does_not_lock_circuit(bot, monkeypatch):
+    endpoint = bot.UpstreamEndpoint("test")
+    monkeypatch.setitem(bot.upstream_endpoints, "test", endpoint)
+    hang = asyncio.Event()
+
+    async def handler(request):
+        if request.query.get("hang"):
+            await hang.wait()
+        return web.Response(status=200)
+
+    async def run():
+        runner, url = await start_server(handler)
+        try:
+            open_circuit(bot, endpoint)
+            let_reset_timeout_pass(bot, endpoint)
+
+            async def probe():
+                async with bot.resilient_request("test", "GET", url + "?hang=1"):
+                    pass
+
+            probe_task = asyncio.create_task(probe())
+            await asyncio.sleep(0.1)
+            assert endpoint.state == "half_open"
+            probe_task.cancel()
+            await asyncio.gather(probe_task, return_exceptions=True)
+            async with bot.resilient_request("test", "GET", url) as response:
+                assert response.status == 200
+        finally:
+            hang.set()
+            await bot.close_http_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert endpoint.state == "closed"